@@ -22,60 +22,329 @@ Source Code:
 PROJECT_VERSION = "0.2.1"
 
 # Standard imports
+import argparse
+import asyncio
+import hashlib
+import json
 import logging
 import os
+import sqlite3
 import sys
+import time
+from datetime import datetime
 
 # Third-part imports
 import discord
 from discord.ext import commands
 from discord import app_commands
 from dotenv import load_dotenv
-from openai import OpenAI
 
 # Project imports
 import database
+import export
+import governor
+import import_report
+import logs
+import metrics
+import presence
+import recommendations
+import tracing
+import voice_workers
+
+# Where the bot keeps its data
+DATABASE_PATH = "basediscordbot.db"
+
+# Most guilds to sync commands to at once when syncing per guild
+GUILD_SYNC_CONCURRENCY = 5
+
+def gateway_options(profile: str) -> dict:
+    """
+    Gets the gateway settings for an intent profile.
+
+    Every intent the bot has makes Discord send it more events, and caching
+    and chunking members costs memory and startup time in every guild, so
+    deployments should only turn on what their cogs use.
+
+    Args:
+        profile (str): One of the following.
+            'music': Commands and voice only.
+            'activity': Also tracks member presences for the 'Activities'
+                cog. Members are fetched in the background after startup
+                rather than before the bot is ready.
+            'full': Every intent, with all members fetched at startup.
+
+    Returns:
+        dict: Keyword arguments for the bot's constructor.
+
+    Raises:
+        ValueError: If the profile doesn't exist.
+    """
+    if profile == "full":
+        return {
+            "intents": discord.Intents.all(),
+            "chunk_guilds_at_startup": True,
+        }
+
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.voice_states = True
+    intents.guild_messages = True
+    intents.message_content = True
+    if profile == "music":
+        # Only keep members that are in a voice channel with the bot
+        return {
+            "intents": intents,
+            "member_cache_flags": discord.MemberCacheFlags(
+                voice=True, joined=False),
+            "chunk_guilds_at_startup": False,
+        }
+    elif profile == "activity":
+        intents.members = True
+        intents.presences = True
+        return {
+            "intents": intents,
+            "member_cache_flags": discord.MemberCacheFlags.from_intents(
+                intents),
+            "chunk_guilds_at_startup": False,
+        }
+    raise ValueError(f"Unknown intent profile '{profile}'")
 
 class BaseDiscordBot(commands.Bot):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.db = database.Database("basediscordbot.db")
+        self._started = time.perf_counter()
+        self._timings = {}
+        self._ready_once = False
+        # How slash commands are registered; either 'global' or 'guild'
+        self.command_sync = os.getenv("COMMAND_SYNC", "global").lower()
+        # Seconds the copy of the database read by stats commands may lag
+        # behind; 0 reads the live database
+        self.db = database.Database(
+            DATABASE_PATH,
+            snapshot_age=float(os.getenv("ANALYTICS_SNAPSHOT_AGE", "300")))
         self.logger = logging.getLogger("basediscordbot")
-        self.add_listener(self._load_cogs, 'on_ready')
-    
+        self.governor = governor.ResourceGovernor.from_env()
+        self.recommender = recommendations.Recommender.from_env(self.db)
+        self.presence = presence.PresenceManager.from_env(self)
+        self.voice_workers = voice_workers.WorkerPool.from_env()
+        self.metrics = metrics.Exporter.from_env()
+        metrics.FFMPEG_PROCESSES.set_function(
+            lambda: self.governor.processes)
+        self.add_listener(self._on_ready, 'on_ready')
+        self.add_listener(self._on_guild_join, 'on_guild_join')
+        self.before_invoke(self._set_log_context)
+
+    async def setup_hook(self):
+        # This only runs once, unlike 'on_ready', which fires again after
+        # the bot reconnects
+        self._timings["login"] = time.perf_counter() - self._started
+        await self.metrics.start()
+        start = time.perf_counter()
+        await self._load_cogs()
+        self._timings["cogs"] = time.perf_counter() - start
+        if self.command_sync != "guild":
+            start = time.perf_counter()
+            await self._sync_commands()
+            self._timings["sync"] = time.perf_counter() - start
+
+    async def close(self):
+        self.presence.close()
+        self.metrics.close()
+        if self.voice_workers:
+            self.voice_workers.shutdown()
+        await super().close()
+
+    async def _set_log_context(self, ctx):
+        # Each command runs in its own task, so this only tags what's logged
+        # while handling this one
+        logs.guild_id.set(ctx.guild.id if ctx.guild else None)
+        logs.request_id.set(
+            ctx.interaction.id if ctx.interaction else ctx.message.id)
+
+    async def _on_ready(self):
+        if self._ready_once:
+            return
+        self._ready_once = True
+        # Syncing per guild needs the guild list, which we only have now
+        if self.command_sync == "guild":
+            start = time.perf_counter()
+            await self._sync_commands()
+            self._timings["sync"] = time.perf_counter() - start
+        total = time.perf_counter() - self._started
+        self.logger.info(
+            "Ready in %.2fs (%s)", total, ", ".join(
+                f"{name} {seconds:.2f}s"
+                for name, seconds in self._timings.items()))
+
     async def _load_cogs(self):
         self.logger.info("Loading cogs...")
         directory = os.path.dirname(os.path.abspath(__file__))
-        for filename in os.listdir(f'{directory}/cogs'):
-            if filename.endswith('.py'):
-                await self.load_extension(f'cogs.{filename[:-3]}')
-                self.logger.info("Loaded %s cog", filename)
-        for server in self.guilds:
-            await self.tree.sync(guild=discord.Object(id=server.id))
+        names = [
+            filename[:-3] for filename in os.listdir(f'{directory}/cogs')
+            if filename.endswith('.py')
+        ]
+
+        async def load(name):
+            start = time.perf_counter()
+            await self.load_extension(f'cogs.{name}')
+            self.logger.info(
+                "Loaded %s cog in %.2fs", name, time.perf_counter() - start)
+
+        await asyncio.gather(*(load(name) for name in names))
+
+    def _command_tree_hash(self) -> str:
+        """Returns a hash of the slash commands, to tell if they've changed."""
+        payload = sorted(
+            (command.to_dict(self.tree)
+             for command in self.tree.get_commands()),
+            key=lambda command: command["name"])
+        return hashlib.sha256(
+            json.dumps([self.command_sync, payload], sort_keys=True).encode()
+        ).hexdigest()
+
+    async def _sync_commands(self):
+        """
+        Registers the slash commands with Discord if they've changed.
+
+        Syncing is one REST call per guild, or one for all of them, and is
+        heavily rate limited, so a hash of the command tree is kept in the
+        database and the sync is skipped when it matches. Each guild has its
+        own hash, so guilds the bot joins don't make the others sync again.
+        """
+        digest = self._command_tree_hash()
+        if self.command_sync == "guild":
+            limit = asyncio.Semaphore(GUILD_SYNC_CONCURRENCY)
+
+            async def sync(guild):
+                async with limit:
+                    return await self._sync_guild(guild, digest)
+
+            synced = await asyncio.gather(
+                *(sync(guild) for guild in self.guilds))
+            self.logger.info(
+                "Synced command tree in %d of %d guilds",
+                sum(synced), len(synced))
+            return
+
+        if self.db.get_setting("command_tree_hash") == digest:
+            self.logger.info("Command tree unchanged; skipping sync")
+            return
+        await self.tree.sync()
+        self.db.set_setting("command_tree_hash", digest)
+        self.logger.info("Synced command tree")
+
+    async def _sync_guild(
+        self,
+        guild: discord.Guild,
+        digest: str,
+        force: bool = False) -> bool:
+        """
+        Registers the slash commands in a guild if they've changed there.
+
+        Args:
+            guild (discord.Guild): The guild to register them in.
+            digest (str): The hash of the command tree.
+            force (bool): Whether to sync even if the hash matches.
+
+        Returns:
+            bool: Whether the commands were synced.
+        """
+        key = f"command_tree_hash:{guild.id}"
+        if not force and self.db.get_setting(key) == digest:
+            return False
+        self.tree.copy_global_to(guild=guild)
+        await self.tree.sync(guild=guild)
+        self.db.set_setting(key, digest)
+        return True
+
+    async def _on_guild_join(self, guild: discord.Guild):
+        # Guild commands may have been removed while the bot was away, so
+        # they're synced even if the stored hash matches
+        if self.command_sync == "guild":
+            await self._sync_guild(guild, self._command_tree_hash(), force=True)
+            self.logger.info("Synced command tree in new guild %s", guild.id)
 
 def main():
-    # Create custom logging handler
-    console_handler = logging.StreamHandler(sys.stdout)
-    console_formatter = logging.Formatter(
-        "[%(asctime)s] [%(levelname)s] [%(name)s] %(message)s")
-    console_handler.setFormatter(console_formatter)
-
-    # Make sure all loggers use this handler
-    root_logger = logging.getLogger()
-    root_logger.setLevel(logging.INFO)
-    root_logger.addHandler(console_handler)
-    
-    # Load credentials
+    parser = argparse.ArgumentParser(description="Runs the bot.")
+    parser.add_argument(
+        "--import-report", action="store_true",
+        help="print how long each module takes to import and exit")
+    parser.add_argument(
+        "--import-budget", type=float, metavar="MS",
+        help="with --import-report, fail if importing takes longer than this")
+    parser.add_argument(
+        "--trace-summary", nargs="?", metavar="PATH",
+        const=True,
+        help="print percentiles of how long each span of '!play' requests "
+             "took and exit")
+    parser.add_argument(
+        "--export", choices=database.EXPORT_TABLES, metavar="TABLE",
+        help="export a history table to a file and exit; one of "
+             + ", ".join(database.EXPORT_TABLES))
+    parser.add_argument(
+        "--output", metavar="PATH",
+        help="with --export, the file to write; .csv or .parquet")
+    parser.add_argument(
+        "--format", choices=export.FORMATS,
+        help="with --export, the file format if not the output's extension")
+    parser.add_argument(
+        "--since", type=datetime.fromisoformat, metavar="TIME",
+        help="with --export or --trace-summary, only use rows or spans from "
+             "this time on")
+    parser.add_argument(
+        "--until", type=datetime.fromisoformat, metavar="TIME",
+        help="with --export, only export rows from before this time")
+    parser.add_argument(
+        "--guild", type=int, metavar="ID",
+        help="with --export, only export rows from this server")
+    args = parser.parse_args()
+    if args.import_report:
+        sys.exit(import_report.report(args.import_budget))
+    if args.trace_summary:
+        load_dotenv()
+        path = args.trace_summary
+        if path is True:
+            path = os.getenv("TRACE_PATH") or "traces.jsonl"
+        sys.exit(tracing.report(
+            path,
+            args.since.timestamp() if args.since else None))
+    if args.export:
+        if not args.output:
+            parser.error("--export needs --output")
+        logging.basicConfig(
+            level=logging.INFO,
+            format="[%(asctime)s] [%(levelname)s] [%(name)s] %(message)s")
+        try:
+            export.export(
+                database.Database(DATABASE_PATH), args.export, args.output,
+                args.format, args.since, args.until, args.guild)
+        except (ValueError, RuntimeError) as e:
+            parser.error(str(e))
+        sys.exit(0)
+
+    # Load credentials and settings
     load_dotenv()
+
+    # Make sure all loggers write through the background log writer
+    logs.setup()
+
     TOKEN = os.getenv('DISCORD_TOKEN')
 
-    # Create bot
+    # Create bot, only receiving the events the deployment needs
     client = BaseDiscordBot(
         command_prefix = '!',
-        intents=discord.Intents.all(),
-        log_hander=False
+        log_hander=False,
+        **gateway_options(os.getenv('INTENT_PROFILE', 'full').lower())
     )
 
+    # Old databases need a one-time full VACUUM before the retention job can
+    # shrink them, which locks the database, so it's done before connecting
+    try:
+        client.db.enable_incremental_vacuum()
+    except sqlite3.OperationalError as e:
+        client.logger.warning(
+            "Couldn't convert database to incremental vacuum: %s", e)
+
     # Run bot
     client.run(TOKEN, log_handler=None)
 
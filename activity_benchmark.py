@@ -0,0 +1,178 @@
+"""
+Compares the old and compact storage of activity changes.
+
+Builds a database in the old 'activity_change' format from synthetic presence
+updates, migrates it with 'Database.migrate_activity_changes()', and reports
+the file size and the time taken to get a user's activity stats before and
+after.
+
+Examples:
+    $ python activity_benchmark.py
+    $ python activity_benchmark.py --rows 1000000 --path /tmp/activity.db
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from database import Database
+
+# Shape of the synthetic data
+USERS = 5000
+ACTIVITIES = 2000
+TYPES = ["playing", "streaming", "listening", "watching", "custom", "competing"]
+STATUSES = ["online", "idle", "dnd", "offline"]
+
+# Number of users whose stats are fetched when timing queries
+QUERIES = 50
+
+# Query the old 'get_activity_stats()' used
+OLD_STATS_QUERY = """
+    SELECT
+        before_activity_name,
+        after_activity_name,
+        timestamp
+    FROM
+        activity_change
+    WHERE
+        user_id = (?) AND
+        timestamp > (?)
+"""
+
+
+def create_old_schema(path: str, rows: int, batch_size: int = 100000):
+    """Creates a database holding 'rows' activity changes in the old format."""
+    rng = random.Random(0)
+    activities = [
+        (rng.choice(TYPES), f"Activity {i} " + "x" * rng.randrange(5, 30))
+        for i in range(ACTIVITIES)]
+    with sqlite3.connect(path) as conn:
+        conn.execute("""
+            CREATE TABLE user (
+                id INTEGER PRIMARY KEY,
+                discord_id INTEGER NOT NULL UNIQUE
+            )
+        """)
+        conn.executemany(
+            "INSERT INTO user (id, discord_id) VALUES (?, ?)",
+            ((i, 10**17 + i) for i in range(1, USERS + 1)))
+        conn.execute("""
+            CREATE TABLE activity_change (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                before_activity_type TEXT,
+                before_activity_name TEXT,
+                before_activity_status TEXT NOT NULL,
+                after_activity_type TEXT,
+                after_activity_name TEXT,
+                after_activity_status TEXT NOT NULL,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL
+            )
+        """)
+
+        # Each user's state carries over from their previous change
+        states = {}
+        start = datetime.now() - timedelta(days=60)
+        step = timedelta(days=60) / rows
+
+        def changes():
+            for i in range(rows):
+                user_id = rng.randrange(1, USERS + 1)
+                before = states.get(user_id, (None, None, "offline"))
+                if rng.random() < 0.3:
+                    after = (None, None, rng.choice(STATUSES))
+                else:
+                    after = (*rng.choice(activities), rng.choice(STATUSES))
+                states[user_id] = after
+                timestamp = (start + step * i).strftime("%Y-%m-%d %H:%M:%S")
+                yield (user_id, *before, *after, timestamp)
+
+        generator = changes()
+        for _ in range(0, rows, batch_size):
+            conn.executemany("""
+                INSERT INTO activity_change (
+                    user_id,
+                    before_activity_type,
+                    before_activity_name,
+                    before_activity_status,
+                    after_activity_type,
+                    after_activity_name,
+                    after_activity_status,
+                    timestamp
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (row for _, row in zip(range(batch_size), generator)))
+            conn.commit()
+
+
+def time_queries(query) -> float:
+    """Returns the mean time in milliseconds of running 'query' per user."""
+    rng = random.Random(1)
+    start = datetime.now() - timedelta(days=30)
+    elapsed = 0.0
+    for _ in range(QUERIES):
+        user_id = rng.randrange(1, USERS + 1)
+        begin = time.perf_counter()
+        query(user_id, start)
+        elapsed += time.perf_counter() - begin
+    return elapsed / QUERIES * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--rows", type=int, default=10_000_000,
+        help="number of activity changes to generate")
+    parser.add_argument(
+        "--path", default=None,
+        help="where to create the database; a temporary file by default")
+    args = parser.parse_args()
+
+    directory = None
+    path = args.path
+    if path is None:
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "activity.db")
+
+    try:
+        print(f"Generating {args.rows:,} activity changes...")
+        create_old_schema(path, args.rows)
+        with sqlite3.connect(path) as conn:
+            conn.execute("VACUUM")
+        old_size = os.path.getsize(path)
+
+        def old_query(user_id, start):
+            with sqlite3.connect(path) as conn:
+                conn.execute(OLD_STATS_QUERY, (user_id, start)).fetchall()
+        old_ms = time_queries(old_query)
+
+        print("Migrating...")
+        begin = time.perf_counter()
+        db = Database(path)
+        batches = 0
+        while db.migrate_activity_changes():
+            batches += 1
+        migrate_s = time.perf_counter() - begin
+        with sqlite3.connect(path) as conn:
+            conn.execute("VACUUM")
+        new_size = os.path.getsize(path)
+        new_ms = time_queries(
+            lambda user_id, start: db.get_activity_stats(10**17 + user_id, start))
+
+        print(f"\nMigrated in {migrate_s:.1f}s ({batches} batches)")
+        print(f"{'':10}{'size (MB)':>12}{'stats (ms)':>12}")
+        print(f"{'old':10}{old_size / 2**20:12.1f}{old_ms:12.2f}")
+        print(f"{'compact':10}{new_size / 2**20:12.1f}{new_ms:12.2f}")
+        print(f"\n{old_size / new_size:.1f}x smaller, "
+              f"{old_ms / new_ms:.1f}x faster stats")
+    finally:
+        if directory:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+"""
+Statistics over recorded member activity.
+
+Activity changes are kept in memory as NumPy arrays of epoch seconds, loaded
+from the database once and then topped up with only the rows added since.
+Every statistic is computed over whole arrays rather than row by row, so that
+a year of history on a large guild takes a fraction of a second. Each change
+starts an interval that lasts until the member's next change, or until the
+data was read for their latest one.
+
+NumPy is slow to import, so cogs import this module when it's first needed.
+"""
+
+import itertools
+import re
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+
+# Seconds in each unit a time window can be given in
+WINDOW_UNITS = {
+    "h": 3600,
+    "d": 86400,
+    "w": 7 * 86400,
+    "m": 30 * 86400,
+    "y": 365 * 86400,
+}
+
+# The Unix epoch was a Thursday, and weeks here start on Monday
+EPOCH_WEEKDAY = 3
+
+
+def parse_window(text: str) -> timedelta:
+    """
+    Parses a time window such as '12h', '30d', '6m' or '1y'.
+
+    Args:
+        text (str): A number followed by one of the units in 'WINDOW_UNITS'.
+
+    Returns:
+        timedelta: The length of the window.
+
+    Raises:
+        ValueError: If the window isn't understood.
+    """
+    match = re.fullmatch(r"\s*(\d+)\s*([a-z])\w*\s*", text.lower())
+    if not match or match[2] not in WINDOW_UNITS:
+        raise ValueError(
+            f"'{text}' isn't a time window; try something like 7d or 1y")
+    return timedelta(seconds=int(match[1]) * WINDOW_UNITS[match[2]])
+
+
+class Intervals:
+    """
+    Time spent by members in activities, as parallel arrays.
+
+    Attributes:
+        users (np.ndarray): The user ID of each interval, grouped by user.
+        activities (np.ndarray): The activity ID of each interval.
+        start (np.ndarray): When each interval started, in epoch seconds.
+        stop (np.ndarray): When each interval ended, in epoch seconds.
+        discord_ids (dict[int, int]): The Discord ID of each user ID.
+        names (dict[int, str]): The name of each activity ID.
+    """
+
+    def __init__(self, users, activities, start, stop, discord_ids, names):
+        self.users = users
+        self.activities = activities
+        self.start = start
+        self.stop = stop
+        self.discord_ids = discord_ids
+        self.names = names
+
+    def __len__(self) -> int:
+        return len(self.start)
+
+    @property
+    def seconds(self) -> np.ndarray:
+        return self.stop - self.start
+
+    def totals(self, top: int = None) -> list[tuple[str, timedelta]]:
+        """
+        Totals the time spent in each activity.
+
+        Args:
+            top (int): The most activities to return.
+
+        Returns:
+            list[tuple[str, timedelta]]: Activity names and the time spent in
+                each, most time first.
+        """
+        # Activity IDs are small, so they can index the totals directly
+        seconds = np.bincount(self.activities, weights=self.seconds)
+        order = np.argsort(seconds)[::-1][:top]
+        return [
+            (self.names.get(int(i), "Unknown"),
+             timedelta(seconds=int(seconds[i])))
+            for i in order if seconds[i] > 0]
+
+    def ranking(self, top: int = 10) -> list[tuple[int, timedelta]]:
+        """
+        Ranks members by the total time spent in activities.
+
+        Args:
+            top (int): The number of members to return.
+
+        Returns:
+            list[tuple[int, timedelta]]: Discord IDs and their total time,
+                most time first.
+        """
+        if not len(self):
+            return []
+        # Intervals are grouped by user, so sum each run of the same ID
+        firsts = np.flatnonzero(
+            np.concatenate(([True], self.users[1:] != self.users[:-1])))
+        seconds = np.add.reduceat(self.seconds, firsts)
+        order = np.argsort(seconds)[::-1][:top]
+        return [
+            (self.discord_ids[int(self.users[firsts[i]])],
+             timedelta(seconds=int(seconds[i])))
+            for i in order]
+
+    def heatmap(self, utc_offset: int = 0) -> np.ndarray:
+        """
+        Totals the time spent in activities by hour of the week.
+
+        Intervals are split exactly across the hours they span. Each one
+        adds its partial first and last hours directly, and the whole hours
+        between through a difference array, so long intervals cost no more
+        than short ones.
+
+        Args:
+            utc_offset (int): Seconds to add to UTC to get the local time the
+                hours are counted in.
+
+        Returns:
+            np.ndarray: A 7 by 24 array of seconds, by day of the week
+                starting on Monday, and hour of the day.
+        """
+        if not len(self):
+            return np.zeros((7, 24))
+        start = self.start + utc_offset
+        stop = self.stop + utc_offset
+        first = start // 3600
+        last = stop // 3600
+        base = first.min()
+        size = last.max() - base + 2
+
+        def add(index, weights=None):
+            return np.bincount(index - base, weights=weights, minlength=size)
+
+        # Time in the first hour of each interval, up to its end or the end
+        # of that hour, and in the last hour if it's a different one
+        within = first == last
+        hours = add(first, np.where(within, stop, (first + 1) * 3600) - start)
+        spans = ~within
+        hours += add(last[spans], stop[spans] - last[spans] * 3600)
+        # Every hour in between is whole
+        whole = add(first[spans] + 1) - add(last[spans])
+        hours += np.cumsum(whole) * 3600
+
+        absolute = np.arange(base, base + len(hours))
+        hour_of_week = ((absolute // 24 + EPOCH_WEEKDAY) % 7) * 24 \
+            + absolute % 24
+        return np.bincount(
+            hour_of_week, weights=hours, minlength=7 * 24).reshape(7, 24)
+
+
+class ActivityHistory:
+    """
+    Every recorded activity change, held in memory.
+
+    Changes are kept ordered by user and then time, so that the intervals
+    between them can be found without sorting on every query.
+
+    Examples:
+        >>> history = ActivityHistory()
+        >>> history.update(db)
+        >>> intervals = history.intervals(start, [member.id])
+        >>> intervals.totals(top=5)
+    """
+
+    def __init__(self):
+        self.ids = np.empty(0, dtype=np.int64)
+        self.users = np.empty(0, dtype=np.int64)
+        self.activities = np.empty(0, dtype=np.int64)
+        self.timestamps = np.empty(0, dtype=np.int64)
+        self.last_id = 0
+        self.discord_ids = {}   # Discord ID of each user ID
+        self.user_ids = {}      # User ID of each Discord ID
+        self.names = {}         # Name of each activity ID
+        self.as_of = None
+        self._lock = threading.Lock()
+
+    def update(self, db) -> datetime:
+        """
+        Loads activity changes recorded since the last update.
+
+        This blocks on the database, so run it in an executor.
+
+        Args:
+            db (database.Database): The database to load from.
+
+        Returns:
+            datetime: How current the history now is.
+        """
+        with self._lock:
+            result = db.get_activity_history({
+                "activity_event": self.last_id,
+                "user": max(self.discord_ids, default=0),
+                "activity": max(self.names, default=0),
+            })
+            value = result.value
+            # Forget changes that have been removed from the database
+            if value["first_id"] is not None:
+                kept = self.ids >= value["first_id"]
+                if not kept.all():
+                    self.ids = self.ids[kept]
+                    self.users = self.users[kept]
+                    self.activities = self.activities[kept]
+                    self.timestamps = self.timestamps[kept]
+            events = value["events"]
+            if events:
+                # Much faster than building the array from the tuples
+                data = np.fromiter(
+                    itertools.chain.from_iterable(events), dtype=np.int64,
+                    count=4 * len(events)).reshape(-1, 4)
+                ids = np.concatenate((self.ids, data[:, 0]))
+                users = np.concatenate((self.users, data[:, 1]))
+                activities = np.concatenate((self.activities, data[:, 2]))
+                timestamps = np.concatenate((self.timestamps, data[:, 3]))
+                # Sort on a single key combining user and time, which is much
+                # faster than sorting on both, and fast when mostly sorted
+                # already; timestamps fit in 32 bits
+                order = np.argsort((users << 32) | timestamps, kind="stable")
+                self.ids = ids[order]
+                self.users = users[order]
+                self.activities = activities[order]
+                self.timestamps = timestamps[order]
+                self.last_id = int(data[-1, 0])
+            self.discord_ids.update(value["users"])
+            self.user_ids.update(
+                (discord_id, user_id)
+                for user_id, discord_id in value["users"].items())
+            self.names.update(value["activities"])
+            self.as_of = result.as_of
+            return self.as_of
+
+    def intervals(
+        self,
+        start: datetime,
+        member_ids: list[int]) -> Intervals:
+        """
+        Gets the time some members spent in activities since a given time.
+
+        Args:
+            start (datetime): The earliest activity change to count.
+            member_ids (list[int]): The Discord IDs of the members.
+
+        Returns:
+            Intervals: The time spent in each activity.
+        """
+        with self._lock:
+            users = self.users
+            activities = self.activities
+            timestamps = self.timestamps
+            end = int(self.as_of.timestamp()) if self.as_of else 0
+            wanted = np.fromiter(
+                (self.user_ids[member_id] for member_id in member_ids
+                 if member_id in self.user_ids), dtype=np.int64)
+
+        mask = (timestamps > int(start.timestamp())) & np.isin(users, wanted)
+        users = users[mask]
+        activities = activities[mask]
+        start = timestamps[mask]
+
+        # Each change lasts until the same member's next change
+        stop = np.full_like(start, end)
+        same_user = users[1:] == users[:-1]
+        stop[:-1][same_user] = start[1:][same_user]
+        # Time without an activity isn't counted
+        doing = activities != 0
+        return Intervals(
+            users[doing], activities[doing], start[doing],
+            np.maximum(stop[doing], start[doing]),
+            self.discord_ids, self.names)
@@ -1,11 +1,10 @@
 #!/usr/bin/env python3
 
-import cairosvg
 import codecs
 import discord
 import inspect
+import logging
 import pathlib
-import PIL
 import tempfile
 
 # I need a list of all colors that the Discord library offers, and I can't seem
@@ -19,6 +18,8 @@ colors = ['ash_embed', 'ash_theme', 'blue', 'blurple', 'brand_green',
     'lighter_grey', 'magenta', 'og_blurple', 'onyx_embed', 'onyx_theme',
     'orange', 'pink', 'purple', 'red', 'teal', 'yellow']
 
+logger = logging.getLogger("icons")
+
 def generate_pngs(svg_path: pathlib.Path, png_path: pathlib.Path):
     """Generate icons for embed messages.
 
@@ -32,6 +33,10 @@ def generate_pngs(svg_path: pathlib.Path, png_path: pathlib.Path):
         svg_path (pathlib.Path): The path to the SVG files to be converted.
         png_path (pathlib.Path): The path to store the resultant PNG files.
     """
+    # Only needed to generate icons, and slow to import, so not imported with
+    # the rest of the module
+    import cairosvg
+    import PIL
     # Convert to each Discord color
     for color_name in colors:
         color_dir = png_path / color_name
@@ -60,7 +65,7 @@ def generate_pngs(svg_path: pathlib.Path, png_path: pathlib.Path):
 
             # Save to actual PNG file
             img.save(color_dir / f"{svg_file.stem}.png", format="PNG")
-            print("new file:", color_dir / f"{svg_file.stem}.png")
+            logger.info("New file: %s", color_dir / f"{svg_file.stem}.png")
 
 def get_icon_url(icon='', color=''):
     return f"https://raw.githubusercontent.com/jtkick/base-discord-bot/refs/"\
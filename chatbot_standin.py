@@ -0,0 +1,155 @@
+"""
+A stand-in for the OpenAI chat completions API, for trying out the chatbot.
+
+Streams a canned reply a word at a time, like the real API, and can be made
+slow or rate limited so that the chatbot's scheduler can be seen at work
+without spending anything. Point the bot at it with OPENAI_BASE_URL, and set
+OPENAI_API_KEY to anything.
+
+Examples:
+    $ python chatbot_standin.py --port 8089 --delay 0.05 --rate-limit 0.2
+    $ OPENAI_BASE_URL=http://127.0.0.1:8089/v1 OPENAI_API_KEY=x python __main__.py
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+# Reply streamed back for every prompt
+REPLY = (
+    "This is a stand-in reply, sent a word at a time so that the message "
+    "it ends up in gets edited while it's still being written.")
+
+
+class StandIn:
+    """
+    Serves chat completions over HTTP.
+
+    Args:
+        delay (float): Seconds between each word of a reply.
+        rate_limit (float): Fraction of requests answered with a 429.
+        retry_after (float): Seconds rate limited requests are asked to wait.
+        max_concurrent (int): Requests over this many at once get a 429.
+    """
+
+    def __init__(
+        self,
+        delay: float = 0.05,
+        rate_limit: float = 0.0,
+        retry_after: float = 2.0,
+        max_concurrent: int = None):
+        self.delay = delay
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.max_concurrent = max_concurrent
+        self.active = 0
+        self.peak = 0
+        self.served = 0
+        self.limited = 0
+
+    async def _respond(self, writer, status: str, headers: dict, body=b""):
+        head = f"HTTP/1.1 {status}\r\n" + "".join(
+            f"{name}: {value}\r\n" for name, value in headers.items())
+        writer.write(head.encode() + b"\r\n" + body)
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+            length = 0
+            for line in request.decode("latin-1").split("\r\n")[1:]:
+                name, _, value = line.partition(":")
+                if name.strip().lower() == "content-length":
+                    length = int(value)
+            body = json.loads(await reader.readexactly(length) or b"{}")
+        except (asyncio.IncompleteReadError, ValueError):
+            writer.close()
+            return
+
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        try:
+            too_many = self.max_concurrent and self.active > self.max_concurrent
+            if too_many or random.random() < self.rate_limit:
+                self.limited += 1
+                error = json.dumps({"error": {
+                    "message": "Rate limit reached", "type": "requests",
+                    "code": "rate_limit_exceeded"}}).encode()
+                await self._respond(writer, "429 Too Many Requests", {
+                    "Content-Type": "application/json",
+                    "Content-Length": len(error),
+                    "Retry-After": self.retry_after,
+                    "Connection": "close",
+                }, error)
+                return
+
+            self.served += 1
+            await self._respond(writer, "200 OK", {
+                "Content-Type": "text/event-stream",
+                "Connection": "close",
+            })
+            created = int(time.time())
+            for i, word in enumerate(REPLY.split(" ")):
+                await asyncio.sleep(self.delay)
+                chunk = {
+                    "id": f"chatcmpl-standin{self.served}",
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": body.get("model", "standin"),
+                    "choices": [{
+                        "index": 0,
+                        "delta": {"content": word if i == 0 else " " + word},
+                        "finish_reason": None,
+                    }],
+                }
+                writer.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                await writer.drain()
+            writer.write(b"data: [DONE]\n\n")
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.active -= 1
+            writer.close()
+
+
+async def serve(host: str, port: int, standin: StandIn):
+    server = await asyncio.start_server(standin.handle, host, port)
+    print(f"Serving chat completions on http://{host}:{port}/v1")
+    async with server:
+        while True:
+            await asyncio.sleep(10)
+            print(
+                f"served {standin.served}, rate limited {standin.limited}, "
+                f"peak concurrency {standin.peak}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument(
+        "--delay", type=float, default=0.05,
+        help="seconds between each word of a reply")
+    parser.add_argument(
+        "--rate-limit", type=float, default=0.0,
+        help="fraction of requests to answer with a 429")
+    parser.add_argument(
+        "--retry-after", type=float, default=2.0,
+        help="seconds rate limited requests are asked to wait")
+    parser.add_argument(
+        "--max-concurrent", type=int, default=None,
+        help="answer requests over this many at once with a 429")
+    args = parser.parse_args()
+    standin = StandIn(
+        args.delay, args.rate_limit, args.retry_after, args.max_concurrent)
+    try:
+        asyncio.run(serve(args.host, args.port, standin))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
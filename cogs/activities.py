@@ -1,3 +1,5 @@
+import asyncio
+import collections
 import datetime
 import discord
 from discord.ext import commands
@@ -5,14 +7,39 @@ import logging
 import os
 import pathlib
 import sqlite3
+import time
 import typing
 
+import logs
+import metrics
+
 class Activities(commands.Cog):
     """A cog to track and gather statistics on user activities."""
 
+    # Seconds to wait between fetching the members of each guild
+    CHUNK_INTERVAL = 1
+
+    # Seconds within which identical presence updates count as one. Discord
+    # sends one update per guild the user shares with the bot
+    DEDUP_WINDOW = 5
+
+    # Seconds to wait between migrating batches of old activity changes, so
+    # that new presence updates can still be written
+    MIGRATION_INTERVAL = 0.1
+
+    # Characters used to draw heatmaps, from least to most time
+    HEATMAP_SHADES = " ░▒▓█"
+
     def __init__(self, bot):
         self.bot = bot
         self.logger = logging.getLogger("activities")
+        self._chunk_task = None
+        self._migration_task = None
+        # Activity history loaded for stats, created when first needed
+        self._history = None
+        # Recently seen presence changes and when they were seen, oldest
+        # first
+        self._recent = collections.OrderedDict()
 
     async def __local_check(self, ctx):
         """A local check which applies to all commands in this cog."""
@@ -29,23 +56,226 @@ class Activities(commands.Cog):
             except discord.HTTPException:
                 pass
 
-        print('Ignoring exception in command {}:'.format(ctx.command), file=sys.stderr)
-        traceback.print_exception(type(error), error, error.__traceback__, file=sys.stderr)
+        self.logger.error(
+            "Ignoring exception in command %s", ctx.command, exc_info=error)
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # Unless every intent is on, guilds aren't chunked before the bot is
+        # ready, so fetch their members in the background instead. Presence
+        # updates for members that aren't cached yet are dropped until then
+        if self._chunk_task is None and self.bot.intents.members:
+            self._chunk_task = asyncio.create_task(self._chunk_guilds())
+        if self._migration_task is None:
+            self._migration_task = asyncio.create_task(
+                self._migrate_activity_changes())
+
+    async def _chunk_guilds(self):
+        for guild in list(self.bot.guilds):
+            if not guild.chunked:
+                await guild.chunk()
+                await asyncio.sleep(self.CHUNK_INTERVAL)
+        self.logger.info("Fetched members of %d guilds", len(self.bot.guilds))
+
+    async def _migrate_activity_changes(self):
+        # Move activity changes recorded in the old format into the compact
+        # tables, a batch at a time so the database stays usable meanwhile
+        loop = asyncio.get_running_loop()
+        while await loop.run_in_executor(
+                None, self.bot.db.migrate_activity_changes):
+            await asyncio.sleep(self.MIGRATION_INTERVAL)
+
+    @staticmethod
+    def _state(member: discord.Member) -> tuple[str, str, str]:
+        """Returns the parts of a member's presence that get recorded."""
+        activity = member.activity
+        return (
+            activity.type.name if activity else None,
+            activity.name if activity else None,
+            member.status.name
+        )
+
+    def _is_duplicate(self, key: tuple) -> bool:
+        """
+        Checks whether a presence change was already seen recently.
+
+        Args:
+            key (tuple): The user ID and their state before and after.
+
+        Returns:
+            bool: True if the same change was seen within the dedup window.
+        """
+        now = time.monotonic()
+        # Forget changes that are too old to match anymore
+        while self._recent:
+            oldest, seen = next(iter(self._recent.items()))
+            if now - seen < self.DEDUP_WINDOW:
+                break
+            del self._recent[oldest]
+        if key in self._recent:
+            return True
+        self._recent[key] = now
+        return False
 
     @commands.Cog.listener()
     async def on_presence_update(
         self,
         before: discord.Member,
         after: discord.Member):
+        metrics.PRESENCE_EVENTS.inc()
+        # Ignore updates that don't change anything we record, such as
+        # changes to rich presence details, and copies of the same update
+        # from other guilds
+        before_state = self._state(before)
+        after_state = self._state(after)
+        if before_state == after_state:
+            return
+        if self._is_duplicate((after.id, before_state, after_state)):
+            return
+
         # Log the activity or status change
+        logs.guild_id.set(after.guild.id)
         if after.activity:
             self.logger.info(
-                f"User '{before.name}' changed activity to "\
-                f"'{after.activity.name}'")
+                "User '%s' changed activity to '%s'",
+                before.name, after.activity.name)
         else:
             self.logger.info(
-                f"User '{before.name}' changed status to '{after.status}'")
+                "User '%s' changed status to '%s'", before.name, after.status)
         self.bot.db.insert_activity_change(before, after)
 
+    @staticmethod
+    def _format_duration(duration: datetime.timedelta) -> str:
+        """Formats a duration as days, hours and minutes, e.g. '2d 4h 10m'."""
+        minutes = int(duration.total_seconds()) // 60
+        days, minutes = divmod(minutes, 24 * 60)
+        hours, minutes = divmod(minutes, 60)
+        parts = [f"{days}d"] if days else []
+        if days or hours:
+            parts.append(f"{hours}h")
+        parts.append(f"{minutes}m")
+        return " ".join(parts)
+
+    def _draw_heatmap(self, heatmap) -> str:
+        """Draws a 7 by 24 heatmap of seconds as a block of text."""
+        top = heatmap.max()
+        levels = len(self.HEATMAP_SHADES) - 1
+        lines = ["    0     6     12    18    "]
+        for day, row in zip(("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"),
+                            heatmap):
+            shades = (row / top * levels).round().astype(int) if top else \
+                [0] * len(row)
+            lines.append(
+                f"{day} " + "".join(self.HEATMAP_SHADES[i] for i in shades))
+        return "```\n" + "\n".join(lines) + "\n```"
+
+    async def _load_intervals(self, window: str, member_ids: list[int]):
+        """
+        Loads the activity intervals of some members within a time window.
+
+        Returns:
+            tuple[analytics.Intervals, datetime.datetime]: The intervals, and
+                how current they are.
+
+        Raises:
+            commands.BadArgument: If the window isn't understood.
+        """
+        # NumPy is slow to import, so only import it once stats are wanted
+        import analytics
+
+        try:
+            start = datetime.datetime.now() - analytics.parse_window(window)
+        except ValueError as e:
+            raise commands.BadArgument(str(e))
+        if self._history is None:
+            self._history = analytics.ActivityHistory()
+
+        def load():
+            as_of = self._history.update(self.bot.db)
+            return self._history.intervals(start, member_ids), as_of
+        return await asyncio.get_running_loop().run_in_executor(None, load)
+
+    @commands.command(
+        name="stats",
+        description="Shows how much time a member spent in each activity."
+    )
+    async def stats_(
+        self,
+        ctx,
+        member: typing.Optional[discord.Member] = None,
+        window: str = "30d"):
+        """
+        Shows a member's most common activities and when they're active.
+
+        Args:
+            ctx (discord.ext.commands.Context): The Discord context associated
+                with the message.
+            member (discord.Member): The member to show stats for. Defaults to
+                the author.
+            window (str): How far back to look, e.g. '7d' or '1y'.
+        """
+        member = member or ctx.author
+        async with ctx.typing():
+            intervals, as_of = await self._load_intervals(window, [member.id])
+            utc_offset = datetime.datetime.now().astimezone().utcoffset()
+            heatmap = intervals.heatmap(int(utc_offset.total_seconds()))
+
+        embed = discord.Embed(
+            title=f"Activity of {member.display_name} over {window}",
+            description=f"As of {discord.utils.format_dt(as_of, 'R')}",
+            color=discord.Color.green())
+        totals = intervals.totals(top=10)
+        embed.add_field(
+            name="Top activities",
+            value="\n".join(
+                f"**{name}**: {self._format_duration(duration)}"
+                for name, duration in totals) or "Nothing recorded",
+            inline=False)
+        if totals:
+            embed.add_field(
+                name="When (hour of the day)",
+                value=self._draw_heatmap(heatmap),
+                inline=False)
+        await ctx.send(embed=embed)
+
+    @commands.guild_only()
+    @commands.command(
+        name="leaderboard",
+        aliases=["lb"],
+        description="Ranks the server's members by time spent in activities."
+    )
+    async def leaderboard_(self, ctx, window: str = "30d"):
+        """
+        Shows the members who spent the most time in activities.
+
+        Args:
+            ctx (discord.ext.commands.Context): The Discord context associated
+                with the message.
+            window (str): How far back to look, e.g. '7d' or '1y'.
+        """
+        async with ctx.typing():
+            intervals, as_of = await self._load_intervals(
+                window, [member.id for member in ctx.guild.members])
+
+        embed = discord.Embed(
+            title=f"Leaderboard over {window}",
+            description=f"As of {discord.utils.format_dt(as_of, 'R')}",
+            color=discord.Color.green())
+        embed.add_field(
+            name="Most active members",
+            value="\n".join(
+                f"{place}. <@{user_id}>: {self._format_duration(duration)}"
+                for place, (user_id, duration) in enumerate(
+                    intervals.ranking(top=10), start=1)) or "Nothing recorded",
+            inline=False)
+        embed.add_field(
+            name="Top activities",
+            value="\n".join(
+                f"**{name}**: {self._format_duration(duration)}"
+                for name, duration in intervals.totals(top=5))
+                or "Nothing recorded",
+            inline=False)
+        await ctx.send(embed=embed)
+
 async def setup(bot):
     await bot.add_cog(Activities(bot))
\ No newline at end of file
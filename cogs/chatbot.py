@@ -1,23 +1,126 @@
+import asyncio
+from async_timeout import timeout
+import collections
+import contextlib
 import discord
 from discord.ext import commands
-from openai import OpenAI
+import logging
 import os
+import re
+import time
+import typing
+import unicodedata
+
+import metrics
+import scheduler
+
+# The OpenAI client is slow to import, so it's only imported when needed
+if typing.TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+logger = logging.getLogger("chatbot")
+
+# Model used to write replies
+MODEL = "gpt-4o-mini"
+
+# Seconds a reply may take in total before it's cut off
+CHAT_TIMEOUT = float(os.getenv("CHATBOT_TIMEOUT", "30"))
+
+# Seconds between edits of a reply while it's being written. Discord allows
+# about five edits per five seconds in a channel
+EDIT_INTERVAL = 1.0
+
+# Longest message Discord allows
+MESSAGE_LIMIT = 2000
+
+# Times to retry a completion the API says is rate limited
+RATE_LIMIT_RETRIES = 3
+
+# Seconds to wait when a rate limited response doesn't say how long
+DEFAULT_RETRY_AFTER = 5.0
+
+# Number of replies to remember for repeated prompts, and for how many
+# seconds; a size of 0 turns the cache off
+CACHE_SIZE = int(os.getenv("CHATBOT_CACHE_SIZE", "256"))
+CACHE_TTL = float(os.getenv("CHATBOT_CACHE_TTL", "3600"))
+
+# Prompts matching this pattern are never answered from the cache, for
+# questions whose answer changes, such as about the time or the news
+CACHE_EXCLUDE = os.getenv("CHATBOT_CACHE_EXCLUDE", "")
+
+# Word a prompt starts with to skip the cache
+FRESH_FLAG = "--fresh"
+
+
+def normalize_prompt(text: str) -> str:
+    """
+    Reduces a prompt to the words in it, so that prompts which only differ in
+    case, punctuation, spacing or lookalike characters get the same reply.
+
+    Examples:
+        >>> normalize_prompt("  Hello,   WORLD!! ")
+        'hello world'
+    """
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return " ".join(re.findall(r"\w+", text))
+
+
+class ResponseCache:
+    """
+    Remembers recent replies, dropping the least recently used when full and
+    any that are older than the time to live.
+
+    Args:
+        size (int): Most replies to remember.
+        ttl (float): Seconds a reply is remembered for.
+    """
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # Replies and when they expire, least recently used first
+        self._entries = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and entry[1] > time.monotonic()
+
+    def get(self, key) -> typing.Optional[str]:
+        """Returns the remembered reply, or None, counting hits and misses."""
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        if entry is not None:
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, reply: str):
+        if self.size <= 0:
+            return
+        self._entries[key] = (reply, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
 
 class Chatbot(commands.Cog):
     """Chat related commands."""
 
-    __slots__ = ('bot', 'players')
+    __slots__ = ('bot', 'scheduler', 'cache', '_openai_client')
 
     def __init__(self, bot, **kwargs):
         self.bot = bot
-        self.openai_client = OpenAI()
-        self.players = {}
-
-    async def cleanup(self, guild):
-        try:
-            del self.players[guild.id]
-        except KeyError:
-            pass
+        self.scheduler = scheduler.CompletionScheduler.from_env()
+        self.cache = ResponseCache(CACHE_SIZE, CACHE_TTL)
+        self._openai_client = None
 
     async def __local_check(self, ctx):
         """A local check which applies to all commands in this cog."""
@@ -33,44 +136,195 @@ class Chatbot(commands.Cog):
             except discord.HTTPException:
                 pass
 
-        print('Ignoring exception in command {}:'.format(ctx.command), file=sys.stderr)
-        traceback.print_exception(type(error), error, error.__traceback__, file=sys.stderr)
+        logger.error(
+            "Ignoring exception in command %s", ctx.command, exc_info=error)
 
-    def get_player(self, ctx):
-        """Retrieve the guild player, or generate one."""
-        try:
-            player = self.players[ctx.guild.id]
-        except KeyError:
-            player = MusicPlayer(ctx)
-            self.players[ctx.guild.id] = player
+    @property
+    def openai_client(self) -> "AsyncOpenAI":
+        """The OpenAI client, created on first use."""
+        if self._openai_client is None:
+            from openai import AsyncOpenAI
+            # Rate limits are retried through the scheduler instead, so that
+            # every completion waits, not just the one that was refused
+            self._openai_client = AsyncOpenAI(
+                timeout=CHAT_TIMEOUT, max_retries=0)
+        return self._openai_client
+
+    def _cache_key(self, user_prompt: str) -> typing.Optional[tuple]:
+        """Gets the key a prompt's reply is cached under, or None if it isn't."""
+        if self.cache.size <= 0:
+            return None
+        if CACHE_EXCLUDE and re.search(CACHE_EXCLUDE, user_prompt, re.I):
+            return None
+        return (MODEL, os.getenv('CHATBOT_PROMPT', ''),
+                normalize_prompt(user_prompt))
+
+    def is_cached(self, user_prompt: str) -> bool:
+        """Returns whether a prompt can be answered from the cache."""
+        key = self._cache_key(user_prompt)
+        return key is not None and key in self.cache
+
+    async def prompt(
+        self,
+        user_prompt: str,
+        cache: bool = True) -> typing.AsyncIterator[str]:
+        """
+        Asks the chatbot for a reply.
 
-        return player
+        Replies to prompts asked recently are reused rather than asked for
+        again. Only replies that were received in full are reused.
 
-    def prompt(self, user_prompt: str):
+        Args:
+            user_prompt (str): What the user said.
+            cache (bool): Whether a remembered reply may be used, and the
+                new one remembered.
 
+        Yields:
+            str: The reply, a few words at a time as it's written.
+        """
         setup_prompt = os.getenv('CHATBOT_PROMPT', '')
         if setup_prompt == '':
-            return '😴'
+            yield '😴'
+            return
+        key = self._cache_key(user_prompt) if cache else None
+        if key is not None:
+            reply = self.cache.get(key)
+            if reply is not None:
+                yield reply
+                return
+        from openai import RateLimitError
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            try:
+                with metrics.OPENAI_SECONDS.time(call="chat"):
+                    stream = await self.openai_client.chat.completions.create(
+                        model=MODEL,
+                        messages=[
+                            {"role": "system", "content": setup_prompt},
+                            {
+                                "role": "user",
+                                "content": user_prompt
+                            }
+                        ],
+                        stream=True
+                    )
+                break
+            except RateLimitError as e:
+                if attempt == RATE_LIMIT_RETRIES:
+                    raise
+                self.scheduler.backoff(self._retry_after(e))
+                await self.scheduler.resumed()
+        pieces = []
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                pieces.append(chunk.choices[0].delta.content)
+                yield pieces[-1]
+        if key is not None:
+            self.cache.put(key, "".join(pieces))
+
+    @staticmethod
+    def _retry_after(error) -> float:
+        """Gets the seconds a rate limited response asked to wait."""
         try:
-            completion =\
-                self.openai_client.chat.completions.create(
-                    model="gpt-4o-mini",
-                    messages=[
-                        {"role": "system", "content": setup_prompt},
-                        {
-                            "role": "user",
-                            "content": user_prompt
-                        }
-                    ]
-                )
-            return completion.choices[0].message.content
-        except Exception as e:
-            print(e)
-            return '😴'
+            return float(error.response.headers["retry-after"])
+        except (AttributeError, KeyError, ValueError):
+            return DEFAULT_RETRY_AFTER
+
+    async def _show(
+        self,
+        ctx,
+        messages: list[discord.Message],
+        shown: list[str],
+        reply: str):
+        """
+        Brings the messages showing a reply up to date.
+
+        Replies too long for one message carry on in new ones. Only messages
+        whose text changed are edited.
+        """
+        pages = [
+            reply[i:i + MESSAGE_LIMIT]
+            for i in range(0, len(reply), MESSAGE_LIMIT)]
+        for i, page in enumerate(pages):
+            if i == len(messages):
+                messages.append(await ctx.send(page))
+                shown.append(page)
+            elif shown[i] != page:
+                await messages[i].edit(content=page)
+                shown[i] = page
 
     @commands.command(name='chat', aliases=[], description="Command for chatting with chatbot.")
     async def chat_(self, ctx, *text):
-        await ctx.send(self.prompt(' '.join(text)))
+        # The reply is shown as soon as it starts, and then edited as more
+        # of it comes in, at most once per edit interval
+        messages = []
+        shown = []
+        reply = ""
+        last_edit = 0.0
+
+        async def on_position(position):
+            # While waiting, the first message says where in line it is
+            await self._show(
+                ctx, messages, shown, f"⏳ You're #{position} in line...")
+
+        fresh = bool(text) and text[0].lower() == FRESH_FLAG
+        if fresh:
+            text = text[1:]
+        user_prompt = ' '.join(text)
+        # Remembered replies cost nothing, so they don't wait their turn
+        if not fresh and self.is_cached(user_prompt):
+            turn = contextlib.nullcontext()
+        else:
+            turn = self.scheduler.turn(
+                ctx.guild.id if ctx.guild else None, ctx.author.id,
+                on_position)
+        try:
+            async with turn:
+                async with ctx.typing(), timeout(CHAT_TIMEOUT):
+                    async for piece in self.prompt(
+                            user_prompt, cache=not fresh):
+                        reply += piece
+                        if time.monotonic() - last_edit >= EDIT_INTERVAL:
+                            await self._show(ctx, messages, shown, reply)
+                            last_edit = time.monotonic()
+        except (scheduler.Throttled, scheduler.QueueFull) as e:
+            reply = str(e)
+        except asyncio.TimeoutError:
+            logger.warning("Reply timed out after %.0fs", CHAT_TIMEOUT)
+            reply += " …"
+        except Exception:
+            logger.exception("Couldn't get a reply")
+        await self._show(ctx, messages, shown, reply.strip() or '😴')
+
+    @commands.command(
+        name="chatstatus",
+        description="Shows how busy the chatbot is."
+    )
+    async def chatstatus_(self, ctx):
+        """
+        Shows the chatbot's scheduler and cache counters.
+
+        Args:
+            ctx (discord.ext.commands.Context): The Discord context associated
+                with the message.
+        """
+        cache = self.cache
+        lookups = cache.hits + cache.misses
+        embed = discord.Embed(title="Chatbot", color=discord.Color.green())
+        embed.add_field(
+            name="Running",
+            value=f"{self.scheduler.active}/{self.scheduler.max_concurrent}")
+        embed.add_field(name="Waiting", value=str(self.scheduler.waiting))
+        embed.add_field(
+            name="Paused", value="yes" if self.scheduler.paused else "no")
+        embed.add_field(
+            name="Cache",
+            value=(
+                f"{len(cache)}/{cache.size} replies, "
+                f"{cache.hits} hits, {cache.misses} misses"
+                + (f" ({cache.hits / lookups:.0%} hit rate)" if lookups else "")
+            )
+        )
+        await ctx.send(embed=embed)
 
 async def setup(bot):
     await bot.add_cog(Chatbot(bot))
@@ -0,0 +1,152 @@
+"""
+Background upkeep of the bot's database.
+
+History tables grow with every presence update, request and play. The
+retention job periodically rolls rows older than each table's policy up into
+daily totals, deletes or archives them in small batches, and hands the freed
+space back to the OS.
+
+Policies are read from the environment, one per table:
+
+    RETENTION_ACTIVITY_EVENT   Policy for presence changes.
+    RETENTION_SONG_REQUEST     Policy for song requests.
+    RETENTION_SONG_PLAY        Policy for songs played.
+
+A policy is a number of days to keep rows for, e.g. '90', optionally prefixed
+with 'archive:' to copy rows into the database at RETENTION_ARCHIVE_PATH
+before removing them, e.g. 'archive:90'. Tables without a policy are kept
+forever. The job runs every RETENTION_INTERVAL_HOURS hours (24 by default).
+
+The enrichment job fills in the title and artist of songs played from URLs;
+see the 'enrichment' module. It runs every ENRICHMENT_INTERVAL_MINUTES
+minutes (10 by default), or never if that's 0.
+"""
+
+import asyncio
+from datetime import datetime, timedelta
+import logging
+import os
+
+from discord.ext import commands, tasks
+
+import database
+import enrichment
+
+
+class Maintenance(commands.Cog):
+    """Keeps the database from growing without bound."""
+
+    # Rows removed per transaction, and seconds to wait between batches so
+    # the rest of the bot can get the write lock
+    BATCH_SIZE = 1000
+    BATCH_INTERVAL = 0.1
+
+    # Pages returned to the OS per incremental vacuum step, and the most
+    # steps per run
+    VACUUM_PAGES = 1000
+    VACUUM_ROUNDS = 100
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.logger = logging.getLogger("maintenance")
+        self.policies = self._policies()
+        self.archive = os.getenv("RETENTION_ARCHIVE_PATH", "archive.db")
+        self.retention.change_interval(
+            hours=float(os.getenv("RETENTION_INTERVAL_HOURS", "24")))
+        self.enricher = enrichment.Enricher.from_env(bot.db)
+        self.enrichment_interval = float(
+            os.getenv("ENRICHMENT_INTERVAL_MINUTES", "10"))
+        if self.enrichment_interval:
+            self.enrichment.change_interval(minutes=self.enrichment_interval)
+
+    def _policies(self) -> dict[str, tuple[int, bool]]:
+        """
+        Reads the retention policy of each table from the environment.
+
+        Returns:
+            dict[str, tuple[int, bool]]: The number of days to keep and
+                whether to archive removed rows, by table.
+
+        Raises:
+            ValueError: If a policy isn't a number of days.
+        """
+        policies = {}
+        for table in database.RETENTION_TABLES:
+            policy = os.getenv(f"RETENTION_{table.upper()}", "").strip()
+            if not policy:
+                continue
+            archive = policy.startswith("archive:")
+            days = int(policy.removeprefix("archive:"))
+            policies[table] = (days, archive)
+        return policies
+
+    async def cog_load(self):
+        if self.policies:
+            self.retention.start()
+        if self.enrichment_interval:
+            self.enrichment.start()
+
+    async def cog_unload(self):
+        self.retention.cancel()
+        self.enrichment.cancel()
+
+    @tasks.loop(hours=24)
+    async def retention(self):
+        loop = asyncio.get_running_loop()
+        db = self.bot.db
+        size = await loop.run_in_executor(None, db.size)
+
+        for table, (days, archive) in self.policies.items():
+            before = datetime.now() - timedelta(days=days)
+            removed = 0
+            while count := await loop.run_in_executor(
+                    None, db.trim_table, table, before, self.BATCH_SIZE,
+                    self.archive if archive else None):
+                removed += count
+                await asyncio.sleep(self.BATCH_INTERVAL)
+            self.logger.info(
+                "%s %d rows older than %d days from '%s'",
+                "Archived" if archive else "Deleted", removed, days, table)
+
+        # Stop once a step frees nothing, as happens if the database was
+        # never converted to incremental vacuuming, and stop after a while
+        # anyway, since the rest of the bot keeps freeing pages as it goes
+        free = None
+        for _ in range(self.VACUUM_ROUNDS):
+            left = await loop.run_in_executor(
+                None, db.incremental_vacuum, self.VACUUM_PAGES)
+            if not left or (free is not None and left >= free):
+                break
+            free = left
+            await asyncio.sleep(self.BATCH_INTERVAL)
+
+        after = await loop.run_in_executor(None, db.size)
+        self.logger.info(
+            "Database size went from %.1f MB to %.1f MB",
+            size["bytes"] / 2**20, after["bytes"] / 2**20)
+
+    @retention.before_loop
+    async def before_retention(self):
+        await self.bot.wait_until_ready()
+
+    @retention.error
+    async def retention_error(self, error):
+        self.logger.error("Retention job failed", exc_info=error)
+
+    @tasks.loop(minutes=10)
+    async def enrichment(self):
+        # Keep going while there's a backlog; lookups are rate limited
+        while await self.enricher.run() >= self.enricher.batch_size:
+            pass
+
+    @enrichment.before_loop
+    async def before_enrichment(self):
+        await self.bot.wait_until_ready()
+
+    @enrichment.error
+    async def enrichment_error(self, error):
+        self.logger.error("Enrichment job failed", exc_info=error)
+
+
+async def setup(bot):
+    await bot.add_cog(Maintenance(bot))
@@ -1,5 +1,4 @@
 import ast
-import atexit
 import datetime
 import discord
 from discord.ext import commands
@@ -8,21 +7,24 @@ import enum
 import random
 import asyncio
 import itertools
-import sys
-import traceback
-import requests
+import typing
+import weakref
 import os
-import validators
 import threading
-import pickle
+import time
 from async_timeout import timeout
 from functools import partial
-import yt_dlp
-from yt_dlp import YoutubeDL
 import logging
 
-import database
 import assets
+import governor
+import logs
+import metrics
+import tracing
+
+# These are slow to import, so they're only imported once they're needed
+if typing.TYPE_CHECKING:
+    from yt_dlp import YoutubeDL
 
 logger = logging.getLogger("music_player")
 
@@ -32,6 +34,51 @@ LASTFM_API_KEY = os.getenv("LASTFM_API_KEY")
 # Suppress noise about console usage from errors
 # yt_dlp.utils.bug_reports_message = lambda: ""
 
+# Options for the YouTube downloader
+YTDL_OPTIONS = {
+    "format": "bestaudio[ext=m4a]/bestaudio",   # Use OPUS for FFmpeg
+    "outtmpl": "downloads/%(extractor)s-%(id)s-%(title)s.%(ext)s",
+    "restrictfilenames": True,
+    "noplaylist": True,
+    "nocheckcertificate": True,
+    "ignoreerrors": False,
+    "logtostderr": False,
+    "quiet": True,
+    "no_warnings": True,
+    "default_search": "auto",
+    "source_address": "0.0.0.0",  # ipv6 addresses cause issues sometimes
+    "retries": 5,
+    "ignoreerrors": True,
+    'throttled_rate': '1M',
+    "fragment_retries": 10,  # Prevents seemingly random stream crashes
+}
+
+# Options used for every FFmpeg process that decodes a song
+FFMPEG_BEFORE_OPTIONS = "-nostdin -reconnect 1 -reconnect_streamed 1 "\
+                        "-reconnect_delay_max 5"
+FFMPEG_OPTIONS = "-vn -f s16le -ar 48000 -ac 2"
+
+# How long a read from FFmpeg may block before the stream counts as stalled.
+# This is longer than FFmpeg's own '-reconnect_delay_max'
+STALL_TIMEOUT = 10
+
+# How close to the end of a song a stream may stop and still count as done
+EOF_TOLERANCE = 5
+
+# Longest time and most attempts spent resuming a dropped stream
+RECOVERY_TIMEOUT = 20
+RECOVERY_ATTEMPTS = 3
+
+# Most times a single song may be resumed before giving up on it
+MAX_RECOVERIES = 5
+
+# How often a playing song's position is saved to the player's snapshot
+SNAPSHOT_INTERVAL = 15
+
+# Seconds to spend finding autocomplete suggestions. Discord gives up on them
+# after three seconds
+AUTOCOMPLETE_TIMEOUT = 2
+
 
 class VoiceConnectionError(commands.CommandError):
     """Custom Exception class for connection errors."""
@@ -41,38 +88,88 @@ class InvalidVoiceChannel(VoiceConnectionError):
     """Exception for cases of invalid Voice Channels."""
 
 
+class StreamWatchdog:
+    """
+    Watches open sources for FFmpeg streams that have stalled.
+
+    A read from FFmpeg blocks until it has audio, so if the upstream stream
+    hangs, the song hangs with it. A single thread checks every open source
+    and kills FFmpeg when a read has been blocked for too long, which ends
+    the read and lets the source resume the song.
+    """
+
+    _sources = weakref.WeakSet()
+    _lock = threading.Lock()
+    _thread = None
+
+    @classmethod
+    def watch(cls, source: "YTDLSource"):
+        with cls._lock:
+            cls._sources.add(source)
+            if cls._thread is None:
+                cls._thread = threading.Thread(
+                    target=cls._run, name="stream-watchdog", daemon=True)
+                cls._thread.start()
+
+    @classmethod
+    def _run(cls):
+        while True:
+            time.sleep(1)
+            now = time.monotonic()
+            with cls._lock:
+                sources = list(cls._sources)
+            for source in sources:
+                started = source._reading_since
+                if started and now - started > STALL_TIMEOUT:
+                    logger.warning(
+                        "Stream for %s stalled at %.1fs", source,
+                        source.position)
+                    source._reading_since = None
+                    source.kill()
+
+
 class YTDLSource(discord.PCMVolumeTransformer):
 
     # Whether or not to download the video before playing
     download = False
 
-    _downloader = YoutubeDL({
-        "format": "bestaudio[ext=m4a]/bestaudio",   # Use OPUS for FFmpeg
-        "outtmpl": "downloads/%(extractor)s-%(id)s-%(title)s.%(ext)s",
-        "restrictfilenames": True,
-        "noplaylist": True,
-        "nocheckcertificate": True,
-        "ignoreerrors": False,
-        "logtostderr": False,
-        "quiet": True,
-        "no_warnings": True,
-        "default_search": "auto",
-        "source_address": "0.0.0.0",  # ipv6 addresses cause issues sometimes
-        "retries": 5,
-        "ignoreerrors": True,
-        'throttled_rate': '1M',
-        "fragment_retries": 10,  # Prevents seemingly random stream crashes
-    })
-
-    def __init__(self, source, **kwargs):
-        super().__init__(source)
+    _downloader = None
+    _downloader_lock = threading.Lock()
+
+    @classmethod
+    def downloader(cls) -> "YoutubeDL":
+        """Returns the shared YouTube downloader, creating it on first use."""
+        with cls._downloader_lock:
+            if cls._downloader is None:
+                from yt_dlp import YoutubeDL
+                cls._downloader = YoutubeDL(YTDL_OPTIONS)
+            return cls._downloader
+
+    def __init__(self, source=None, **kwargs):
+        # The FFmpeg process is only spawned once the song is about to play,
+        # either here or in a voice worker process; see 'open()'
+        if source is not None:
+            super().__init__(source)
+        else:
+            self.original = None
+            self.volume = 1.0
 
         # YouTube Metadata
         self.title = kwargs.get("title")
         self.url = kwargs.get("url")
+        self.stream = kwargs.get("stream")
         self.web_url = kwargs.get("web_url")
         self.thumbnail_url = kwargs.get("thumbnail_url")
         self.filename = kwargs.get("filename")
+        self.duration = kwargs.get("duration")
+
+        # Playback position, used to resume the stream if it drops
+        self.start_at = kwargs.get("start_at", 0)
+        self.frames = 0
+        self.recoveries = 0
+        self.failed = False
+        self._reading_since = None
+        self._closed = False
 
         # Song metadata
         self.search_term = kwargs.get("search_term")
@@ -82,17 +179,240 @@ class YTDLSource(discord.PCMVolumeTransformer):
         # Discord info
         self.requester = kwargs.get("requester")
 
+        # The request's trace, when it was queued, and the spans to end once
+        # the first frame of audio is read
+        self.trace = None
+        self.queued_at = None
+        self.first_frame = None
+
     def __str__(self):
         if self.song_title and self.artist:
             return f"'{self.song_title}' by {self.artist}"
         else:
             return f"{self.title}"
 
+    def open(self):
+        """
+        Spawns the FFmpeg process that decodes this source's stream.
+
+        Sources are created when a song is queued, but FFmpeg is only needed
+        once it actually plays, so the process is started lazily here.
+
+        Returns:
+            YTDLSource: This source, ready to be read from.
+        """
+        if self.stream is None:
+            self.stream = self._resolve_stream()
+        if self.original is None:
+            # Seeking before the input is fast, since FFmpeg skips straight
+            # to the offset instead of decoding up to it
+            before_options = FFMPEG_BEFORE_OPTIONS
+            if self.start_at:
+                before_options = f"-ss {self.start_at:.2f} {before_options}"
+            self.original = discord.FFmpegPCMAudio(
+                self.stream,
+                before_options=before_options,
+                options=FFMPEG_OPTIONS)
+            StreamWatchdog.watch(self)
+        return self
+
+    @property
+    def position(self) -> float:
+        """How far into the song playback is, in seconds."""
+        frame_length = discord.opus.Encoder.FRAME_LENGTH / 1000
+        return self.start_at + self.frames * frame_length
+
+    def read(self) -> bytes:
+        while True:
+            self._reading_since = time.monotonic()
+            data = super().read()
+            self._reading_since = None
+            if data:
+                self.frames += 1
+                if self.first_frame:
+                    for span in self.first_frame:
+                        span.end()
+                    self.first_frame = None
+                return data
+            if not self._recover():
+                return b""
+
+    def _recover(self) -> bool:
+        """
+        Resumes the song if its stream ended before the song did.
+
+        FFmpeg ending early means the stream dropped or was killed for
+        stalling. The stream URL may have expired by then, so it's resolved
+        again, and FFmpeg is restarted at the current position.
+
+        Returns:
+            bool: Whether the stream was resumed.
+        """
+        if self._closed or not self.duration:
+            return False
+        position = self.position
+        if position >= self.duration - EOF_TOLERANCE:
+            return False
+        if self.recoveries >= MAX_RECOVERIES:
+            logger.error("Giving up on %s at %.1fs", self, position)
+            self.failed = True
+            return False
+        self.recoveries += 1
+
+        logger.warning(
+            "Stream for %s ended at %.1fs of %ds; resuming",
+            self, position, self.duration)
+        deadline = time.monotonic() + RECOVERY_TIMEOUT
+        if self.original is not None:
+            self.original.cleanup()
+            self.original = None
+        for attempt in range(RECOVERY_ATTEMPTS):
+            if self._closed or time.monotonic() > deadline:
+                break
+            try:
+                if not self.download:
+                    self.stream = self._resolve_stream_until(deadline)
+                self.start_at = position
+                self.frames = 0
+                self.open()
+                return True
+            except Exception:
+                logger.exception("Couldn't resume %s", self)
+                backoff = min(2 ** attempt, deadline - time.monotonic())
+                time.sleep(max(backoff, 0))
+
+        self.failed = True
+        return False
+
+    def _resolve_stream(self) -> str:
+        """Gets a fresh stream URL, or file, for this source's video."""
+        data = self.downloader().extract_info(
+            self.web_url, download=self.download)
+        if data and "entries" in data:
+            data = data["entries"][0]
+        if self.download:
+            return self.downloader().prepare_filename(data)
+        return data["url"]
+
+    def _resolve_stream_until(self, deadline: float) -> str:
+        """
+        Gets a fresh stream URL, giving up at a deadline.
+
+        yt-dlp has no overall timeout, so the lookup runs in its own thread,
+        which is left to finish on its own if it hangs.
+
+        Raises:
+            TimeoutError: If the lookup isn't done by the deadline.
+        """
+        result = {}
+
+        def resolve():
+            try:
+                result["stream"] = self._resolve_stream()
+            except Exception as e:
+                result["error"] = e
+
+        thread = threading.Thread(
+            target=resolve, name="resolve-stream", daemon=True)
+        thread.start()
+        thread.join(max(deadline - time.monotonic(), 0))
+        if thread.is_alive():
+            raise TimeoutError(f"Looking up {self} took too long")
+        if "error" in result:
+            raise result["error"]
+        return result["stream"]
+
+    async def resolve(self):
+        """
+        Gets the stream for this source's video if it doesn't have one yet.
+
+        Sources restored from a snapshot only know which video to play, since
+        stream URLs expire, so the stream is looked up right before playing.
+        """
+        if self.stream is None:
+            self.stream = await asyncio.get_event_loop().run_in_executor(
+                None, self._resolve_stream)
+
+    def kill(self):
+        """Kills the FFmpeg process, ending any blocked read."""
+        process = getattr(self.original, "_process", None)
+        if process:
+            process.kill()
+
+    def cleanup(self):
+        self._closed = True
+        if self.original is not None:
+            self.original.cleanup()
+
+    @property
+    def pid(self) -> int:
+        """The process ID of this source's FFmpeg process, if it's open."""
+        process = getattr(self.original, "_process", None)
+        return process.pid if process else None
+
+    def to_spec(self) -> dict:
+        """
+        Returns the picklable keyword arguments needed to rebuild this source.
+
+        This is used to hand a song to a voice worker process, which builds
+        its own copy of the source and opens FFmpeg there.
+        """
+        return {
+            "title": self.title,
+            "url": self.url,
+            "stream": self.stream,
+            "web_url": self.web_url,
+            "thumbnail_url": self.thumbnail_url,
+            "filename": self.filename,
+            "duration": self.duration,
+            "start_at": self.start_at,
+            "search_term": self.search_term,
+            "artist": self.artist,
+            "song_title": self.song_title,
+        }
+
+    def snapshot(self) -> dict:
+        """
+        Returns the metadata needed to play this source again later.
+
+        Unlike 'to_spec()', this leaves out the stream URL, which expires, and
+        is safe to store as JSON.
+        """
+        snapshot = self.to_spec()
+        del snapshot["stream"]
+        del snapshot["url"]
+        snapshot["requester_id"] = \
+            self.requester.id if self.requester else None
+        return snapshot
+
+    @classmethod
+    def from_snapshot(cls, snapshot: dict, guild: discord.Guild):
+        """
+        Rebuilds a source saved with 'snapshot()'.
+
+        Args:
+            snapshot (dict): The saved metadata.
+            guild (discord.Guild): The guild the source is played in, used
+                to look up who requested it.
+
+        Returns:
+            YTDLSource: The source, whose stream is resolved when it plays.
+        """
+        snapshot = dict(snapshot)
+        requester_id = snapshot.pop("requester_id", None)
+        source = cls(**snapshot)
+        if requester_id:
+            source.requester = \
+                guild.get_member(requester_id) or discord.Object(requester_id)
+        return source
+
     @classmethod
+    @metrics.YTDL_SECONDS.time(call="create")
+    @tracing.traced("create")
     async def create(cls, search: str = ""):
         # Get YouTube video source
         logger.info(f"Getting YouTube video: {search}")
-        to_run = partial(cls._downloader.extract_info,
+        to_run = partial(cls.downloader().extract_info,
                          url=search, download=cls.download)
         data = await asyncio.get_event_loop().run_in_executor(None, to_run)
 
@@ -104,24 +424,19 @@ class YTDLSource(discord.PCMVolumeTransformer):
 
         # Get either source filename or URL, depending on if we're downloading
         if cls.download:
-            source = cls._downloader.prepare_filename(data)
+            source = cls.downloader().prepare_filename(data)
         else:
             source = data["url"]
         logger.info(f"Using source: {data["webpage_url"]}")
 
-        # Setup actual audio source
-        ffmpeg_source = discord.FFmpegPCMAudio(
-            source,
-            before_options="-nostdin -reconnect 1 -reconnect_streamed 1 "\
-                           "-reconnect_delay_max 5",
-            options="-vn -f s16le -ar 48000 -ac 2")
         return cls(
-            ffmpeg_source,
             title = data.get("title"),
             url = data.get("url"),
+            stream = source,
             web_url = data.get("webpage_url"),
             thumbnail_url = data.get("thumbnail"),
             filename = data.get("filename"),
+            duration = data.get("duration"),
             search_term = search
         )
 
@@ -138,12 +453,17 @@ class YTDLSource(discord.PCMVolumeTransformer):
     #     source.song_title = source['title']
 
     @classmethod
+    @metrics.YTDL_SECONDS.time(call="from_search")
+    @tracing.traced("from_search")
     async def from_search(cls, search: str = ""):
+        import requests
+
         # Get song metadata
         logger.info(f"Searching LastFM for: '{search}'")
         url = f"http://ws.audioscrobbler.com/2.0/?method=track.search&"\
             f"track={search}&api_key={LASTFM_API_KEY}&format=json"
-        response = requests.get(url)
+        with metrics.LASTFM_SECONDS.time(), tracing.span("lastfm"):
+            response = requests.get(url)
         lastfm_data = response.json()
 
         # Handle errors
@@ -275,6 +595,7 @@ class MusicPlayer:
         "volume",
         "dj_mode",
         "_view",
+        "_task",
     )
 
     # Each player is assiciated with a guild, so create a lock for when we do
@@ -286,23 +607,29 @@ class MusicPlayer:
         PLAYING = 2
         PAUSED = 3
 
-    def __init__(self, ctx: discord.ext.commands.Context):
+    def __init__(
+        self,
+        bot: commands.Bot,
+        guild: discord.Guild,
+        channel: discord.abc.Messageable,
+        cog: "Music"):
         """
-        Initializes the music player object associated with the given Discord
-        context.
+        Initializes the music player for the given guild.
+
+        Players should be created through 'PlayerRegistry.get()' rather than
+        directly, so that they are torn down properly.
 
         Args:
-            ctx (discord.ext.commands.Context):
-                The context within the player will connect to play music and
-                respond to requests.
+            bot (commands.Bot): The bot the player belongs to.
+            guild (discord.Guild): The guild the player plays music in.
+            channel (discord.abc.Messageable): The text channel the player
+                posts its 'Now Playing' message in.
+            cog (Music): The cog that owns the player.
         """
-        # Ensure proper cleanup
-        atexit.register(self.__del__)
-
-        self.bot = ctx.bot
-        self._guild = ctx.guild
-        self._channel = ctx.channel
-        self._cog = ctx.cog
+        self.bot = bot
+        self._guild = guild
+        self._channel = channel
+        self._cog = cog
         self._np = None  # 'Now Playing' message
 
         self._state = self.State.IDLE
@@ -315,15 +642,43 @@ class MusicPlayer:
         self.current = None
         self.dj_mode = False
 
-        ctx.bot.loop.create_task(self.player_loop())
+        self._task = bot.loop.create_task(self.player_loop())
 
-    def __del__(self):
+    async def close(self):
         """
-        Cleanup music player, which includes deleting messages like the
-        'Now Playing' message.
+        Stops the player and releases everything it holds.
+
+        This cancels the player loop, stops any FFmpeg processes for the
+        current and queued songs, deletes the 'Now Playing' message and
+        disconnects from voice. It is safe to call from within the player
+        loop itself.
         """
+        if self._task is not asyncio.current_task():
+            self._task.cancel()
+            try:
+                await self._task
+            except BaseException:
+                pass
+
+        # Drop queued songs
+        while not self._queue.empty():
+            source = self._queue.get_nowait()
+            if source:
+                source.cleanup()
+        if self.current:
+            self.current.cleanup()
+            self.current = None
+
         if self._np:
-            asyncio.run(self._np.delete())
+            try:
+                await self._np.delete()
+            except discord.HTTPException:
+                pass
+            self._np = None
+
+        vc = self._guild.voice_client
+        if vc:
+            await vc.disconnect()
 
     async def _change_state(self, new_state: "MusicPlayer.State" = None):
         """When state changes, update the Discord 'Now Playing' message."""
@@ -405,8 +760,6 @@ class MusicPlayer:
 
             # Add 'DJ Mode' footer if on
             if self.dj_mode:
-                print("dj icon url: ", assets.icons.get_icon_url(
-                    icon="headphones", color="green"))
                 embed.set_footer(text="DJ Mode", icon_url=assets.icons.get_icon_url(
                     icon="headphones", color="green"))
 
@@ -447,13 +800,16 @@ class MusicPlayer:
             controls.add_item(next_button)
 
             # If last post is the 'Now Playing' message, just update it
+            metrics.PLAYER_RENDERS.inc()
             last_message = [m async for m in self._channel.history(limit=1)]
             if last_message[0] and self._np and last_message[0].id == self._np.id:
                 await self._np.edit(embed=embed, view=controls)
+                metrics.PLAYER_MESSAGES.inc(action="edit")
             else:
                 if self._np:
                     self._np = await self._np.delete()
                 self._np = await self._channel.send(embed=embed, view=controls)
+                metrics.PLAYER_MESSAGES.inc(action="send")
 
     async def resume(self, interaction: discord.Interaction = None):
         if interaction:
@@ -487,19 +843,66 @@ class MusicPlayer:
         self._skipped = True    # Notify loop that we skipped the song
         vc.stop()
 
+    @tracing.traced("queue")
     async def queue(self, source: YTDLSource):
+        source.queued_at = time.perf_counter()
         await self._queue.put(source)
-        await self._change_state(None)
+        self.save_snapshot()
+        with tracing.span("change_state"):
+            await self._change_state(None)
+
+    def save_snapshot(self):
+        """Saves the player's state so it can be restored after a restart."""
+        vc = self._guild.voice_client
+        current = None
+        if self.current:
+            current = self.current.snapshot()
+            # The voice client's source knows how far into the song it is
+            if vc and hasattr(vc.source, "position"):
+                current["start_at"] = vc.source.position
+        self.bot.db.save_player_snapshot(
+            self._guild.id,
+            self._channel.id,
+            vc.channel.id if vc else None,
+            self.volume,
+            self.dj_mode,
+            current,
+            [s.snapshot() for s in self._queue._queue if s is not None])
+
+    def restore(self, snapshot: dict):
+        """
+        Restores the player's state from a snapshot.
+
+        The song that was playing is put back at the front of the queue, and
+        resumes where it left off.
+
+        Args:
+            snapshot (dict): A snapshot from 'Database.get_player_snapshots()'.
+        """
+        self.volume = snapshot["volume"]
+        self.dj_mode = snapshot["dj_mode"]
+        songs = snapshot["queue"]
+        if snapshot["current"]:
+            songs = [snapshot["current"]] + songs
+        for song in songs:
+            self._queue.put_nowait(
+                YTDLSource.from_snapshot(song, self._guild))
 
     async def player_loop(self, interaction: discord.Interaction = None):
         """
         The main loop that waits for song requests and plays music accordingly.
         """
+        # Everything the player logs and traces is for its server, not for
+        # the command that happened to start it
+        logs.guild_id.set(self._guild.id)
+        logs.request_id.set(None)
+        tracing.clear()
         await self.bot.wait_until_ready()
 
         while not self.bot.is_closed():
             self._next.clear()
             await self._change_state(self.State.IDLE)
+            source = None
 
             # Always get a song if there's one in the queue
             if self._queue.qsize() > 0 or self.dj_mode is False:
@@ -518,10 +921,16 @@ class MusicPlayer:
                     "Queue is empty and DJ mode is on. Picking song at random"
                 )
                 try:
-                    user_ids = [m.id for m in self._channel.members]
+                    # Voice members are cached with every intent profile,
+                    # unlike the text channel's members
+                    user_ids = [
+                        m.id for m in self._guild.voice_client.channel.members
+                    ]
                     channel_ids = [c.id for c in self._channel.guild.channels]
                     source = await self.bot.db.get_next_song(
-                        users=user_ids, channels=channel_ids)
+                        users=user_ids, channels=channel_ids,
+                        channel=self._channel.id,
+                        recommender=self.bot.recommender)
                     if not source:
                         raise RuntimeError("Could not get YouTube source.")
                 except Exception as e:
@@ -538,65 +947,277 @@ class MusicPlayer:
             if source is None:
                 continue
 
-            source.volume = self.volume
-            self.current = source
+            # Pick up the request's trace, if it has one
+            trace = source.trace or tracing.NO_SPAN
+            if source.queued_at is not None:
+                trace.child("queue_wait", start=source.queued_at).end()
+            steps = trace.child("player_loop")
 
-            logger.info(f"Playing '{source.song_title}' by '{source.artist}'")
-            row_id = self.bot.db.insert_song_play(self._channel.id, source)
+            # Restored songs need their stream looked up again
+            try:
+                with steps.child("resolve"):
+                    await source.resolve()
+            except Exception as e:
+                steps.end(error=type(e).__name__)
+                trace.end(error=type(e).__name__)
+                embed = discord.Embed(
+                    title=f"Couldn't play {str(source)}",
+                    description=str(e),
+                    color=discord.Color.red()
+                )
+                await self._channel.send(embed=embed)
+                continue
 
-            def song_finished(error):
-                # Update database to reflect song finishing
-                if not error:
-                    self.bot.db.update_song_play(row_id, not self._skipped)
-                    self._skipped = False
-                logger.info(f"Song finiehd with error: {error}")
-                self.bot.loop.call_soon_threadsafe(self._next.set)
+            # Wait until the host has room for another FFmpeg process
+            if not self.bot.governor.has_capacity():
+                embed = discord.Embed(
+                    title="The bot is busy right now",
+                    description=(
+                        f"{str(source)} will start as soon as there's room."),
+                    color=discord.Color.yellow()
+                )
+                await self._channel.send(embed=embed)
             try:
-                self._guild.voice_client.play(
-                    source,
-                    after=song_finished
+                with steps.child("governor"):
+                    slot = await self.bot.governor.acquire(self._guild.id)
+            except governor.AdmissionRefused as e:
+                steps.end(error=type(e).__name__)
+                trace.end(error=type(e).__name__)
+                embed = discord.Embed(
+                    title=f"Couldn't play {str(source)}",
+                    description=str(e),
+                    color=discord.Color.red()
                 )
-                logger.info("Updating presense and 'now playing' message")
-                await self.bot.change_presence(
-                    activity=discord.Activity(
-                        type=discord.ActivityType.custom,
-                        name="custom",
-                        state=f"🎵 {source.song_title} by {source.artist}",
+                await self._channel.send(embed=embed)
+                continue
+
+            # From here on the slot is released however the song ends
+            try:
+                source.volume = self.volume
+                self.current = source
+                self.save_snapshot()
+
+                logger.info(
+                    f"Playing '{source.song_title}' by '{source.artist}'")
+                row_id = self.bot.db.insert_song_play(
+                    self._channel.id, source, self._guild.id)
+
+                def song_finished(error):
+                    # Update database to reflect song finishing. A stream that
+                    # dropped and couldn't be resumed didn't finish either
+                    if not error:
+                        finished = not self._skipped and not audio.failed
+                        self.bot.db.update_song_play(row_id, finished)
+                        self._skipped = False
+                    logger.info(f"Song finiehd with error: {error}")
+                    self.bot.loop.call_soon_threadsafe(self._next.set)
+
+                # Decode and encode in a voice worker process if we have them,
+                # otherwise do it on discord.py's audio thread
+                workers = self.bot.voice_workers
+                with steps.child("voice_start"):
+                    if workers:
+                        audio = workers.open(
+                            self._guild.id, source, self.volume)
+                    else:
+                        audio = source.open()
+                    slot.audio = audio
+                    if trace:
+                        # The request is done once the first frame is read,
+                        # on the audio thread
+                        audio.first_frame = [
+                            steps.child("first_frame"), trace]
+                    self._guild.voice_client.play(
+                        audio,
+                        after=song_finished
                     )
-                )
+                steps.end()
+                self.bot.presence.set_playing(self._guild.id, str(source))
+
+                logger.info("Waiting for song to finish")
+                await self._change_state(self.State.PLAYING)
+                while not self._next.is_set():
+                    try:
+                        await asyncio.wait_for(
+                            self._next.wait(), SNAPSHOT_INTERVAL)
+                    except asyncio.TimeoutError:
+                        self.save_snapshot()
             except Exception as e:
+                steps.end(error=type(e).__name__)
+                trace.end(error=type(e).__name__)
                 # Post error message
                 embed = discord.Embed(
                     title=f"Error: {str(e)}", color=discord.Color.red()
                 )
                 await self._channel.send(embed=embed)
                 raise e
+            finally:
+                # Runs even if the player is torn down mid-song, so FFmpeg
+                # and the governor slot are always released, and the bot's
+                # status stops showing the song
+                self.bot.governor.release(slot)
+                self.bot.presence.clear(self._guild.id)
+                # Does nothing if the song got as far as its first frame
+                trace.end(error="stopped")
+                if source.filename and os.path.exists(source.filename):
+                    os.remove(source.filename)
+                source.cleanup()
+                self.current = None
+            self.save_snapshot()
 
-            logger.info("Waiting for song to finish")
-            await self._change_state(self.State.PLAYING)
-            await self._next.wait()
+    async def destroy(self):
+        """Disconnect and cleanup the player."""
+        await self._cog.players.teardown(self._guild, self)
 
-            if source.filename and os.path.exists(source.filename):
-                os.remove(source.filename)
 
-            # Make sure the FFmpeg process is cleaned up.
-            try:
-                source.cleanup()
-            except:
-                pass
-            self.current = None
+class HistoryPages(discord.ui.View):
+    """
+    A page of a server's play history, with buttons for older and newer ones.
 
-            # Update bot statuses to match no song playing
-            await self.bot.change_presence(status=None)
+    Each page is fetched from where the page before it ended, so paging stays
+    fast however long the history is.
+    """
 
-    async def destroy(self):
-        """Disconnect and cleanup the player."""
-        if self._np:
-            self._np = await self._np.delete()
-        try:
-            return await self._cog.cleanup(self._guild)
-        except:
-            return None
+    # Number of songs on each page
+    PAGE_SIZE = 10
+
+    def __init__(self, ctx, search: str = None):
+        super().__init__(timeout=300)
+        self.bot = ctx.bot
+        self.author_id = ctx.author.id
+        self.guild_id = ctx.guild.id
+        self.search = search
+        # The song each page shown so far starts before, newest page first
+        self._pages = [None]
+        self._older = None
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        return interaction.user.id == self.author_id
+
+    async def load(self) -> discord.Embed:
+        """Fetches the current page and builds its embed."""
+        loop = asyncio.get_running_loop()
+        songs = await loop.run_in_executor(None, partial(
+            self.bot.db.search_song_plays, self.guild_id, self.search,
+            before_id=self._pages[-1], limit=self.PAGE_SIZE + 1))
+        self._older = songs[self.PAGE_SIZE - 1]["id"] \
+            if len(songs) > self.PAGE_SIZE else None
+        self.newer.disabled = len(self._pages) == 1
+        self.older.disabled = self._older is None
+
+        lines = []
+        for song in songs[:self.PAGE_SIZE]:
+            played = datetime.datetime.fromisoformat(song["timestamp"]) \
+                .replace(tzinfo=datetime.timezone.utc)
+            title = song["song_title"] or song["search_term"]
+            line = f"{discord.utils.format_dt(played, 'd')} **{title}**"
+            if song["song_artist"]:
+                line += f" by {song['song_artist']}"
+            if song["user_id"]:
+                line += f" (<@{song['user_id']}>)"
+            lines.append(line)
+        embed = discord.Embed(
+            title=f"History: {self.search}" if self.search else "History",
+            description="\n".join(lines) or "Nothing played yet",
+            color=discord.Color.green(),
+        )
+        embed.set_footer(text=f"Page {len(self._pages)}")
+        return embed
+
+    @discord.ui.button(label="Newer", style=discord.ButtonStyle.secondary)
+    async def newer(self, interaction: discord.Interaction, button):
+        self._pages.pop()
+        await interaction.response.edit_message(
+            embed=await self.load(), view=self)
+
+    @discord.ui.button(label="Older", style=discord.ButtonStyle.secondary)
+    async def older(self, interaction: discord.Interaction, button):
+        self._pages.append(self._older)
+        await interaction.response.edit_message(
+            embed=await self.load(), view=self)
+
+
+class PlayerRegistry:
+    """
+    Owns the music player of every guild the bot is playing in.
+
+    Players are only created once a guild needs one, and are held here until
+    they are torn down, either by a command or by timing out. Tearing a
+    player down removes every reference the bot keeps to it and releases its
+    task, FFmpeg processes and voice connection, so players don't pile up
+    over a long uptime.
+
+    Examples:
+        >>> players = PlayerRegistry(cog)
+        >>> player = players.get(ctx)
+        >>> await players.teardown(ctx.guild)
+    """
+
+    def __init__(self, cog: "Music"):
+        self._cog = cog
+        self._players: dict[int, MusicPlayer] = {}
+
+    def __len__(self) -> int:
+        return len(self._players)
+
+    def __iter__(self):
+        return iter(list(self._players.values()))
+
+    def find(self, guild_id: int) -> MusicPlayer:
+        """Returns the guild's player, or None if it doesn't have one."""
+        return self._players.get(guild_id)
+
+    def get(self, ctx: commands.Context) -> MusicPlayer:
+        """Returns the guild's player, creating one if needed."""
+        player = self._players.get(ctx.guild.id)
+        if player is None:
+            player = self.create(ctx.guild, ctx.channel)
+        return player
+
+    def create(
+        self,
+        guild: discord.Guild,
+        channel: discord.abc.Messageable) -> MusicPlayer:
+        """
+        Creates a new player for a guild that doesn't have one.
+
+        Raises:
+            RuntimeError: If the guild already has a player, which would be
+                left running without anything to tear it down.
+        """
+        if guild.id in self._players:
+            raise RuntimeError(f"Server {guild.id} already has a player")
+        player = MusicPlayer(self._cog.bot, guild, channel, self._cog)
+        self._players[guild.id] = player
+        return player
+
+    async def teardown(self, guild: discord.Guild, player: MusicPlayer = None):
+        """
+        Tears down the guild's player and disconnects from voice.
+
+        Args:
+            guild (discord.Guild): The guild to tear down the player of.
+            player (MusicPlayer): If given, only tear down the guild's player
+                if it's still this one.
+        """
+        current = self._players.get(guild.id)
+        if player is not None and current is not player:
+            current = None
+        else:
+            self._players.pop(guild.id, None)
+
+        if current:
+            # The player was stopped on purpose, so don't restore it later
+            self._cog.bot.db.delete_player_snapshot(guild.id)
+            await current.close()
+        elif guild.voice_client and player is None:
+            await guild.voice_client.disconnect()
+
+    async def close_all(self):
+        """Tears down every player."""
+        players, self._players = self._players, {}
+        await asyncio.gather(
+            *(p.close() for p in players.values()), return_exceptions=True)
 
 
 class Music(commands.Cog):
@@ -609,7 +1230,64 @@ class Music(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
-        self.players = {}
+        self.players = PlayerRegistry(self)
+        self._restore_task = None
+        metrics.QUEUE_DEPTH.set_function(lambda: {
+            (player._guild.id,): player._queue.qsize()
+            for player in self.players})
+
+    async def cog_load(self):
+        self._restore_task = self.bot.loop.create_task(self.restore_players())
+
+    async def cog_unload(self):
+        # Players are closed without deleting their snapshots, so that they
+        # pick back up when the bot starts again
+        await self.players.close_all()
+
+    async def restore_players(self):
+        """Restores the music players that were running before a restart."""
+        await self.bot.wait_until_ready()
+        snapshots = self.bot.db.get_player_snapshots()
+        if not snapshots:
+            return
+        logger.info("Restoring %d music players", len(snapshots))
+
+        # Don't connect to too many voice channels at once
+        limit = asyncio.Semaphore(5)
+
+        async def restore(snapshot):
+            async with limit:
+                try:
+                    await self._restore_player(snapshot)
+                except Exception:
+                    logger.exception(
+                        "Couldn't restore player in server %d",
+                        snapshot["server_id"])
+                    self.bot.db.delete_player_snapshot(snapshot["server_id"])
+
+        await asyncio.gather(*(restore(s) for s in snapshots))
+
+    async def _restore_player(self, snapshot: dict):
+        guild = self.bot.get_guild(snapshot["server_id"])
+        channel = guild.get_channel(snapshot["channel_id"]) if guild else None
+        voice_channel = None
+        if guild and snapshot["voice_channel_id"]:
+            voice_channel = guild.get_channel(snapshot["voice_channel_id"])
+        if not channel or not voice_channel:
+            self.bot.db.delete_player_snapshot(snapshot["server_id"])
+            return
+
+        if not guild.voice_client:
+            await voice_channel.connect()
+        # Someone may have started playing while the bot was starting up or
+        # connecting, in which case their player takes over from the old one
+        if self.players.find(guild.id) is not None:
+            logger.info(
+                "Not restoring player in server %d, which already has one",
+                guild.id)
+            return
+        player = self.players.create(guild, channel)
+        player.restore(snapshot)
 
     # @commands.Cog.listener()
     # async def on_ready(self):
@@ -617,15 +1295,7 @@ class Music(commands.Cog):
     #     logger.info("Synced command tree")
 
     async def cleanup(self, guild):
-        try:
-            await guild.voice_client.disconnect()
-        except AttributeError:
-            pass
-
-        try:
-            del self.players[guild.id]
-        except KeyError:
-            pass
+        await self.players.teardown(guild)
 
     async def __local_check(self, ctx):
         """
@@ -653,23 +1323,12 @@ class Music(commands.Cog):
                 " in a valid channel or provide me with one"
             )
 
-        print(
-            "Ignoring exception in command {}:".format(ctx.command),
-            file=sys.stderr,
-        )
-        traceback.print_exception(
-            type(error), error, error.__traceback__, file=sys.stderr
-        )
+        logger.error(
+            "Ignoring exception in command %s", ctx.command, exc_info=error)
 
     def get_player(self, ctx):
         """Retrieve the guild player, or generate one."""
-        try:
-            player = self.players[ctx.guild.id]
-        except KeyError:
-            player = MusicPlayer(ctx)
-            self.players[ctx.guild.id] = player
-
-        return player
+        return self.players.get(ctx)
 
     @commands.command(
         name="join", aliases=["connect", "j"], description="connects to voice"
@@ -721,7 +1380,12 @@ class Music(commands.Cog):
                 )
         # await ctx.message.add_reaction('👍')
 
-    @commands.command(name="play", aliases=["p", "queue", "q"])
+    @commands.hybrid_command(
+        name="play",
+        aliases=["p", "queue", "q"],
+        description="Plays a song, or adds it to the queue."
+    )
+    @app_commands.describe(search="The song to search for, or its URL")
     async def play_(self, ctx, *, search: str = None):
         """Plays the given song in a voice channel.
 
@@ -735,12 +1399,28 @@ class Music(commands.Cog):
         Example:
             !play Play That Funky Music by Wild Cherry
         """
-        print(dir(assets))
+        # Time the request until its first frame of audio; the trace is
+        # handed to the player along with the song
+        trace = tracing.begin(
+            "play", guild_id=ctx.guild.id,
+            request_id=ctx.interaction.id if ctx.interaction else ctx.message.id
+        ) if search else tracing.NO_SPAN
+        with tracing.span("play_"):
+            try:
+                await self._play(ctx, search, trace)
+            except Exception as e:
+                trace.end(error=type(e).__name__)
+                raise
+
+    async def _play(self, ctx, search: str, trace: tracing.Span):
+        # Slash commands have to be answered within three seconds
+        await ctx.defer()
 
         # Ensure we're connected to the proper voice channel
         vc = ctx.voice_client
         if not vc:
-            await ctx.invoke(self.connect_)
+            with tracing.span("voice_connect"):
+                await ctx.invoke(self.connect_)
 
         # Ignore empty search term
         if not search:
@@ -755,17 +1435,20 @@ class Music(commands.Cog):
             name="Searching for:",
             icon_url=assets.icons.get_icon_url(icon="search", color="green")
         )
-        message = await ctx.channel.send(embed=embed)
+        with tracing.span("discord_send"):
+            message = await ctx.send(embed=embed)
 
         # Create source
+        import validators
         try:
             if not validators.url(search):
                 source = await YTDLSource.from_search(search)
             else:
                 source = await YTDLSource.create(search)
             source.requester = ctx.author
+            source.trace = trace or None
             # Track song requests in database
-            self.bot.db.insert_song_request(message, source)
+            self.bot.db.insert_song_request(ctx.message, source)
             # Add song to the corresponding player object
             player = self.get_player(ctx)
             await player.queue(source)
@@ -783,8 +1466,11 @@ class Music(commands.Cog):
                     icon="line-3", color="green")
             )
             embed.set_thumbnail(url=source.thumbnail_url)
-            await message.edit(embed=embed)
+            with tracing.span("discord_edit"):
+                await message.edit(embed=embed)
         except Exception as e:
+            # Failed lookups are what traces are most needed for
+            trace.end(error=type(e).__name__)
             # Gracefully tell user there was an issue
             embed = discord.Embed(
                 title=f"ERROR",
@@ -794,10 +1480,80 @@ class Music(commands.Cog):
             await message.edit(embed=embed)
             raise e
 
+    @play_.autocomplete("search")
+    async def play_autocomplete(
+        self,
+        interaction: discord.Interaction,
+        current: str) -> list[app_commands.Choice[str]]:
+        """Suggests songs that were played in the server before."""
+        if not interaction.guild_id:
+            return []
+        loop = asyncio.get_running_loop()
+        try:
+            suggestions = await asyncio.wait_for(
+                loop.run_in_executor(
+                    None, self.bot.db.suggest_songs,
+                    interaction.guild_id, current),
+                AUTOCOMPLETE_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Song suggestions for '%s' timed out", current)
+            return []
+        # Choices are limited to 100 characters
+        return [
+            app_commands.Choice(name=suggestion[:100], value=suggestion[:100])
+            for suggestion in suggestions]
+
+    @commands.guild_only()
+    @commands.command(
+        name="history", description="Shows songs played in this server."
+    )
+    async def history_(self, ctx, *, search: str = None):
+        """
+        Shows the songs played in this server, newest first.
+
+        Args:
+            ctx (discord.ext.commands.Context): The Discord context associated
+                with the message.
+            search (str): Only show songs with these words in their title,
+                artist or search term.
+        """
+        view = HistoryPages(ctx, search)
+        await ctx.send(embed=await view.load(), view=view)
+
     @app_commands.command(name="hello", description="says hello")
     async def hello(self, interaction: discord.Interaction):
         await interaction.response.send_message("hello")
 
+    @commands.command(
+        name="capacity",
+        description="Shows how much more music the bot can play at once."
+    )
+    async def capacity_(self, ctx):
+        """
+        Shows the bot's remaining capacity for playing music.
+
+        Args:
+            ctx (discord.ext.commands.Context): The Discord context associated
+                with the message.
+        """
+        usage = self.bot.governor.usage()
+        headroom = self.bot.governor.headroom()
+        embed = discord.Embed(title="Capacity", color=discord.Color.green())
+        for name, key, unit in (
+                ("Streams", "streams", ""),
+                ("CPU", "cpu", "%"),
+                ("Memory", "rss_mb", " MB")):
+            left = headroom[key]
+            embed.add_field(
+                name=name,
+                value=(
+                    f"{usage[key]:.0f}{unit} used, "
+                    + ("no limit" if left is None else f"{left:.0f}{unit} left")
+                )
+            )
+        embed.add_field(name="Waiting", value=str(headroom["waiting"]))
+        await ctx.send(embed=embed)
+
     @commands.command(
         name="djmode", aliases=["dj"], description="Turns DJ mode on or off."
     )
@@ -819,6 +1575,7 @@ class Music(commands.Cog):
         # Switch to desired mode
         player = self.get_player(ctx)
         player.dj_mode = mode
+        player.save_snapshot()
         # Break player out of waiting on queue so it can pick a song at random
         if player.dj_mode:
             await player.queue(None)
@@ -904,16 +1661,17 @@ class Music(commands.Cog):
 
         player = self.get_player(ctx)
         if pos == None:
-            player.queue._queue.pop()
+            player._queue._queue.pop()
+            player.save_snapshot()
         else:
             try:
-                s = player.queue._queue[pos - 1]
-                del player.queue._queue[pos - 1]
+                s = player._queue._queue[pos - 1]
+                del player._queue._queue[pos - 1]
+                player.save_snapshot()
                 embed = discord.Embed(
                     title="",
                     description=(
-                        f"Removed [{s['title']}]({s['webpage_url']})"
-                        f" [{s['requester'].mention}]"
+                        f"Removed [{str(s)}]({s.web_url})"
                     ),
                     color=discord.Color.green(),
                 )
@@ -949,7 +1707,8 @@ class Music(commands.Cog):
             return await ctx.send(embed=embed)
 
         player = self.get_player(ctx)
-        player.queue._queue.clear()
+        player._queue._queue.clear()
+        player.save_snapshot()
         await ctx.send("**Cleared**")
 
     @commands.command(
@@ -1000,6 +1759,7 @@ class Music(commands.Cog):
             vc.source.volume = vol / 100
 
         player.volume = vol / 100
+        player.save_snapshot()
         embed = discord.Embed(
             title="",
             description=f"**`{ctx.author}`** set the volume to **{vol}%**",
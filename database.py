@@ -1,23 +1,189 @@
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+import contextlib
 import discord
+import json
 import logging
-import openai
+import os
 import random
+import re
 import sqlite3
+import threading
+import time
 import typing
 
-from cogs import music_player
+import metrics
+
+# Importing the music player cog pulls in a lot, and it imports this module,
+# so it's only imported for type checking or when it's needed
+if typing.TYPE_CHECKING:
+    from cogs import music_player
+    import recommendations
 
 logger = logging.getLogger("database")
 
+# Rows of the old 'activity_change' table migrated per transaction
+MIGRATION_BATCH_SIZE = 10000
+
+# For each table that old rows can be trimmed from: the expression for when a
+# row was recorded, the date it was recorded on, and a query that adds the
+# rows up to a given ID and before a given time into the table's daily rollup
+RETENTION_TABLES = {
+    "activity_event": (
+        "timestamp",
+        "date(timestamp, 'unixepoch')",
+        """
+            INSERT INTO activity_daily (day, user_id, activity_id, seconds)
+            SELECT
+                date(event.timestamp, 'unixepoch'),
+                event.user_id,
+                event.activity_id,
+                SUM(COALESCE((
+                    SELECT MIN(next.timestamp) FROM activity_event AS next
+                    WHERE next.user_id = event.user_id
+                        AND next.timestamp > event.timestamp
+                ), event.timestamp) - event.timestamp)
+            FROM
+                activity_event AS event
+            WHERE
+                event.id <= ? AND event.timestamp < ? AND
+                event.activity_id IS NOT NULL
+            GROUP BY 1, 2, 3
+            ON CONFLICT (day, user_id, activity_id) DO UPDATE SET
+                seconds = seconds + excluded.seconds
+        """),
+    "song_request": (
+        "timestamp",
+        "date(timestamp)",
+        """
+            INSERT INTO song_request_daily (day, channel_id, user_id, requests)
+            SELECT date(timestamp), channel_id, user_id, COUNT(*)
+            FROM song_request
+            WHERE id <= ? AND timestamp < ?
+            GROUP BY 1, 2, 3
+            ON CONFLICT (day, channel_id, user_id) DO UPDATE SET
+                requests = requests + excluded.requests
+        """),
+    "song_play": (
+        "timestamp",
+        "date(timestamp)",
+        """
+            INSERT INTO song_play_daily (day, channel_id, plays, finished)
+            SELECT date(timestamp), channel_id, COUNT(*), SUM(finished)
+            FROM song_play
+            WHERE id <= ? AND timestamp < ?
+            GROUP BY 1, 2
+            ON CONFLICT (day, channel_id) DO UPDATE SET
+                plays = plays + excluded.plays,
+                finished = finished + excluded.finished
+        """),
+}
+
+# Tables with a full-text index over what was searched for and found
+SEARCHABLE_TABLES = ("song_request", "song_play")
+
+# For each table that can be exported: its columns and their types, and a
+# query for its rows with readable values in place of internal IDs. Types are
+# 'int', 'str', 'bool' or 'time', which is in seconds since the epoch
+EXPORT_TABLES = {
+    "activity_event": (
+        [("id", "int"), ("user_id", "int"), ("activity_type", "str"),
+         ("activity_name", "str"), ("status", "str"), ("timestamp", "time")],
+        """
+            SELECT
+                activity_event.id,
+                user.discord_id,
+                activity.type,
+                activity.name,
+                status.name,
+                activity_event.timestamp
+            FROM
+                activity_event
+                JOIN user ON user.id = activity_event.user_id
+                LEFT JOIN activity ON activity.id = activity_event.activity_id
+                JOIN status ON status.id = activity_event.status_id
+        """),
+    "song_request": (
+        [("id", "int"), ("user_id", "int"), ("server_id", "int"),
+         ("channel_id", "int"), ("search_term", "str"), ("song_title", "str"),
+         ("song_artist", "str"), ("timestamp", "time")],
+        """
+            SELECT
+                song_request.id,
+                user.discord_id,
+                server.discord_id,
+                channel.discord_id,
+                song_request.search_term,
+                song_request.song_title,
+                song_request.song_artist,
+                CAST(strftime('%s', song_request.timestamp) AS INTEGER)
+            FROM
+                song_request
+                JOIN user ON user.id = song_request.user_id
+                JOIN channel ON channel.id = song_request.channel_id
+                LEFT JOIN server ON server.id = channel.server_id
+        """),
+    "song_play": (
+        [("id", "int"), ("user_id", "int"), ("server_id", "int"),
+         ("channel_id", "int"), ("search_term", "str"), ("song_title", "str"),
+         ("song_artist", "str"), ("finished", "bool"), ("timestamp", "time")],
+        """
+            SELECT
+                song_play.id,
+                user.discord_id,
+                server.discord_id,
+                channel.discord_id,
+                song_play.search_term,
+                song_play.song_title,
+                song_play.song_artist,
+                song_play.finished,
+                CAST(strftime('%s', song_play.timestamp) AS INTEGER)
+            FROM
+                song_play
+                LEFT JOIN user ON user.id = song_play.user_id
+                JOIN channel ON channel.id = song_play.channel_id
+                LEFT JOIN server ON server.id = channel.server_id
+        """),
+}
+
+class AnalyticsResult(typing.NamedTuple):
+    """The result of an analytics query, and how current its data is."""
+    value: typing.Any
+    as_of: datetime
+
+@metrics.time_methods(metrics.DB_SECONDS)
 class Database:
-    def __init__(self, path: str):
+    def __init__(self, path: str, snapshot_age: float = 0):
+        """
+        Args:
+            path (str): The path of the database file.
+            snapshot_age (float): How many seconds old the copy of the
+                database that analytics queries read may get before it is
+                refreshed. If 0, analytics queries read the live database
+                through a read-only connection instead of a copy.
+        """
         self.path = path
+        self.snapshot_age = snapshot_age
+        self.snapshot_path = f"{path}.snapshot"
+        self._snapshot_time = None
+        self._snapshot_lock = threading.Lock()
+        # Interned activity and status IDs, so recording a presence change
+        # doesn't look them up every time
+        self._activity_ids = {}
+        self._status_ids = {}
         self._ensure_db()
 
     def _ensure_db(self):
         with sqlite3.connect(self.path) as conn:
 
+            # Let space freed by deleting old rows be reclaimed a little at a
+            # time. This only applies to new databases; existing ones are
+            # converted by 'enable_incremental_vacuum()'
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+
+            # Readers don't block writers, or the other way around, in WAL
+            # mode, so analytics queries don't hold up recording new events
+            conn.execute("PRAGMA journal_mode = WAL")
+
             # Table for keeping track of servers
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS server (
@@ -26,13 +192,19 @@ class Database:
                 )
             """)
 
-            # Table for keeping track of channels
+            # Table for keeping track of channels, and the server they're in
+            # if it's known
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS channel (
                     id INTEGER PRIMARY KEY,
-                    discord_id INTEGER NOT NULL UNIQUE
+                    discord_id INTEGER NOT NULL UNIQUE,
+                    server_id INTEGER
                 )
             """)
+            columns = [
+                row[1] for row in conn.execute("PRAGMA table_info(channel)")]
+            if "server_id" not in columns:
+                conn.execute("ALTER TABLE channel ADD COLUMN server_id INTEGER")
 
             # Table for keeping track of users
             conn.execute("""
@@ -42,20 +214,40 @@ class Database:
                 )
             """)
 
-            # Create the activity table
+            # Table of every distinct activity, so names aren't repeated
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS activity (
+                    id INTEGER PRIMARY KEY,
+                    type TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    UNIQUE (type, name)
+                )
+            """)
+
+            # Table of every distinct user status
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS status (
+                    id INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL UNIQUE
+                )
+            """)
+
+            # Table of user activity and status changes. Each row only holds
+            # the new state; the state before is the user's previous row. The
+            # timestamp is in seconds since the epoch
             conn.execute("""
-                CREATE TABLE IF NOT EXISTS activity_change (
+                CREATE TABLE IF NOT EXISTS activity_event (
                     id INTEGER PRIMARY KEY,
                     user_id INTEGER NOT NULL,
-                    before_activity_type TEXT,
-                    before_activity_name TEXT,
-                    before_activity_status TEXT NOT NULL,
-                    after_activity_type TEXT,
-                    after_activity_name TEXT,
-                    after_activity_status TEXT NOT NULL,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL
+                    activity_id INTEGER,
+                    status_id INTEGER NOT NULL,
+                    timestamp INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)) NOT NULL
                 )
             """)
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS activity_event_user_timestamp
+                ON activity_event (user_id, timestamp)
+            """)
             
             # Create the song request table
             conn.execute("""
@@ -84,6 +276,158 @@ class Database:
                 )
             """)
 
+            # Songs played from a URL have no title or artist until the
+            # enrichment job looks them up; these find them without a scan
+            for table in ("song_request", "song_play"):
+                conn.execute(f"""
+                    CREATE INDEX IF NOT EXISTS {table}_unenriched
+                    ON {table} (search_term) WHERE song_title IS NULL
+                """)
+
+            # Title and artist looked up for each search term, or NULL if the
+            # lookup found nothing, so each is only looked up once
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS song_metadata (
+                    search_term TEXT PRIMARY KEY,
+                    song_title TEXT,
+                    song_artist TEXT,
+                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL
+                )
+            """)
+
+            # Daily totals of old rows removed by the retention job. Seconds
+            # spent in each activity, requests per user and plays per channel
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS activity_daily (
+                    day TEXT NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    activity_id INTEGER NOT NULL,
+                    seconds INTEGER NOT NULL,
+                    PRIMARY KEY (day, user_id, activity_id)
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS song_request_daily (
+                    day TEXT NOT NULL,
+                    channel_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    requests INTEGER NOT NULL,
+                    PRIMARY KEY (day, channel_id, user_id)
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS song_play_daily (
+                    day TEXT NOT NULL,
+                    channel_id INTEGER NOT NULL,
+                    plays INTEGER NOT NULL,
+                    finished INTEGER NOT NULL,
+                    PRIMARY KEY (day, channel_id)
+                )
+            """)
+
+            # Full-text indexes over song searches, titles and artists. The
+            # indexes read the text from the tables themselves, and triggers
+            # keep them in step. Prefixes of two and three characters are
+            # indexed too, for autocomplete
+            for table in SEARCHABLE_TABLES:
+                exists = conn.execute("""
+                    SELECT 1 FROM sqlite_master WHERE name = ?
+                """, (f"{table}_search",)).fetchone()
+                conn.execute(f"""
+                    CREATE VIRTUAL TABLE IF NOT EXISTS {table}_search
+                    USING fts5(
+                        search_term, song_title, song_artist,
+                        content='{table}', content_rowid='id',
+                        prefix='2 3'
+                    )
+                """)
+                conn.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS {table}_search_insert
+                    AFTER INSERT ON {table} BEGIN
+                        INSERT INTO {table}_search (
+                            rowid, search_term, song_title, song_artist
+                        ) VALUES (
+                            new.id, new.search_term, new.song_title,
+                            new.song_artist
+                        );
+                    END
+                """)
+                conn.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS {table}_search_delete
+                    AFTER DELETE ON {table} BEGIN
+                        INSERT INTO {table}_search (
+                            {table}_search, rowid, search_term, song_title,
+                            song_artist
+                        ) VALUES (
+                            'delete', old.id, old.search_term, old.song_title,
+                            old.song_artist
+                        );
+                    END
+                """)
+                conn.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS {table}_search_update
+                    AFTER UPDATE OF search_term, song_title, song_artist
+                    ON {table} BEGIN
+                        INSERT INTO {table}_search (
+                            {table}_search, rowid, search_term, song_title,
+                            song_artist
+                        ) VALUES (
+                            'delete', old.id, old.search_term, old.song_title,
+                            old.song_artist
+                        );
+                        INSERT INTO {table}_search (
+                            rowid, search_term, song_title, song_artist
+                        ) VALUES (
+                            new.id, new.search_term, new.song_title,
+                            new.song_artist
+                        );
+                    END
+                """)
+                # Index what was recorded before the index existed
+                if not exists:
+                    logger.info("Building search index of '%s'", table)
+                    conn.execute(f"""
+                        INSERT INTO {table}_search ({table}_search)
+                        VALUES ('rebuild')
+                    """)
+
+            # Small bits of bot state that need to survive restarts
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS setting (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                )
+            """)
+
+            # Last known state of each server's music player, so playback can
+            # pick back up after a restart. Songs are stored as JSON objects
+            # of their metadata, without stream URLs, which expire
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS player_snapshot (
+                    server_id INTEGER PRIMARY KEY,
+                    channel_id INTEGER NOT NULL,
+                    voice_channel_id INTEGER,
+                    volume REAL NOT NULL,
+                    dj_mode BOOL NOT NULL,
+                    current TEXT,
+                    queue TEXT NOT NULL,
+                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL
+                )
+            """)
+
+            # Songs recommended for DJ mode in each channel, waiting to be
+            # played, oldest first
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS recommendation (
+                    id INTEGER PRIMARY KEY,
+                    channel_id INTEGER NOT NULL,
+                    song_title TEXT NOT NULL,
+                    song_artist TEXT NOT NULL,
+                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL,
+                    UNIQUE (channel_id, song_title, song_artist)
+                )
+            """)
+
             conn.commit()
 
     def _insert_server(self, discord_id: int = None) -> int:
@@ -125,7 +469,10 @@ class Database:
                 row_id = cursor.fetchone()[0]
             return row_id
 
-    def _insert_channel(self, discord_id: int = None) -> int:
+    def _insert_channel(
+        self,
+        discord_id: int = None,
+        server_id: int = None) -> int:
         """
         Inserts Discord channel ID into the 'channel' table.
         
@@ -135,6 +482,9 @@ class Database:
 
         Args:
             discord_id (int): The ID used to identify the channel in Discord.
+            server_id (int): The Discord ID of the server the channel is in,
+                if known. Channels recorded before servers were tracked get it
+                filled in.
 
         Returns:
             int: The ID of the channel in the channel table.
@@ -144,15 +494,22 @@ class Database:
             >>> db._insert_channel(8506109222564428891)
             12
         """
+        if server_id is not None:
+            server_id = self._insert_server(server_id)
         with sqlite3.connect(self.path) as conn:
             cursor = conn.cursor()
-            # Insert it; ignoring already exists error
+            # Insert it; ignoring already exists error unless the server is
+            # newly known
             cursor.execute("""
-                INSERT INTO channel (discord_id)
-                VALUES (?)
-                ON CONFLICT(discord_id) DO NOTHING
+                INSERT INTO channel (discord_id, server_id)
+                VALUES (?, ?)
+                ON CONFLICT(discord_id) DO UPDATE SET
+                    server_id = excluded.server_id
+                WHERE
+                    channel.server_id IS NULL AND
+                    excluded.server_id IS NOT NULL
                 RETURNING id;
-            """, (discord_id,))
+            """, (discord_id, server_id))
             row = cursor.fetchone()
             if row:
                 row_id = row[0]
@@ -203,6 +560,101 @@ class Database:
                 row_id = cursor.fetchone()[0]
             return row_id
 
+    def get_setting(self, key: str) -> str:
+        """
+        Gets a value from the 'setting' table.
+
+        Args:
+            key (str): The name of the setting.
+
+        Returns:
+            str: The value of the setting, or None if it isn't set.
+        """
+        with sqlite3.connect(self.path) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT value FROM setting WHERE key = ?
+            """, (key,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+
+    def set_setting(self, key: str, value: str):
+        """
+        Sets a value in the 'setting' table.
+
+        Args:
+            key (str): The name of the setting.
+            value (str): The value to store.
+        """
+        with sqlite3.connect(self.path) as conn:
+            conn.execute("""
+                INSERT INTO setting (key, value)
+                VALUES (?, ?)
+                ON CONFLICT(key) DO UPDATE SET value = excluded.value
+            """, (key, value))
+
+    def _insert_activity(self, type: str, name: str) -> int:
+        """
+        Inserts an activity into the 'activity' table.
+
+        Like the other '_insert_*()' methods, this ignores activities that are
+        already present and returns the row ID regardless. IDs are cached, so
+        each activity is only looked up once.
+
+        Args:
+            type (str): The name of the activity type, e.g. 'playing'.
+            name (str): The name of the activity.
+
+        Returns:
+            int: The ID of the activity in the activity table.
+        """
+        key = (type, name)
+        if key not in self._activity_ids:
+            with sqlite3.connect(self.path) as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    INSERT INTO activity (type, name)
+                    VALUES (?, ?)
+                    ON CONFLICT(type, name) DO NOTHING
+                    RETURNING id;
+                """, key)
+                row = cursor.fetchone()
+                if not row:
+                    cursor.execute("""
+                        SELECT id FROM activity WHERE type = ? AND name = ?
+                    """, key)
+                    row = cursor.fetchone()
+                self._activity_ids[key] = row[0]
+        return self._activity_ids[key]
+
+    def _insert_status(self, name: str) -> int:
+        """
+        Inserts a user status into the 'status' table.
+
+        Args:
+            name (str): The name of the status, e.g. 'online'.
+
+        Returns:
+            int: The ID of the status in the status table.
+        """
+        if name not in self._status_ids:
+            with sqlite3.connect(self.path) as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    INSERT INTO status (name)
+                    VALUES (?)
+                    ON CONFLICT(name) DO NOTHING
+                    RETURNING id;
+                """, (name,))
+                row = cursor.fetchone()
+                if not row:
+                    cursor.execute("""
+                        SELECT id FROM status WHERE name = ?
+                    """, (name,))
+                    row = cursor.fetchone()
+                self._status_ids[name] = row[0]
+        return self._status_ids[name]
+
     def insert_activity_change(
         self,
         before: discord.Member,
@@ -210,8 +662,8 @@ class Database:
         """
         Inserts an activity change into the database.
 
-        This method takes two discord.Memeber objects, and records the change
-        in activity into the 'activity_change' table.
+        This method takes two discord.Memeber objects, and records the new
+        activity and status into the 'activity_event' table.
 
         Args:
             before (discord.Member): The previous user status.
@@ -235,39 +687,110 @@ class Database:
         if before.id != after.id:
             raise ValueError("User IDs do not match.")
         user_id = self._insert_user(before.id)
-        # Get activities if they exist
-        before_type = before.activity.type.name if before.activity else None
-        before_name = before.activity.name if before.activity else None
-        after_type = after.activity.type.name if after.activity else None
-        after_name = after.activity.name if after.activity else None
+        # Get activity if it exists
+        activity_id = None
+        if after.activity:
+            activity_id = self._insert_activity(
+                after.activity.type.name, after.activity.name)
+        status_id = self._insert_status(after.status.name)
         # Insert the activity change
         with sqlite3.connect(self.path) as conn:
             conn.execute("""
-                INSERT INTO activity_change (
+                INSERT INTO activity_event (
                     user_id,
-                    before_activity_type,
-                    before_activity_name,
-                    before_activity_status,
-                    after_activity_type,
-                    after_activity_name,
-                    after_activity_status
+                    activity_id,
+                    status_id
                 ) VALUES (
-                    ?, ?, ?, ?, ?, ?, ?
+                    ?, ?, ?
                 )
-            """, (
-                user_id,
-                before_type,
-                before_name,
-                before.status.name,
-                after_type,
-                after_name,
-                after.status.name
-            ))
+            """, (user_id, activity_id, status_id))
+
+    def migrate_activity_changes(
+        self,
+        batch_size: int = MIGRATION_BATCH_SIZE) -> bool:
+        """
+        Migrates a batch of rows from the old 'activity_change' table.
+
+        The old table stored the full activity and status both before and
+        after every change. This copies the new state of each row into
+        'activity_event', a batch at a time so that the database is never
+        locked for long while the bot keeps recording new changes, and drops
+        the old table once it's empty.
+
+        Args:
+            batch_size (int): The number of rows to migrate.
+
+        Returns:
+            bool: Whether there are rows left to migrate.
+
+        Examples:
+            >>> db = Database("path.db")
+            >>> while db.migrate_activity_changes():
+            ...     time.sleep(0.1)
+        """
+        with sqlite3.connect(self.path) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT 1 FROM sqlite_master
+                WHERE type = 'table' AND name = 'activity_change'
+            """)
+            if not cursor.fetchone():
+                return False
+
+            cursor.execute("""
+                SELECT MAX(id) FROM (
+                    SELECT id FROM activity_change ORDER BY id LIMIT ?
+                )
+            """, (batch_size,))
+            last_id = cursor.fetchone()[0]
+            if last_id is None:
+                conn.execute("DROP TABLE activity_change")
+                logger.info("Finished migrating 'activity_change'")
+                return False
+
+            conn.execute("""
+                INSERT OR IGNORE INTO activity (type, name)
+                SELECT DISTINCT after_activity_type, after_activity_name
+                FROM activity_change
+                WHERE id <= ? AND after_activity_name IS NOT NULL
+            """, (last_id,))
+            conn.execute("""
+                INSERT OR IGNORE INTO status (name)
+                SELECT DISTINCT after_activity_status
+                FROM activity_change
+                WHERE id <= ?
+            """, (last_id,))
+            conn.execute("""
+                INSERT INTO activity_event (
+                    user_id,
+                    activity_id,
+                    status_id,
+                    timestamp
+                )
+                SELECT
+                    activity_change.user_id,
+                    activity.id,
+                    status.id,
+                    CAST(strftime('%s', activity_change.timestamp) AS INTEGER)
+                FROM
+                    activity_change
+                    LEFT JOIN activity
+                        ON activity.type = activity_change.after_activity_type
+                        AND activity.name = activity_change.after_activity_name
+                    JOIN status
+                        ON status.name = activity_change.after_activity_status
+                WHERE
+                    activity_change.id <= ?
+            """, (last_id,))
+            conn.execute("""
+                DELETE FROM activity_change WHERE id <= ?
+            """, (last_id,))
+            return True
 
     def insert_song_request(
         self,
         message: discord.Message,
-        source: music_player.YTDLSource):
+        source: "music_player.YTDLSource"):
         """
         Inserts a song request into the database.
 
@@ -292,7 +815,9 @@ class Database:
                 )
             """, (
                 self._insert_user(message.author.id),
-                self._insert_channel(message.channel.id),
+                self._insert_channel(
+                    message.channel.id,
+                    message.guild.id if message.guild else None),
                 source.search_term,
                 source.song_title,
                 source.artist
@@ -301,7 +826,8 @@ class Database:
     def insert_song_play(
         self,
         channel_id: int,
-        source: music_player.YTDLSource):
+        source: "music_player.YTDLSource",
+        server_id: int = None):
         """
         Inserts a song play into the database.
 
@@ -311,12 +837,13 @@ class Database:
         Args:
             channel (int): The Discord channel the song is being played in.
             source (music_player.YTDLSource): The audio source.
+            server_id (int): The Discord server the channel is in.
 
         Returns:
             int: The row ID of the entered song. Used to update 'played' value.
         """
         user_id = self._insert_user(source.requester.id) if source.requester else None
-        channel_id = self._insert_channel(channel_id)
+        channel_id = self._insert_channel(channel_id, server_id)
         # Insert the information
         with sqlite3.connect(self.path) as conn:
             cur = conn.cursor()
@@ -362,65 +889,926 @@ class Database:
                     id = ?
             """, (finished, song_play_id))
 
+    def save_player_snapshot(
+        self,
+        server_id: int,
+        channel_id: int,
+        voice_channel_id: int,
+        volume: float,
+        dj_mode: bool,
+        current: dict,
+        queue: list[dict]):
+        """
+        Saves the state of a server's music player.
+
+        Each server has a single snapshot, which is replaced every time the
+        player's state changes.
+
+        Args:
+            server_id (int): The Discord ID of the server.
+            channel_id (int): The Discord ID of the player's text channel.
+            voice_channel_id (int): The Discord ID of the voice channel the
+                player is connected to, if any.
+            volume (float): The player's volume.
+            dj_mode (bool): Whether DJ mode is on.
+            current (dict): The song currently playing, including how far
+                into it playback is, or None.
+            queue (list[dict]): The songs waiting to be played.
+        """
+        server_id = self._insert_server(server_id)
+        channel_id = self._insert_channel(channel_id)
+        if voice_channel_id:
+            voice_channel_id = self._insert_channel(voice_channel_id)
+        with sqlite3.connect(self.path) as conn:
+            conn.execute("""
+                INSERT INTO player_snapshot (
+                    server_id,
+                    channel_id,
+                    voice_channel_id,
+                    volume,
+                    dj_mode,
+                    current,
+                    queue
+                ) VALUES (
+                    ?, ?, ?, ?, ?, ?, ?
+                )
+                ON CONFLICT(server_id) DO UPDATE SET
+                    channel_id = excluded.channel_id,
+                    voice_channel_id = excluded.voice_channel_id,
+                    volume = excluded.volume,
+                    dj_mode = excluded.dj_mode,
+                    current = excluded.current,
+                    queue = excluded.queue,
+                    timestamp = CURRENT_TIMESTAMP
+            """, (
+                server_id,
+                channel_id,
+                voice_channel_id,
+                volume,
+                dj_mode,
+                json.dumps(current) if current else None,
+                json.dumps(queue)
+            ))
+
+    def delete_player_snapshot(self, server_id: int):
+        """
+        Deletes the snapshot of a server's music player.
+
+        Args:
+            server_id (int): The Discord ID of the server.
+        """
+        with sqlite3.connect(self.path) as conn:
+            conn.execute("""
+                DELETE FROM
+                    player_snapshot
+                WHERE
+                    server_id = (SELECT id FROM server WHERE discord_id = ?)
+            """, (server_id,))
+
+    def get_player_snapshots(self) -> list[dict]:
+        """
+        Gets the snapshots of every server's music player.
+
+        Returns:
+            list[dict]: One dictionary per server, with the same keys as the
+                arguments of 'save_player_snapshot()'. IDs are Discord IDs.
+        """
+        with sqlite3.connect(self.path) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT
+                    server.discord_id,
+                    channel.discord_id,
+                    voice_channel.discord_id,
+                    player_snapshot.volume,
+                    player_snapshot.dj_mode,
+                    player_snapshot.current,
+                    player_snapshot.queue
+                FROM
+                    player_snapshot
+                    JOIN server ON server.id = player_snapshot.server_id
+                    JOIN channel ON channel.id = player_snapshot.channel_id
+                    LEFT JOIN channel AS voice_channel
+                        ON voice_channel.id = player_snapshot.voice_channel_id
+            """)
+            rows = cursor.fetchall()
+        return [{
+            "server_id": server_id,
+            "channel_id": channel_id,
+            "voice_channel_id": voice_channel_id,
+            "volume": volume,
+            "dj_mode": bool(dj_mode),
+            "current": json.loads(current) if current else None,
+            "queue": json.loads(queue),
+        } for (server_id, channel_id, voice_channel_id, volume, dj_mode,
+               current, queue) in rows]
+
+    @staticmethod
+    def _match(text: str) -> str:
+        """
+        Turns what a user typed into a full-text query.
+
+        Every word must appear, and the last one may be unfinished.
+
+        Args:
+            text (str): The text to search for.
+
+        Returns:
+            str: The query, or None if there are no words to search for.
+        """
+        words = re.findall(r"\w+", text.lower())
+        if not words:
+            return None
+        return " ".join(f'"{word}"' for word in words[:-1]) \
+            + f' "{words[-1]}"*'
+
+    def search_song_plays(
+        self,
+        server_id: int,
+        text: str = None,
+        before_id: int = None,
+        limit: int = 10) -> list[dict]:
+        """
+        Searches the songs played in a server, newest first.
+
+        Pages are fetched by passing the ID of the last song of the previous
+        page, so each page costs the same however far back it is.
+
+        Args:
+            server_id (int): The Discord ID of the server.
+            text (str): Words in the song's title, artist or search term. All
+                songs are returned if not given.
+            before_id (int): Only return songs played before this one.
+            limit (int): The most songs to return.
+
+        Returns:
+            list[dict]: The songs, with the keys 'id', 'search_term',
+                'song_title', 'song_artist', 'user_id' (a Discord ID),
+                'finished' and 'timestamp'.
+
+        Examples:
+            >>> db = Database("path.db")
+            >>> page = db.search_song_plays(8506109222, "funky")
+            >>> older = db.search_song_plays(
+            ...     8506109222, "funky", before_id=page[-1]["id"])
+        """
+        match = self._match(text) if text else None
+        conditions = [
+            "channel.server_id = (SELECT id FROM server WHERE discord_id = ?)"]
+        params = [server_id]
+        source = "song_play"
+        order = "song_play.id"
+        if match:
+            source = """
+                song_play_search
+                JOIN song_play ON song_play.id = song_play_search.rowid
+            """
+            conditions.append("song_play_search MATCH ?")
+            params.append(match)
+            # Ordering on the index's own row IDs lets it return matches
+            # newest first, rather than all of them being sorted
+            order = "song_play_search.rowid"
+        if before_id is not None:
+            conditions.append("song_play.id < ?")
+            params.append(before_id)
+        with sqlite3.connect(f"file:{self.path}?mode=ro", uri=True) as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                SELECT
+                    song_play.id,
+                    song_play.search_term,
+                    song_play.song_title,
+                    song_play.song_artist,
+                    user.discord_id,
+                    song_play.finished,
+                    song_play.timestamp
+                FROM
+                    {source}
+                    JOIN channel ON channel.id = song_play.channel_id
+                    LEFT JOIN user ON user.id = song_play.user_id
+                WHERE
+                    {" AND ".join(conditions)}
+                ORDER BY
+                    {order} DESC
+                LIMIT ?
+            """, (*params, limit))
+            rows = cursor.fetchall()
+        keys = ("id", "search_term", "song_title", "song_artist", "user_id",
+                "finished", "timestamp")
+        return [dict(zip(keys, row)) for row in rows]
+
+    def suggest_songs(
+        self,
+        server_id: int,
+        text: str,
+        limit: int = 25) -> list[str]:
+        """
+        Suggests songs a server has played before, for autocomplete.
+
+        Songs are matched on words in their title, artist or search term,
+        most recently played first, and each song is only suggested once.
+        Searches that were requested but never played are suggested after
+        them.
+
+        Args:
+            server_id (int): The Discord ID of the server.
+            text (str): What the user has typed so far.
+            limit (int): The most suggestions to return.
+
+        Returns:
+            list[str]: Suggested searches, such as 'Title - Artist'.
+        """
+        match = self._match(text)
+        # Matches are scanned newest first, and only this many are looked at
+        # so that common prefixes stay fast
+        scan = limit * 8
+        suggestions = {}
+        with sqlite3.connect(f"file:{self.path}?mode=ro", uri=True) as conn:
+            cursor = conn.cursor()
+            for table in ("song_play", "song_request"):
+                if match:
+                    source = f"""
+                        {table}_search
+                        JOIN {table} ON {table}.id = {table}_search.rowid
+                    """
+                    condition = f"{table}_search MATCH ?"
+                    params = [match]
+                    order = f"{table}_search.rowid"
+                else:
+                    source, condition, params = table, "1", []
+                    order = f"{table}.id"
+                cursor.execute(f"""
+                    SELECT
+                        {table}.search_term,
+                        {table}.song_title,
+                        {table}.song_artist
+                    FROM
+                        {source}
+                        JOIN channel ON channel.id = {table}.channel_id
+                    WHERE
+                        {condition} AND
+                        channel.server_id = (
+                            SELECT id FROM server WHERE discord_id = ?
+                        )
+                    ORDER BY
+                        {order} DESC
+                    LIMIT ?
+                """, (*params, server_id, scan))
+                for search_term, title, artist in cursor:
+                    if title and artist:
+                        suggestion = f"{title} - {artist}"
+                    else:
+                        suggestion = title or search_term
+                    suggestions.setdefault(suggestion.lower(), suggestion)
+                    if len(suggestions) >= limit:
+                        return list(suggestions.values())
+        return list(suggestions.values())
+
+    @staticmethod
+    def _timestamp(table: str, when: datetime) -> typing.Union[int, str]:
+        """Converts a time to how the given table stores timestamps."""
+        if table == "activity_event":
+            return int(when.timestamp())
+        return when.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+    def export_rows(
+        self,
+        table: str,
+        since: datetime = None,
+        until: datetime = None,
+        server_id: int = None,
+        batch_size: int = 10000) -> typing.Iterator[list[tuple]]:
+        """
+        Reads the rows of a table for export, a batch at a time.
+
+        Rows are read through a single cursor, so only one batch is held in
+        memory at a time however large the table is. The read doesn't block
+        the bot from writing meanwhile.
+
+        Args:
+            table (str): One of the tables in 'EXPORT_TABLES'.
+            since (datetime): Only export rows recorded at or after this.
+            until (datetime): Only export rows recorded before this.
+            server_id (int): Only export rows from this Discord server.
+            batch_size (int): The number of rows in each batch.
+
+        Returns:
+            typing.Iterator[list[tuple]]: Batches of rows, with the columns
+                listed in 'EXPORT_TABLES'.
+
+        Raises:
+            ValueError: If filtering on a server the table doesn't record.
+
+        Examples:
+            >>> db = Database("path.db")
+            >>> for rows in db.export_rows("song_play", server_id=85061092):
+            ...     writer.writerows(rows)
+        """
+        _, query = EXPORT_TABLES[table]
+        conditions = []
+        params = []
+        if since is not None:
+            conditions.append(f"{table}.timestamp >= ?")
+            params.append(self._timestamp(table, since))
+        if until is not None:
+            conditions.append(f"{table}.timestamp < ?")
+            params.append(self._timestamp(table, until))
+        if server_id is not None:
+            if "server.discord_id" not in query:
+                raise ValueError(f"'{table}' isn't recorded per server")
+            conditions.append("server.discord_id = ?")
+            params.append(server_id)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += f" ORDER BY {table}.id"
+
+        # Checked above rather than when the first batch is read
+        def batches():
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+            try:
+                cursor = conn.execute(query, params)
+                while rows := cursor.fetchmany(batch_size):
+                    yield rows
+            finally:
+                conn.close()
+        return batches()
+
+    def trim_table(
+        self,
+        table: str,
+        before: datetime,
+        batch_size: int = 1000,
+        archive: str = None) -> int:
+        """
+        Removes a batch of rows recorded before a given time from a table.
+
+        The rows are first added to the table's daily rollup, so totals stay
+        available after the rows themselves are gone. Each batch is its own
+        short transaction, so call this repeatedly until it returns 0 rather
+        than using a large batch size.
+
+        Args:
+            table (str): One of the tables in 'RETENTION_TABLES'.
+            before (datetime): Rows recorded before this time are removed.
+            batch_size (int): The most rows to remove.
+            archive (str): The path of a database to copy the rows into
+                before they are removed. If not given, they are deleted.
+
+        Returns:
+            int: The number of rows removed.
+
+        Examples:
+            >>> db = Database("path.db")
+            >>> while db.trim_table("song_play", datetime(2024, 1, 1)):
+            ...     time.sleep(0.1)
+        """
+        column, _, rollup = RETENTION_TABLES[table]
+        cutoff = self._timestamp(table, before)
+        with sqlite3.connect(self.path) as conn:
+            if archive:
+                conn.execute("ATTACH DATABASE ? AS archive", (archive,))
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                SELECT MAX(id), COUNT(*) FROM (
+                    SELECT id FROM {table} WHERE {column} < ?
+                    ORDER BY id LIMIT ?
+                )
+            """, (cutoff, batch_size))
+            last_id, count = cursor.fetchone()
+            if not count:
+                return 0
+            conn.execute(rollup, (last_id, cutoff))
+            if archive:
+                conn.execute(f"""
+                    CREATE TABLE IF NOT EXISTS archive.{table} AS
+                    SELECT * FROM main.{table} WHERE 0
+                """)
+                conn.execute(f"""
+                    INSERT INTO archive.{table}
+                    SELECT * FROM main.{table} WHERE id <= ? AND {column} < ?
+                """, (last_id, cutoff))
+            conn.execute(f"""
+                DELETE FROM main.{table} WHERE id <= ? AND {column} < ?
+            """, (last_id, cutoff))
+            conn.commit()
+            if archive:
+                conn.execute("DETACH DATABASE archive")
+        return count
+
+    def size(self) -> dict[str, int]:
+        """
+        Gets the size of the database.
+
+        Returns:
+            dict[str, int]: The size of the database file and the space in it
+                that is free to be reclaimed, both in bytes.
+        """
+        with sqlite3.connect(self.path) as conn:
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            pages = conn.execute("PRAGMA page_count").fetchone()[0]
+            free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return {"bytes": pages * page_size, "free_bytes": free * page_size}
+
+    def enable_incremental_vacuum(self) -> bool:
+        """
+        Converts the database to incremental vacuuming if it isn't already.
+
+        Databases created before incremental vacuuming was turned on need a
+        full VACUUM once, which rewrites the whole file and locks it while it
+        runs, so this is only done at startup, before the bot connects.
+
+        Returns:
+            bool: Whether the database had to be converted.
+
+        Raises:
+            sqlite3.OperationalError: If the database couldn't be converted,
+                for example because something else has it locked.
+        """
+        with sqlite3.connect(self.path) as conn:
+            mode = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+            if mode == 2:
+                return False
+            size = self.size()["bytes"]
+            logger.info(
+                "Converting %.1f MB database to incremental vacuum; this only "
+                "happens once", size / 2**20)
+            start = time.perf_counter()
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+        logger.info(
+            "Converted database in %.1fs", time.perf_counter() - start)
+        return True
+
+    def incremental_vacuum(self, pages: int = 1000) -> int:
+        """
+        Returns free pages at the end of the database file to the OS.
+
+        Args:
+            pages (int): The most pages to free.
+
+        Returns:
+            int: The number of pages still free afterwards.
+        """
+        with sqlite3.connect(self.path) as conn:
+            conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+            return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+    def refresh_snapshot(self) -> datetime:
+        """
+        Copies the database to the snapshot analytics queries read from.
+
+        The copy is made with SQLite's online backup API into a temporary
+        file, which then replaces the old snapshot, so queries still reading
+        the old one aren't disturbed. In WAL mode the backup only holds a read
+        transaction, so writers carry on while it runs.
+
+        Returns:
+            datetime: When the snapshot was taken.
+        """
+        with self._snapshot_lock:
+            begin = time.perf_counter()
+            taken = datetime.now()
+            temporary = f"{self.snapshot_path}.tmp"
+            with contextlib.closing(sqlite3.connect(self.path)) as source, \
+                    contextlib.closing(sqlite3.connect(temporary)) as target:
+                # Copy every page in one step; a copy made in several steps
+                # starts over whenever the database is written to meanwhile
+                source.backup(target)
+                # The snapshot is only ever read, so it doesn't need WAL
+                target.execute("PRAGMA journal_mode = DELETE")
+            os.replace(temporary, self.snapshot_path)
+            self._snapshot_time = taken
+            logger.info("Refreshed analytics snapshot in %.2fs",
+                        time.perf_counter() - begin)
+            return taken
+
+    @contextlib.contextmanager
+    def _analytics(self) -> typing.Iterator[
+            tuple[sqlite3.Connection, datetime]]:
+        """
+        Opens a read-only connection for a heavy analytics query.
+
+        Yields:
+            tuple[sqlite3.Connection, datetime]: The connection, and how
+                current the data it reads is.
+        """
+        if self.snapshot_age:
+            as_of = self._snapshot_time
+            if as_of is None or (datetime.now() - as_of >
+                                 timedelta(seconds=self.snapshot_age)):
+                as_of = self.refresh_snapshot()
+            path = self.snapshot_path
+        else:
+            as_of = datetime.now()
+            path = self.path
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            yield conn, as_of
+        finally:
+            conn.close()
+
     def get_activity_stats(
         self,
         member: typing.Union[discord.Member, int],
-        start: datetime = datetime.now() - timedelta(days=30)
-        ) -> dict[str, timedelta]:
+        start: datetime = None
+        ) -> AnalyticsResult:
         """
         Gets stats on the activities of the given member.
 
         This method searches the database for activity changes by the given
-        user and computes the amount of time spent in each activity.
+        user and computes the amount of time spent in each activity. It reads
+        the analytics snapshot, so it may miss the most recent changes.
 
         Args:
             member (discord.Member): The Discord member to get stats for.
-            start (datetime): The earliest activity change to get.
+            start (datetime): The earliest activity change to get. Defaults
+                to 30 days ago.
 
         Returns:
-            dict[str, timedelta]: A dictionary of activity names and
-                seconds in each.
+            AnalyticsResult: A dictionary of activity names and the time
+                spent in each, and when the data was read.
         """
-        # Get member Discord ID and convert to DB ID
+        if start is None:
+            start = datetime.now() - timedelta(days=30)
         member_id = member.id if isinstance(member, discord.Member) else member
-        member_id = self._insert_user(member_id)
         # Pull all activities for this user
-        with sqlite3.connect(self.path) as conn:
+        with self._analytics() as (conn, as_of):
             cursor = conn.cursor()
             cursor.execute("""
                 SELECT
-                    before_activity_name,
-                    after_activity_name,
-                    timestamp
+                    activity.name,
+                    activity_event.timestamp
                 FROM
-                    activity_change
+                    activity_event
+                    JOIN user ON user.id = activity_event.user_id
+                    LEFT JOIN activity
+                        ON activity.id = activity_event.activity_id
                 WHERE
-                    user_id = (?) AND
-                    timestamp > (?)
-            """, (member_id, start))
+                    user.discord_id = (?) AND
+                    activity_event.timestamp > (?)
+                ORDER BY
+                    activity_event.timestamp
+            """, (member_id, int(start.timestamp())))
             activities = cursor.fetchall()
-        # Collect activities
+        # Collect activities; each lasts until the user's next change
         activity_stats = {}
         for first, second in zip(activities, activities[1:]):
-            if first[1] == second[0]:
-                activity_name = first[1]
-                activity_time = \
-                    datetime.fromisoformat(second[2]) - \
-                    datetime.fromisoformat(first[2])
+            if first[0] is not None:
+                activity_name = first[0]
+                activity_time = timedelta(seconds=second[1] - first[1])
                 if activity_name in activity_stats:
                     activity_stats[activity_name] += activity_time
                 else:
                     activity_stats[activity_name] = activity_time
         if None in activity_stats:
             del activity_stats[None]
-        return activity_stats
+        return AnalyticsResult(activity_stats, as_of)
+
+    def get_activity_history(
+        self,
+        after: dict[str, int] = None) -> AnalyticsResult:
+        """
+        Gets raw activity changes, and the users and activities they refer to.
 
-    async def get_next_song(self, users: list[int], channels: list[int], limit: int = 100, cutoff: datetime = None):
+        This is meant for computing statistics in bulk, so rows come back as
+        plain integers in ID order, and only rows newer than those already
+        loaded are returned, so a caller can keep a copy up to date cheaply.
+
+        Args:
+            after (dict[str, int]): The highest row IDs already loaded from
+                the 'activity_event', 'user' and 'activity' tables.
+
+        Returns:
+            AnalyticsResult: A dictionary with the following keys, and when
+                the data was read.
+                'first_id': The lowest activity event ID still stored, as
+                    older ones may have been removed since.
+                'events': The ID, user ID, activity ID (0 for none) and epoch
+                    timestamp of each newer activity change.
+                'users': The Discord ID of each newer user ID.
+                'activities': The name of each newer activity ID.
+        """
+        after = after or {}
+        with self._analytics() as (conn, as_of):
+            cursor = conn.cursor()
+            cursor.execute("SELECT MIN(id) FROM activity_event")
+            first_id = cursor.fetchone()[0]
+            cursor.execute("""
+                SELECT
+                    id,
+                    user_id,
+                    COALESCE(activity_id, 0),
+                    timestamp
+                FROM
+                    activity_event
+                WHERE
+                    id > ?
+            """, (after.get("activity_event", 0),))
+            events = cursor.fetchall()
+            cursor.execute("""
+                SELECT id, discord_id FROM user WHERE id > ?
+            """, (after.get("user", 0),))
+            users = dict(cursor.fetchall())
+            cursor.execute("""
+                SELECT id, name FROM activity WHERE id > ?
+            """, (after.get("activity", 0),))
+            activities = dict(cursor.fetchall())
+        return AnalyticsResult({
+            "first_id": first_id,
+            "events": events,
+            "users": users,
+            "activities": activities,
+        }, as_of)
+
+    def get_song_play_history(self, after: int = 0) -> AnalyticsResult:
+        """
+        Gets raw song plays for building recommendations in bulk.
+
+        Args:
+            after (int): The highest song play ID already loaded.
+
+        Returns:
+            AnalyticsResult: A list of newer plays in ID order, and when the
+                data was read. Each play is its ID, channel ID, the Discord
+                ID of who asked for it (None for DJ mode), title, artist,
+                whether it finished, and epoch timestamp.
+        """
+        with self._analytics() as (conn, as_of):
+            plays = conn.execute("""
+                SELECT
+                    play.id,
+                    play.channel_id,
+                    user.discord_id,
+                    play.song_title,
+                    play.song_artist,
+                    play.finished,
+                    CAST(strftime('%s', play.timestamp) AS INTEGER)
+                FROM
+                    song_play AS play
+                    LEFT JOIN user ON user.id = play.user_id
+                WHERE
+                    play.id > ?
+                ORDER BY
+                    play.id
+            """, (after,)).fetchall()
+        return AnalyticsResult(plays, as_of)
+
+    def get_unenriched_search_terms(
+        self,
+        limit: int = 50,
+        retry_days: float = 7) -> list[str]:
+        """
+        Gets search terms of requests and plays with no title or artist.
+
+        Terms that have been looked up already are skipped, unless nothing
+        was found and that was more than 'retry_days' ago.
+
+        Args:
+            limit (int): The most search terms to return.
+            retry_days (float): Days before a failed lookup is tried again.
+
+        Returns:
+            list[str]: The search terms, usually URLs.
+        """
+        with sqlite3.connect(self.path) as conn:
+            rows = conn.execute("""
+                SELECT
+                    term.search_term
+                FROM (
+                    SELECT search_term FROM song_play
+                    WHERE song_title IS NULL
+                    UNION
+                    SELECT search_term FROM song_request
+                    WHERE song_title IS NULL
+                ) AS term
+                WHERE
+                    NOT EXISTS (
+                        SELECT 1 FROM song_metadata AS metadata
+                        WHERE
+                            metadata.search_term = term.search_term AND (
+                                metadata.song_title IS NOT NULL OR
+                                metadata.timestamp > datetime('now', ?)
+                            )
+                    )
+                LIMIT ?
+            """, (f"-{retry_days} days", limit)).fetchall()
+        return [row[0] for row in rows]
+
+    def save_song_metadata(
+        self,
+        metadata: dict[str, typing.Optional[tuple[str, str]]]) -> int:
+        """
+        Records looked up titles and artists, and fills them in on every
+        request and play of the same search term that's missing them.
+
+        Everything is written in one transaction. Calling this with nothing
+        new still fills in rows added since terms were last looked up.
+
+        Args:
+            metadata (dict[str, Optional[tuple[str, str]]]): The title and
+                artist found for each search term, or None if nothing was.
+
+        Returns:
+            int: The number of requests and plays filled in.
+        """
+        with sqlite3.connect(self.path) as conn:
+            conn.executemany("""
+                INSERT INTO song_metadata (
+                    search_term,
+                    song_title,
+                    song_artist
+                ) VALUES (
+                    ?, ?, ?
+                )
+                ON CONFLICT(search_term) DO UPDATE SET
+                    song_title = excluded.song_title,
+                    song_artist = excluded.song_artist,
+                    timestamp = CURRENT_TIMESTAMP
+            """, [
+                (term, *(found or (None, None)))
+                for term, found in metadata.items()])
+            filled = 0
+            for table in ("song_request", "song_play"):
+                filled += conn.execute(f"""
+                    UPDATE
+                        {table}
+                    SET
+                        song_title = metadata.song_title,
+                        song_artist = metadata.song_artist
+                    FROM
+                        song_metadata AS metadata
+                    WHERE
+                        {table}.song_title IS NULL AND
+                        metadata.search_term = {table}.search_term AND
+                        metadata.song_title IS NOT NULL
+                """).rowcount
+        return filled
+
+    def get_recent_songs(
+        self,
+        channels: list[int],
+        limit: int = 10,
+        finished: bool = True) -> list[dict]:
+        """
+        Gets the songs most recently played in some channels.
+
+        Args:
+            channels (list[int]): The Discord IDs of the channels.
+            limit (int): The most songs to return.
+            finished (bool): Whether to only include songs that were played
+                to the end.
+
+        Returns:
+            list[dict]: The title and artist of each song, most recent first.
+        """
+        with sqlite3.connect(self.path) as conn:
+            rows = conn.execute("""
+                SELECT
+                    song_title,
+                    song_artist
+                FROM
+                    song_play
+                WHERE
+                    channel_id IN (
+                        SELECT id FROM channel WHERE discord_id IN (%s)
+                    ) AND
+                    song_title IS NOT NULL AND
+                    (finished = 1 OR NOT ?)
+                GROUP BY
+                    song_title,
+                    song_artist
+                ORDER BY
+                    MAX(id) DESC
+                LIMIT ?
+            """ % ",".join("?" for _ in channels),
+                (*channels, finished, limit)).fetchall()
+        return [{"title": title, "artist": artist} for title, artist in rows]
+
+    def add_recommendations(self, channel_id: int, songs: list[dict]) -> int:
+        """
+        Adds songs to the end of a channel's recommendations.
+
+        Songs that are already waiting in the channel are skipped.
+
+        Args:
+            channel_id (int): The Discord ID of the channel.
+            songs (list[dict]): The 'title' and 'artist' of each song.
+
+        Returns:
+            int: The number of recommendations now waiting in the channel.
+        """
+        channel_id = self._insert_channel(channel_id)
+        with sqlite3.connect(self.path) as conn:
+            conn.executemany("""
+                INSERT INTO recommendation (
+                    channel_id,
+                    song_title,
+                    song_artist
+                ) VALUES (
+                    ?, ?, ?
+                )
+                ON CONFLICT DO NOTHING
+            """, [
+                (channel_id, song["title"], song["artist"]) for song in songs])
+            return conn.execute("""
+                SELECT COUNT(*) FROM recommendation WHERE channel_id = ?
+            """, (channel_id,)).fetchone()[0]
+
+    def get_recommendations(self, channel_id: int) -> list[dict]:
+        """
+        Gets the recommendations waiting in a channel, in the order they'll
+        be played.
+
+        Args:
+            channel_id (int): The Discord ID of the channel.
+
+        Returns:
+            list[dict]: The title and artist of each song.
+        """
+        with sqlite3.connect(self.path) as conn:
+            rows = conn.execute("""
+                SELECT
+                    song_title,
+                    song_artist
+                FROM
+                    recommendation
+                WHERE
+                    channel_id = (SELECT id FROM channel WHERE discord_id = ?)
+                ORDER BY
+                    id
+            """, (channel_id,)).fetchall()
+        return [{"title": title, "artist": artist} for title, artist in rows]
+
+    def pop_recommendation(
+        self,
+        channel_id: int) -> tuple[typing.Optional[dict], int]:
+        """
+        Takes the oldest recommendation waiting in a channel.
+
+        Args:
+            channel_id (int): The Discord ID of the channel.
+
+        Returns:
+            tuple[Optional[dict], int]: The title and artist of the song, or
+                None if there are none waiting, and the number still waiting.
+        """
+        with sqlite3.connect(self.path) as conn:
+            row = conn.execute("""
+                DELETE FROM
+                    recommendation
+                WHERE
+                    id = (
+                        SELECT MIN(id) FROM recommendation
+                        WHERE channel_id = (
+                            SELECT id FROM channel WHERE discord_id = ?
+                        )
+                    )
+                RETURNING
+                    song_title,
+                    song_artist
+            """, (channel_id,)).fetchone()
+            remaining = conn.execute("""
+                SELECT COUNT(*) FROM recommendation
+                WHERE channel_id = (SELECT id FROM channel WHERE discord_id = ?)
+            """, (channel_id,)).fetchone()[0]
+        song = {"title": row[0], "artist": row[1]} if row else None
+        return song, remaining
+
+    async def get_next_song(
+        self,
+        users: list[int],
+        channels: list[int],
+        limit: int = 100,
+        cutoff: datetime = None,
+        channel: int = None,
+        recommender: "recommendations.Recommender" = None):
+        """
+        Picks a song for DJ mode.
+
+        Songs that go with the latest plays and the members listening are
+        picked first. Failing that, songs the members have finished before
+        in the server are picked at random. Songs played recently are
+        skipped. When there are none left, the next of the channel's
+        recommendations is played instead.
+
+        Args:
+            users (list[int]): The Discord IDs of the members listening.
+            channels (list[int]): The Discord IDs of the server's channels.
+            limit (int): The most of the members' songs to pick from.
+            cutoff (datetime): Songs played since this aren't picked.
+                Defaults to an hour ago.
+            channel (int): The Discord ID of the player's text channel.
+            recommender (recommendations.Recommender): Where recommendations
+                come from.
+
+        Returns:
+            music_player.YTDLSource: The song to play, or None if there isn't
+                one.
+        """
         
         _cutoff = datetime.now() - timedelta(hours=1) if not cutoff else cutoff
 
-        print("users:", users)
-        print("channels:", channels)
+        logger.debug("Picking a song for users %s in channels %s", users, channels)
 
         # Convert user IDs to row IDs
         with sqlite3.connect(self.path) as conn:
@@ -473,7 +1861,7 @@ class Database:
 
         # Compile results into cleaner list of dicts
         candidates = [{"title": t, "artist": a, "plays": p} for t, a, p in old_song_plays]
-        print("candidates:", candidates)
+        logger.debug("Candidates: %s", candidates)
 
         # Get recent song plays
         logger.info("Getting recent song plays")
@@ -494,66 +1882,38 @@ class Database:
                     song_artist;
             """ % (",".join(str(id) for id in channel_ids)), (_cutoff, ))
             recent_song_plays = cursor.fetchall()
-        print("recent:", recent_song_plays)
+        logger.debug("Recently played: %s", recent_song_plays)
 
         # Remove all songs that were recently played
         def keep(song_play: dict[str, str, int]):
             return not (song_play["title"], song_play["artist"]) in recent_song_plays
         candidates = list(filter(keep, candidates))
-        print("filtered candidates:", candidates)
+        logger.debug("Candidates not recently played: %s", candidates)
 
-        if len(candidates) > 0:
+        candidate = None
+        if recommender is not None:
+            try:
+                candidate = await recommender.similar(
+                    channel, users,
+                    [{"title": t, "artist": a}
+                     for t, a in recent_song_plays if t is not None])
+            except Exception:
+                logger.exception("Couldn't find a similar song")
+
+        if candidate is not None:
+            pass
+        elif len(candidates) > 0:
             candidate = random.choice(candidates)
-        # If we have no songs left to play, get a recommendation from ChatGPT
+        # If we have no songs left to play, use a recommendation
+        elif recommender is not None:
+            candidate = await recommender.next(channel, channels)
+            if candidate is None:
+                return None
         else:
-
-            # Get last five or so completed song plays
-            with sqlite3.connect(self.path) as conn:
-                cursor = conn.cursor()
-                # Get recent songs to avoid
-                cursor.execute("""
-                    SELECT
-                        song_title,
-                        song_artist
-                    FROM
-                        song_play
-                    WHERE
-                        channel_id IN (%s) AND
-                        finished = 1
-                    GROUP BY
-                        song_title,
-                        song_artist
-                    ORDER BY
-                        timestamp DESC
-                    LIMIT 5;
-                """ % (",".join(str(id) for id in channel_ids)))
-                last_five = cursor.fetchall()
-
-                print("last five song plays:", last_five)
-
-            setup_prompt = "I'm going to give you a list of songs and artists "\
-                           "formatted as a Python list of dicts where the "\
-                           "song title is the 'title' key and the artist is "\
-                           "the 'artist' key. I want you to return a song "\
-                           "title and artist that you would recommend based "\
-                           "on the given songs. Don't be afraid to branch out "\
-                           "and vary songs; the same artist should not be "\
-                           "repeated more than twice. You should give me only a bare text "\
-                           "string formatted as a Python dict where the "\
-                           "'title' key is the song title, and the 'artist' "\
-                           "key is the song's artist. Don't add anything other "\
-                           "than this dict."
-            user_prompt = []
-            completion = openai.OpenAI().chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": setup_prompt},
-                    {"role": "user", "content": str(last_five)}
-                ]
-            )
-            candidate = eval(completion.choices[0].message.content)
+            return None
 
         # Construct new source based on this song choice
+        from cogs import music_player
         source = await music_player.YTDLSource.create(f"{candidate["title"]} {candidate["artist"]}")
         source.song_title = candidate["title"]
         source.artist = candidate["artist"]
@@ -0,0 +1,197 @@
+"""
+Fills in the title and artist of songs that were played from a URL.
+
+Songs searched for by name get their title and artist from LastFM before they
+play, but songs played straight from a URL don't, so they're left out of DJ
+mode, stats and history search. Rather than slow down playing them, the
+enrichment job looks them up later, a batch at a time:
+
+1. The video's own metadata, which names the track and artist for most
+   music on YouTube.
+2. Otherwise, LastFM's best match for the video's title, with the usual
+   '(Official Video)' style noise taken out.
+3. Otherwise, the title itself if it looks like 'Artist - Title'.
+
+Every lookup is remembered in the 'song_metadata' table, found or not, so
+each URL is only looked up once however many times it's played, and
+lookups are rate limited so a backlog doesn't hammer either service.
+
+Settings are read from the environment:
+
+    ENRICHMENT_RATE        Lookups per minute. Defaults to 30.
+    ENRICHMENT_BATCH_SIZE  Search terms looked up per run. Defaults to 50.
+    ENRICHMENT_RETRY_DAYS  Days before a lookup that found nothing is tried
+                           again. Defaults to 7.
+"""
+
+import asyncio
+import logging
+import os
+import re
+import typing
+
+import database
+import metrics
+import scheduler
+
+logger = logging.getLogger("enrichment")
+
+# Seconds a single LastFM request may take
+LASTFM_TIMEOUT = 10
+
+# Bracketed parts of video titles that aren't part of the song's name
+TITLE_NOISE = re.compile(
+    r"\s*[(\[][^)\]]*\b(official|video|audio|lyrics?|hd|hq|4k|visuali[sz]er"
+    r"|remaster(ed)?|mv|m/v)\b[^)\]]*[)\]]",
+    re.IGNORECASE)
+
+# Separators between artist and title in video titles
+TITLE_SEPARATOR = re.compile(r"\s+[-–—|]\s+")
+
+
+def clean_title(title: str) -> str:
+    """
+    Strips the noise that uploaders add to video titles.
+
+    Examples:
+        >>> clean_title("Daft Punk - One More Time (Official Video) [HD]")
+        'Daft Punk - One More Time'
+    """
+    return " ".join(TITLE_NOISE.sub("", title).split())
+
+
+def split_title(title: str) -> typing.Optional[tuple[str, str]]:
+    """
+    Splits a video title of the form 'Artist - Title'.
+
+    Returns:
+        Optional[tuple[str, str]]: The title and artist, or None if the
+            title isn't in that form.
+    """
+    parts = TITLE_SEPARATOR.split(clean_title(title), maxsplit=1)
+    if len(parts) != 2 or not all(parts):
+        return None
+    artist, song_title = parts
+    return song_title.strip(' "\''), artist
+
+
+class Enricher:
+    """
+    Looks up the title and artist of songs that are missing them.
+
+    Examples:
+        >>> enricher = Enricher(db)
+        >>> await enricher.run()
+        50
+    """
+
+    def __init__(
+        self,
+        db: database.Database,
+        rate: float = 30,
+        batch_size: int = 50,
+        retry_days: float = 7):
+        self.db = db
+        self.batch_size = batch_size
+        self.retry_days = retry_days
+        self._bucket = scheduler.TokenBucket(rate / 60, 1)
+
+    @classmethod
+    def from_env(cls, db: database.Database) -> "Enricher":
+        """Creates an enricher using the settings in the environment."""
+        return cls(
+            db,
+            rate=float(os.getenv("ENRICHMENT_RATE", "30")),
+            batch_size=int(os.getenv("ENRICHMENT_BATCH_SIZE", "50")),
+            retry_days=float(os.getenv("ENRICHMENT_RETRY_DAYS", "7")))
+
+    def _lastfm(self, title: str) -> typing.Optional[tuple[str, str]]:
+        """Gets LastFM's best match for a title, if there's a key to ask."""
+        api_key = os.getenv("LASTFM_API_KEY")
+        if not api_key:
+            return None
+        import requests
+        with metrics.LASTFM_SECONDS.time():
+            response = requests.get(
+                "http://ws.audioscrobbler.com/2.0/",
+                params={
+                    "method": "track.search",
+                    "track": title,
+                    "api_key": api_key,
+                    "format": "json",
+                    "limit": 1,
+                },
+                timeout=LASTFM_TIMEOUT)
+        response.raise_for_status()
+        data = response.json()
+        if "error" in data:
+            raise RuntimeError(
+                f"LastFM returned error code '{data['error']}': "
+                f"{data.get('message')}")
+        tracks = data.get("results", {}).get("trackmatches", {}).get("track")
+        if not tracks:
+            return None
+        return tracks[0]["name"], tracks[0]["artist"]
+
+    def lookup(self, search_term: str) -> typing.Optional[tuple[str, str]]:
+        """
+        Finds the title and artist of a song.
+
+        This blocks on the network, so run it in an executor.
+
+        Args:
+            search_term (str): What was played, usually a URL.
+
+        Returns:
+            Optional[tuple[str, str]]: The title and artist, or None if
+                nothing was found.
+        """
+        import validators
+        if not validators.url(search_term):
+            return self._lastfm(search_term)
+
+        from cogs import music_player
+        info = music_player.YTDLSource.downloader().extract_info(
+            search_term, download=False, process=False)
+        if info and "entries" in info:
+            info = next(iter(info["entries"]), None)
+        if not info:
+            return None
+        artist = info.get("artist") or info.get("creator")
+        if info.get("track") and artist:
+            # Several artists come comma separated; the first is the main one
+            return info["track"], artist.split(",")[0].strip()
+        title = info.get("title")
+        if not title:
+            return None
+        return self._lastfm(clean_title(title)) or split_title(title)
+
+    async def run(self) -> int:
+        """
+        Looks up a batch of search terms and fills in their songs.
+
+        Returns:
+            int: The number of search terms looked up. Fewer than the batch
+                size means there are none left.
+        """
+        loop = asyncio.get_running_loop()
+        terms = await loop.run_in_executor(
+            None, self.db.get_unenriched_search_terms, self.batch_size,
+            self.retry_days)
+        found = {}
+        for term in terms:
+            while wait := self._bucket.wait_time():
+                await asyncio.sleep(wait)
+            self._bucket.take()
+            try:
+                found[term] = await loop.run_in_executor(
+                    None, self.lookup, term)
+            except Exception as e:
+                logger.warning("Couldn't look up '%s': %s", term, e)
+                found[term] = None
+        filled = await loop.run_in_executor(
+            None, self.db.save_song_metadata, found)
+        logger.info(
+            "Looked up %d search terms, found %d, filled in %d songs",
+            len(terms), sum(1 for value in found.values() if value), filled)
+        return len(terms)
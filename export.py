@@ -0,0 +1,140 @@
+"""
+Exports the bot's history tables for offline analysis.
+
+Rows are streamed out of the database in fixed-size batches and written as
+they arrive, so exporting a table of any size takes the same small amount of
+memory, and the bot can keep running and writing while it happens.
+
+CSV needs nothing extra. Parquet needs 'pyarrow', which is only imported when
+it's used.
+
+Examples:
+    $ python __main__.py --export song_play --output plays.csv
+    $ python __main__.py --export activity_event --output activity.parquet \\
+          --since 2025-01-01 --until 2025-07-01
+    $ python __main__.py --export song_request --output requests.csv \\
+          --guild 850610922256442889
+"""
+
+import csv
+import logging
+from datetime import datetime, timezone
+
+import database
+
+logger = logging.getLogger("export")
+
+# Rows read from the database and written at a time
+BATCH_SIZE = 10000
+
+FORMATS = ("csv", "parquet")
+
+
+def _format_time(timestamp: int) -> str:
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+
+
+def write_csv(path: str, columns: list[tuple[str, str]], batches) -> int:
+    """
+    Writes batches of rows to a CSV file, with times in ISO 8601.
+
+    Returns:
+        int: The number of rows written.
+    """
+    times = [i for i, (_, kind) in enumerate(columns) if kind == "time"]
+    count = 0
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(name for name, _ in columns)
+        for rows in batches:
+            if times:
+                rows = [list(row) for row in rows]
+                for row in rows:
+                    for i in times:
+                        row[i] = _format_time(row[i])
+            writer.writerows(rows)
+            count += len(rows)
+    return count
+
+
+def write_parquet(path: str, columns: list[tuple[str, str]], batches) -> int:
+    """
+    Writes batches of rows to a Parquet file, one row group per batch.
+
+    Returns:
+        int: The number of rows written.
+
+    Raises:
+        RuntimeError: If 'pyarrow' isn't installed.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError(
+            "Exporting to Parquet needs pyarrow; run 'pip install pyarrow'")
+
+    types = {
+        "int": pa.int64(),
+        "str": pa.string(),
+        "bool": pa.bool_(),
+        "time": pa.timestamp("s", tz="UTC"),
+    }
+    schema = pa.schema([(name, types[kind]) for name, kind in columns])
+    count = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for rows in batches:
+            arrays = [
+                pa.array(values, type=pa.int64()).cast(field.type)
+                if field.type != pa.string() else pa.array(values, field.type)
+                for values, field in zip(zip(*rows), schema)]
+            writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+            count += len(rows)
+    return count
+
+
+def export(
+    db: database.Database,
+    table: str,
+    path: str,
+    format: str = None,
+    since: datetime = None,
+    until: datetime = None,
+    server_id: int = None,
+    batch_size: int = BATCH_SIZE) -> int:
+    """
+    Exports a table to a file.
+
+    Args:
+        db (database.Database): The database to export from.
+        table (str): One of the tables in 'database.EXPORT_TABLES'.
+        path (str): The file to write.
+        format (str): Either 'csv' or 'parquet'. Defaults to the file's
+            extension.
+        since (datetime): Only export rows recorded at or after this.
+        until (datetime): Only export rows recorded before this.
+        server_id (int): Only export rows from this Discord server.
+        batch_size (int): The number of rows to read and write at a time.
+
+    Returns:
+        int: The number of rows exported.
+
+    Raises:
+        ValueError: If the table, format or filters aren't supported.
+    """
+    if table not in database.EXPORT_TABLES:
+        raise ValueError(
+            f"Can't export '{table}'; choose from "
+            + ", ".join(database.EXPORT_TABLES))
+    format = (format or path.rsplit(".", 1)[-1]).lower()
+    if format not in FORMATS:
+        raise ValueError(f"Can't export to '{format}'; use csv or parquet")
+
+    columns, _ = database.EXPORT_TABLES[table]
+    batches = db.export_rows(table, since, until, server_id, batch_size)
+    writer = write_csv if format == "csv" else write_parquet
+    count = writer(path, columns, batches)
+    logger.info("Exported %d rows from '%s' to '%s'", count, table, path)
+    return count
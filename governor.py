@@ -0,0 +1,236 @@
+"""
+Host-wide admission control for FFmpeg streams.
+
+Every song that plays is decoded by its own FFmpeg process. Without a limit,
+an overloaded host degrades every stream at once, so the governor admits new
+streams only while the host stays under the configured limits and makes the
+rest wait their turn, or refuses them.
+
+Limits are read from the environment:
+
+    FFMPEG_MAX_STREAMS   Maximum number of concurrent FFmpeg processes.
+    FFMPEG_MAX_CPU       Maximum combined CPU use of FFmpeg, in percent of
+                         one core (e.g. 400 for four full cores).
+    FFMPEG_MAX_RSS_MB    Maximum combined resident memory of FFmpeg, in MB.
+    FFMPEG_ADMIT_WAIT    Seconds a song may wait for capacity before it is
+                         refused. Defaults to 60.
+
+Any limit that is unset is not enforced.
+"""
+
+import asyncio
+import collections
+import logging
+import os
+import time
+
+from discord.ext import commands
+
+logger = logging.getLogger("governor")
+
+# Clock ticks per second and page size, used to read /proc
+_CLK_TCK = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+# Least seconds between CPU samples of a process. CPU time only advances in
+# clock ticks, so rates measured over shorter spans are mostly noise
+CPU_SAMPLE_INTERVAL = 1.0
+
+
+class AdmissionRefused(commands.CommandError):
+    """Raised when a stream can't be admitted within the wait limit."""
+
+
+class Slot:
+    """
+    A stream admitted by the governor.
+
+    The audio source is attached once playback starts so that the governor
+    can find its FFmpeg process. Sources expose the process ID through a 'pid'
+    attribute, which may be None until the process exists.
+    """
+
+    __slots__ = ("guild_id", "audio", "admitted_at")
+
+    def __init__(self, guild_id: int):
+        self.guild_id = guild_id
+        self.audio = None
+        self.admitted_at = time.monotonic()
+
+    @property
+    def pid(self) -> int:
+        return getattr(self.audio, "pid", None)
+
+
+class ResourceGovernor:
+    """
+    Tracks active FFmpeg processes and admits new ones within host limits.
+
+    Examples:
+        >>> governor = ResourceGovernor(max_streams=20)
+        >>> slot = await governor.acquire(guild.id)
+        >>> slot.audio = source.open()
+        >>> ...
+        >>> governor.release(slot)
+    """
+
+    def __init__(
+        self,
+        max_streams: int = None,
+        max_cpu: float = None,
+        max_rss_mb: float = None,
+        wait: float = 60):
+        self.max_streams = max_streams
+        self.max_cpu = max_cpu
+        self.max_rss_mb = max_rss_mb
+        self.wait = wait
+        self._slots = set()
+        self._waiters = collections.deque()
+        self._changed = asyncio.Event()
+        # Last CPU samples, by PID, as (cpu ticks, wall time, CPU percent
+        # measured up to then)
+        self._cpu_samples = {}
+
+    @classmethod
+    def from_env(cls) -> "ResourceGovernor":
+        """Creates a governor using the limits set in the environment."""
+        def env(name, cast):
+            value = os.getenv(name)
+            return cast(value) if value else None
+        return cls(
+            max_streams=env("FFMPEG_MAX_STREAMS", int),
+            max_cpu=env("FFMPEG_MAX_CPU", float),
+            max_rss_mb=env("FFMPEG_MAX_RSS_MB", float),
+            wait=env("FFMPEG_ADMIT_WAIT", float) or 60)
+
+    @property
+    def processes(self) -> int:
+        """The number of admitted streams whose FFmpeg process is running."""
+        return sum(1 for slot in self._slots if slot.pid)
+
+    def _sample(self, pid: int) -> tuple[float, float]:
+        """
+        Returns the CPU percent and RSS in MB of a process.
+
+        The CPU percent is measured over at least 'CPU_SAMPLE_INTERVAL'
+        seconds; checks in between get the last rate measured, which is 0
+        until a process has been sampled for that long.
+        """
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                # The command name may contain spaces, so split after it
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{pid}/statm") as f:
+                rss_pages = int(f.read().split()[1])
+        except (OSError, IndexError, ValueError):
+            self._cpu_samples.pop(pid, None)
+            return 0.0, 0.0
+        ticks = int(fields[11]) + int(fields[12])     # utime + stime
+        now = time.monotonic()
+        rss = rss_pages * _PAGE_SIZE / 2**20
+        if pid not in self._cpu_samples:
+            self._cpu_samples[pid] = (ticks, now, 0.0)
+            return 0.0, rss
+        last_ticks, last_now, cpu = self._cpu_samples[pid]
+        elapsed = now - last_now
+        if elapsed >= CPU_SAMPLE_INTERVAL:
+            cpu = (ticks - last_ticks) / _CLK_TCK / elapsed * 100
+            self._cpu_samples[pid] = (ticks, now, cpu)
+        return cpu, rss
+
+    def usage(self) -> dict[str, float]:
+        """
+        Measures what the active FFmpeg processes are using right now.
+
+        Returns:
+            dict[str, float]: The number of streams, their combined CPU use
+                in percent of one core, and their combined RSS in MB.
+        """
+        cpu = rss = 0.0
+        pids = {slot.pid for slot in self._slots if slot.pid}
+        for pid in pids:
+            pid_cpu, pid_rss = self._sample(pid)
+            cpu += pid_cpu
+            rss += pid_rss
+        # Forget processes that have gone away
+        for pid in set(self._cpu_samples) - pids:
+            del self._cpu_samples[pid]
+        return {"streams": len(self._slots), "cpu": cpu, "rss_mb": rss}
+
+    def headroom(self) -> dict[str, float]:
+        """
+        Reports how much of each limit is still available.
+
+        Returns:
+            dict[str, float]: The remaining streams, CPU percent and RSS in MB
+                before each limit is hit. Limits that aren't set are None.
+        """
+        usage = self.usage()
+        def left(limit, used):
+            return None if limit is None else max(limit - used, 0)
+        return {
+            "streams": left(self.max_streams, usage["streams"]),
+            "cpu": left(self.max_cpu, usage["cpu"]),
+            "rss_mb": left(self.max_rss_mb, usage["rss_mb"]),
+            "waiting": len(self._waiters),
+        }
+
+    def has_capacity(self) -> bool:
+        """Returns whether a new stream would be admitted right now."""
+        headroom = self.headroom()
+        if headroom["streams"] is not None and headroom["streams"] < 1:
+            return False
+        if headroom["cpu"] is not None and headroom["cpu"] <= 0:
+            return False
+        if headroom["rss_mb"] is not None and headroom["rss_mb"] <= 0:
+            return False
+        return True
+
+    async def acquire(self, guild_id: int) -> Slot:
+        """
+        Waits for capacity to play a new stream.
+
+        Waiting streams are admitted in the order they arrived.
+
+        Args:
+            guild_id (int): The guild the stream will play in.
+
+        Returns:
+            Slot: The admitted stream. It must be passed to 'release()' once
+                the stream stops.
+
+        Raises:
+            AdmissionRefused: If there's no capacity within the wait limit.
+        """
+        ticket = object()
+        self._waiters.append(ticket)
+        deadline = time.monotonic() + self.wait
+        try:
+            while not (self._waiters[0] is ticket and self.has_capacity()):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.warning(
+                        "Refused stream for guild %d: %s",
+                        guild_id, self.usage())
+                    raise AdmissionRefused(
+                        "The bot is playing in too many servers right now. "
+                        "Please try again in a few minutes.")
+                # CPU and memory change without any slot being released, so
+                # check again every so often as well
+                self._changed.clear()
+                try:
+                    await asyncio.wait_for(
+                        self._changed.wait(), min(remaining, 1.0))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._waiters.remove(ticket)
+            self._changed.set()
+        slot = Slot(guild_id)
+        self._slots.add(slot)
+        return slot
+
+    def release(self, slot: Slot):
+        """Frees the capacity used by a stream."""
+        self._slots.discard(slot)
+        self._changed.set()
@@ -0,0 +1,97 @@
+"""
+Reports how long the bot's modules take to import.
+
+Everything imported at startup delays connecting to the gateway, so heavy
+dependencies are imported lazily where possible. This measures what's left
+by importing the bot's modules in a fresh interpreter with '-X importtime',
+and can fail when the total goes over a budget.
+
+Examples:
+    $ python __main__.py --import-report
+    $ python __main__.py --import-report --import-budget 800
+"""
+
+import os
+import subprocess
+import sys
+
+# The directory the bot lives in
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# Number of the slowest individual modules to list
+SLOWEST = 15
+
+
+def startup_modules() -> list[str]:
+    """Returns the project modules the bot imports when it starts."""
+    cogs = sorted(
+        f"cogs.{filename[:-3]}"
+        for filename in os.listdir(os.path.join(DIRECTORY, "cogs"))
+        if filename.endswith(".py"))
+    return [
+        "database", "enrichment", "governor", "logs", "metrics", "presence",
+        "recommendations", "scheduler", "tracing", "voice_workers"] + cogs
+
+
+def measure(modules: list[str]) -> list[tuple[str, int, float, float]]:
+    """
+    Imports the given modules in a new interpreter and times each import.
+
+    Args:
+        modules (list[str]): The modules to import.
+
+    Returns:
+        list[tuple[str, int, float, float]]: One entry per imported module,
+            in import order, with its name, how deeply nested the import was,
+            and the time spent on it in milliseconds, both on its own and
+            including the modules it imported.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c",
+         "; ".join(f"import {module}" for module in modules)],
+        cwd=DIRECTORY, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        entries.append((
+            name.strip(), depth,
+            int(self_us) / 1000, int(cumulative_us) / 1000))
+    return entries
+
+
+def report(budget_ms: float = None) -> int:
+    """
+    Prints the import cost of the bot's startup modules.
+
+    Args:
+        budget_ms (float): The most time importing may take in total, in
+            milliseconds.
+
+    Returns:
+        int: The exit code; 1 if the budget was exceeded, otherwise 0.
+    """
+    entries = measure(startup_modules())
+    top_level = sorted(
+        (e for e in entries if e[1] == 0), key=lambda e: e[3], reverse=True)
+    total = sum(e[3] for e in top_level)
+
+    print("Top-level imports (cumulative ms):")
+    for name, _, _, cumulative in top_level:
+        if cumulative >= 1:
+            print(f"  {cumulative:9.1f}  {name}")
+    print(f"\nSlowest {SLOWEST} modules (self ms):")
+    for name, _, self_ms, _ in sorted(
+            entries, key=lambda e: e[2], reverse=True)[:SLOWEST]:
+        print(f"  {self_ms:9.1f}  {name}")
+    print(f"\nTotal: {total:.1f} ms")
+
+    if budget_ms is not None and total > budget_ms:
+        print(f"Over the import budget of {budget_ms:.0f} ms")
+        return 1
+    return 0
@@ -0,0 +1,215 @@
+"""
+Logging for the bot.
+
+Writing log lines to stdout blocks, so doing it on the event loop stalls
+everything else the bot is doing whenever the output is slow. Instead, log
+records are put on a queue as they're logged, and a background thread
+formats and writes them.
+
+Each record is written as one JSON object per line, with the ID of the
+server and of the command or event it came from, so the logs of a busy bot
+can be filtered and followed. The IDs come from context variables, which
+are set once at the start of each command, event or player, and then apply
+to everything logged while handling it, in that task only.
+
+Some events, such as presence updates, can happen hundreds of times a
+second. Debug and info records from each line of code are rate limited, and
+the next record that gets through from that line says how many were dropped.
+
+Settings are read from the environment:
+
+    LOG_LEVEL       Lowest level logged. Defaults to INFO.
+    LOG_FORMAT      'json', or 'text' for the old human readable lines.
+                    Defaults to json.
+    LOG_RATE        Debug and info records allowed per second from each line
+                    of code. Defaults to 5.
+    LOG_BURST       Records allowed at once from each line of code after it's
+                    been quiet. Defaults to 20.
+    LOG_QUEUE_SIZE  Records waiting to be written before new ones are
+                    dropped. Defaults to 10000.
+
+Examples:
+    >>> logs.setup()
+    >>> logs.guild_id.set(guild.id)
+    >>> logger.info("Playing %s", song)
+    {"time": "...", "level": "INFO", "logger": "music_player",
+     "message": "Playing 'Teardrop' by Massive Attack", "guild_id": 85061...}
+"""
+
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+# The server, and the command or event, that whatever's being logged is for
+guild_id = contextvars.ContextVar("guild_id", default=None)
+request_id = contextvars.ContextVar("request_id", default=None)
+
+TEXT_FORMAT = "[%(asctime)s] [%(levelname)s] [%(name)s] %(message)s"
+
+# Attributes every log record has, so anything else was passed in 'extra'
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord(
+    "", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+# The background writer, once 'setup' has started it
+_listener = None
+
+
+class ContextFilter(logging.Filter):
+    """
+    Adds the current server and request IDs to records.
+
+    This has to run where the record is logged, not in the writer thread,
+    which doesn't share the context.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.guild_id = guild_id.get()
+        record.request_id = request_id.get()
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Limits how often records are logged from each line of code.
+
+    Warnings and worse are always logged.
+
+    Args:
+        rate (float): Records allowed per second from each line.
+        burst (int): Records allowed at once after a line has been quiet.
+    """
+
+    def __init__(self, rate: float = 5, burst: int = 20):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        # Tokens left, when they were counted, and records dropped, by line
+        self._lines = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated, dropped = self._lines.get(
+                key, (self.burst, now, 0))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self._lines[key] = (tokens, now, dropped + 1)
+                return False
+            self._lines[key] = (tokens - 1, now, 0)
+        if dropped:
+            record.dropped = dropped
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as a single line of JSON."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": datetime.fromtimestamp(
+                record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        # Anything passed in 'extra', and the IDs from 'ContextFilter'
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and value is not None:
+                data[key] = value
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data["exception"] = record.exc_text
+        if record.stack_info:
+            data["stack"] = record.stack_info
+        return json.dumps(data, default=str, ensure_ascii=False)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records on a bounded queue, dropping them rather than waiting when
+    it's full.
+    """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+        self._exceptions = logging.Formatter()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The message and traceback are rendered here, while the arguments
+        # and frames are still what they were when it was logged, but are
+        # kept apart so the writer can put them in separate fields
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self._exceptions.formatException(record.exc_info)
+            record.exc_info = None
+        if self.dropped:
+            record.queue_dropped, self.dropped = self.dropped, 0
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup(level: str = None, format: str = None):
+    """
+    Sends every log record through a queue to a background writer.
+
+    The writer is stopped, writing whatever's left, when the interpreter
+    exits, or when 'shutdown' is called.
+
+    Args:
+        level (str): The lowest level to log. Defaults to LOG_LEVEL.
+        format (str): 'json' or 'text'. Defaults to LOG_FORMAT.
+    """
+    global _listener
+    shutdown()
+    level = (level or os.getenv("LOG_LEVEL", "INFO")).upper()
+    format = (format or os.getenv("LOG_FORMAT", "json")).lower()
+
+    records = queue.Queue(int(os.getenv("LOG_QUEUE_SIZE", "10000")))
+    handler = DroppingQueueHandler(records)
+    handler.addFilter(ContextFilter())
+    handler.addFilter(RateLimitFilter(
+        float(os.getenv("LOG_RATE", "5")), int(os.getenv("LOG_BURST", "20"))))
+
+    writer = logging.StreamHandler(sys.stdout)
+    writer.setFormatter(
+        JsonFormatter() if format == "json" else logging.Formatter(TEXT_FORMAT))
+    _listener = logging.handlers.QueueListener(
+        records, writer, respect_handler_level=True)
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.setLevel(level)
+    root.addHandler(handler)
+    _listener.start()
+
+
+@atexit.register
+def shutdown():
+    """Stops the background writer once it has written what's queued."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
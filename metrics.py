@@ -0,0 +1,456 @@
+"""
+Metrics about where the bot spends its time.
+
+Metrics are kept in memory and served over HTTP in the Prometheus text
+format, so they can be scraped by Prometheus, or just read with curl, without
+running anything else:
+
+    $ curl localhost:9108/metrics
+    # HELP bot_db_call_seconds Time taken by each database call.
+    # TYPE bot_db_call_seconds histogram
+    bot_db_call_seconds_bucket{method="get_next_song",le="0.005"} 12
+    ...
+
+Every metric the bot reports is defined at the bottom of this module, so
+they're all in one place. Counters, gauges and histograms can be updated
+from any thread, including executors.
+
+Settings are read from the environment:
+
+    METRICS_HOST  Address to serve metrics on. Defaults to 127.0.0.1, so
+                  they're only reachable from the host itself.
+    METRICS_PORT  Port to serve metrics on, or 0 to not serve them.
+                  Defaults to 9108.
+"""
+
+import asyncio
+import functools
+import inspect
+import logging
+import math
+import os
+import threading
+import time
+import typing
+
+logger = logging.getLogger("metrics")
+
+# Prefix of every metric's name
+NAMESPACE = "bot"
+
+# Upper bounds of histogram buckets, in seconds
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, math.inf)
+
+# Seconds between event loop lag measurements
+LAG_INTERVAL = 0.5
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace(
+        "\n", "\\n")
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    """
+    A named series of values, one per combination of label values.
+
+    Args:
+        name (str): The metric's name, without the namespace.
+        help (str): What the metric measures.
+        labels (tuple[str]): The names of the metric's labels.
+    """
+
+    type = None
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = f"{NAMESPACE}_{name}"
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labels):
+            raise ValueError(
+                f"'{self.name}' has labels {self.labels}, "
+                f"got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self) -> typing.Iterator[tuple[str, str, float]]:
+        """Yields the name suffix, labels and value of every sample."""
+        with self._lock:
+            values = dict(self._values)
+        for key, value in values.items():
+            yield "", _format_labels(self.labels, key), value
+
+    def render(self) -> list[str]:
+        """Returns the metric in the Prometheus text format."""
+        lines = [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append(
+                f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    """A value that only goes up, such as a number of events."""
+
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down, such as a queue's length.
+
+    Instead of being set, a gauge can be given a function that reads its
+    values whenever metrics are collected.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        super().__init__(name, help, labels)
+        self._function = None
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function: typing.Callable[[], typing.Any]):
+        """
+        Reads the gauge from a function instead.
+
+        Args:
+            function (Callable): Returns the value, or for a gauge with
+                labels, a dict of values by tuples of label values. It's
+                called on the event loop, so it mustn't block.
+        """
+        self._function = function
+
+    def samples(self):
+        if self._function is None:
+            yield from super().samples()
+            return
+        try:
+            values = self._function()
+        except Exception:
+            logger.exception("Couldn't collect '%s'", self.name)
+            return
+        if not self.labels:
+            values = {(): values}
+        for key, value in values.items():
+            yield "", _format_labels(self.labels, key), value
+
+
+class Histogram(Metric):
+    """
+    Counts of values, usually durations, falling under each of a few bounds.
+
+    Args:
+        buckets (tuple[float]): The upper bound of each bucket, ending with
+            infinity.
+    """
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple = (),
+        buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(
+                key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def time(self, **labels):
+        """
+        Times a block of code, or every call of a function or coroutine.
+
+        Examples:
+            >>> with LASTFM_SECONDS.time():
+            ...     response = requests.get(url)
+
+            >>> @YTDL_SECONDS.time(call="create")
+            ... async def create(cls, search):
+        """
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            values = {
+                key: (list(counts), total)
+                for key, (counts, total) in self._values.items()}
+        for key, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield "_bucket", _format_labels(
+                    self.labels, key, f'le="{_format_value(bound)}"'), \
+                    cumulative
+            labels = _format_labels(self.labels, key)
+            yield "_sum", labels, total
+            yield "_count", labels, cumulative
+
+
+class _Timer:
+    """Observes how long it's used for; see 'Histogram.time()'."""
+
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(
+            time.perf_counter() - self._start, **self.labels)
+
+    def __call__(self, function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    self.histogram.observe(
+                        time.perf_counter() - start, **self.labels)
+        else:
+            @functools.wraps(function)
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.histogram.observe(
+                        time.perf_counter() - start, **self.labels)
+        return timed
+
+
+class Registry:
+    """The metrics that are served, by name."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        """
+        Adds a metric, or returns the one already registered by its name.
+
+        Raises:
+            ValueError: If a different kind of metric has the name.
+        """
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is None:
+                self._metrics[metric.name] = metric
+                return metric
+        if type(existing) is not type(metric) \
+                or existing.labels != metric.labels:
+            raise ValueError(f"'{metric.name}' is already registered")
+        return existing
+
+    def render(self) -> str:
+        """Returns every metric in the Prometheus text format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, help: str, labels: tuple = ()) -> Counter:
+    """Creates and registers a counter."""
+    return REGISTRY.register(Counter(name, help, labels))
+
+
+def gauge(name: str, help: str, labels: tuple = ()) -> Gauge:
+    """Creates and registers a gauge."""
+    return REGISTRY.register(Gauge(name, help, labels))
+
+
+def histogram(
+    name: str,
+    help: str,
+    labels: tuple = (),
+    buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+    """Creates and registers a histogram."""
+    return REGISTRY.register(Histogram(name, help, labels, buckets))
+
+
+def time_methods(histogram: Histogram, label: str = "method"):
+    """
+    Class decorator that times every public method of a class.
+
+    Args:
+        histogram (Histogram): Where the times go.
+        label (str): The histogram's label for the method's name.
+    """
+    def decorate(cls):
+        for name, value in list(vars(cls).items()):
+            if not name.startswith("_") and inspect.isfunction(value):
+                setattr(cls, name, histogram.time(**{label: name})(value))
+        return cls
+    return decorate
+
+
+async def _handle(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter):
+    try:
+        request = await reader.readuntil(b"\r\n\r\n")
+        method, path, *_ = request.decode("latin-1").split(" ", 2)
+        if method == "GET" and path.split("?")[0] in ("/", "/metrics"):
+            status = "200 OK"
+            body = REGISTRY.render().encode()
+        else:
+            status = "404 Not Found"
+            body = b"Not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+            ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _watch_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LAG_INTERVAL)
+        lag = max(loop.time() - start - LAG_INTERVAL, 0)
+        LOOP_LAG_SECONDS.observe(lag)
+
+
+class Exporter:
+    """
+    Serves the metrics over HTTP, and measures event loop lag.
+
+    Examples:
+        >>> exporter = Exporter.from_env()
+        >>> await exporter.start()
+        >>> ...
+        >>> exporter.close()
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 9108):
+        self.host = host
+        self.port = port
+        self._server = None
+        self._lag_task = None
+
+    @classmethod
+    def from_env(cls) -> "Exporter":
+        """Creates an exporter using the settings in the environment."""
+        return cls(
+            host=os.getenv("METRICS_HOST", "127.0.0.1"),
+            port=int(os.getenv("METRICS_PORT", "9108")))
+
+    async def start(self):
+        """Starts serving, unless the port is 0."""
+        if not self.port:
+            return
+        self._lag_task = asyncio.create_task(_watch_loop_lag())
+        try:
+            self._server = await asyncio.start_server(
+                _handle, self.host, self.port)
+        except OSError as e:
+            logger.error(
+                "Couldn't serve metrics on %s:%d: %s", self.host, self.port, e)
+            return
+        logger.info("Serving metrics on http://%s:%d/metrics",
+                    self.host, self.port)
+
+    def close(self):
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+        if self._server is not None:
+            self._server.close()
+
+
+# Metrics reported by the bot
+
+YTDL_SECONDS = histogram(
+    "ytdl_seconds",
+    "Time taken to find a song's video and stream with yt-dlp.",
+    ("call",))
+LASTFM_SECONDS = histogram(
+    "lastfm_request_seconds",
+    "Time taken by LastFM track searches.")
+OPENAI_SECONDS = histogram(
+    "openai_request_seconds",
+    "Time taken by OpenAI requests, until the reply starts when streamed.",
+    ("call",))
+DB_SECONDS = histogram(
+    "db_call_seconds",
+    "Time taken by each database call.",
+    ("method",))
+QUEUE_DEPTH = gauge(
+    "player_queue_depth",
+    "Songs waiting in each server's queue.",
+    ("guild_id",))
+FFMPEG_PROCESSES = gauge(
+    "ffmpeg_processes",
+    "FFmpeg processes decoding songs.")
+PLAYER_RENDERS = counter(
+    "player_renders_total",
+    "Times a 'Now Playing' message was rebuilt.")
+PLAYER_MESSAGES = counter(
+    "player_messages_total",
+    "'Now Playing' messages edited or sent.",
+    ("action",))
+LOOP_LAG_SECONDS = histogram(
+    "event_loop_lag_seconds",
+    "How late the event loop ran a timer.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, math.inf))
+PRESENCE_EVENTS = counter(
+    "presence_events_total",
+    "Presence updates received from Discord, before duplicates are dropped.")
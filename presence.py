@@ -0,0 +1,133 @@
+"""
+The bot's status, showing what it's playing.
+
+The bot has one status across every server, and Discord only allows a few
+status updates a minute, so players don't set it themselves. They tell the
+presence manager what they're playing, and the manager updates the status
+at most once per PRESENCE_INTERVAL seconds, with only the latest state, and
+only when it has changed. When music is playing in more than one server, the
+status takes turns between how many servers and what's playing in one of
+them, moving on every PRESENCE_ROTATE seconds.
+
+Settings are read from the environment:
+
+    PRESENCE_INTERVAL  Least seconds between status updates. Defaults to 15.
+    PRESENCE_ROTATE    Seconds each status is shown for when playing in more
+                       than one server. Defaults to 60.
+"""
+
+import asyncio
+import logging
+import os
+import time
+import typing
+
+import discord
+
+logger = logging.getLogger("presence")
+
+# Longest custom status Discord shows
+MAX_LENGTH = 128
+
+
+class PresenceManager:
+    """
+    Coalesces what every player is playing into the bot's status.
+
+    Examples:
+        >>> bot.presence.set_playing(guild.id, "'Teardrop' by Massive Attack")
+        >>> bot.presence.clear(guild.id)
+    """
+
+    def __init__(self, bot, interval: float = 15, rotate: float = 60):
+        self.bot = bot
+        self.interval = interval
+        self.rotate = rotate
+        # What's playing in each server
+        self.playing = {}
+        self._changed = asyncio.Event()
+        self._task = None
+        self._sent = None
+        self._last_update = 0.0
+        self._turn = 0
+
+    @classmethod
+    def from_env(cls, bot) -> "PresenceManager":
+        """Creates a presence manager using the settings in the environment."""
+        return cls(
+            bot,
+            interval=float(os.getenv("PRESENCE_INTERVAL", "15")),
+            rotate=float(os.getenv("PRESENCE_ROTATE", "60")))
+
+    def set_playing(self, guild_id: int, song: str):
+        """
+        Shows that a server is playing a song.
+
+        Args:
+            guild_id (int): The Discord ID of the server.
+            song (str): What's playing, e.g. "'Teardrop' by Massive Attack".
+        """
+        if self.playing.get(guild_id) != song:
+            self.playing[guild_id] = song
+            self._wake()
+
+    def clear(self, guild_id: int):
+        """Shows that a server has stopped playing."""
+        if self.playing.pop(guild_id, None) is not None:
+            self._wake()
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def _wake(self):
+        self._changed.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def status(self) -> typing.Optional[str]:
+        """Returns the status to show now, or None to show nothing."""
+        if not self.playing:
+            return None
+        if len(self.playing) == 1:
+            status = f"🎵 {next(iter(self.playing.values()))}"
+        elif self._turn % 2 == 0:
+            status = f"🎵 Playing in {len(self.playing)} servers"
+        else:
+            songs = [self.playing[key] for key in sorted(self.playing)]
+            status = f"🎵 {songs[self._turn // 2 % len(songs)]}"
+        if len(status) > MAX_LENGTH:
+            status = status[:MAX_LENGTH - 1] + "…"
+        return status
+
+    async def _run(self):
+        while True:
+            # Only a status shared by several servers changes on its own
+            rotating = len(self.playing) > 1
+            try:
+                await asyncio.wait_for(
+                    self._changed.wait(), self.rotate if rotating else None)
+            except asyncio.TimeoutError:
+                self._turn += 1
+            # Let a burst of changes settle into one update, and stay under
+            # Discord's limit
+            wait = self._last_update + self.interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._changed.clear()
+
+            status = self.status()
+            if status == self._sent:
+                continue
+            try:
+                await self.bot.change_presence(
+                    activity=discord.Activity(
+                        type=discord.ActivityType.custom,
+                        name="custom",
+                        state=status,
+                    ) if status else None
+                )
+                self._sent = status
+            except Exception:
+                logger.exception("Couldn't update the bot's status")
+            self._last_update = time.monotonic()
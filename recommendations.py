@@ -0,0 +1,341 @@
+"""
+Song recommendations for DJ mode.
+
+DJ mode first plays songs that have gone together with its latest plays
+before, found locally by the 'similarity' module. When there are none, and it
+runs out of songs the listeners have played before, it plays songs
+recommended by a language model. Asking for one song at a time would put a
+slow API call in front of every pick, so songs are asked for in batches and
+kept in a buffer for each channel in the database. The buffer is topped up in
+the background whenever it runs low, so a pick only waits on the API when the
+buffer is empty.
+
+Replies are requested as JSON matching a schema, and every song is checked
+before it's buffered.
+
+Settings are read from the environment:
+
+    RECOMMENDATION_BATCH_SIZE  Songs asked for at a time. Defaults to 10.
+    RECOMMENDATION_LOW_WATER   Songs left in a buffer that start a refill.
+                               Defaults to 3.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import random
+import typing
+
+import database
+import metrics
+
+# The OpenAI client is slow to import, so it's only imported when needed
+if typing.TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+logger = logging.getLogger("recommendations")
+
+# Model used to recommend songs
+MODEL = "gpt-4o-mini"
+
+# Seconds a request for recommendations may take
+TIMEOUT = 30
+
+# Songs recently finished in the server that recommendations are based on
+SEEDS = 10
+
+# Songs recently played in the server that shouldn't be recommended again
+RECENT = 50
+
+# Longest title or artist accepted
+MAX_LENGTH = 200
+
+SETUP_PROMPT = (
+    "You recommend songs for a Discord music bot. You'll be given a JSON list "
+    "of songs the listeners recently enjoyed, and a list of songs to avoid. "
+    "Recommend {count} other songs they would enjoy. Branch out and vary "
+    "them; don't repeat an artist more than twice, and don't recommend any "
+    "song you were given. Use each song's official title and the name of "
+    "its main artist.")
+
+# JSON schema replies must follow
+SCHEMA = {
+    "name": "recommendations",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "songs": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "title": {"type": "string"},
+                        "artist": {"type": "string"},
+                    },
+                    "required": ["title", "artist"],
+                    "additionalProperties": False,
+                },
+            },
+        },
+        "required": ["songs"],
+        "additionalProperties": False,
+    },
+}
+
+
+def _song_key(song: dict) -> tuple[str, str]:
+    return song["title"].casefold(), song["artist"].casefold()
+
+
+def parse_songs(
+    text: str,
+    avoid: list[dict] = (),
+    limit: int = None) -> list[dict]:
+    """
+    Reads the songs out of a reply, dropping any that aren't valid.
+
+    Args:
+        text (str): The reply, as JSON matching 'SCHEMA'.
+        avoid (list[dict]): Songs to drop if they're recommended.
+        limit (int): The most songs to return.
+
+    Returns:
+        list[dict]: The 'title' and 'artist' of each song.
+
+    Raises:
+        ValueError: If the reply isn't JSON in the expected shape.
+    """
+    data = json.loads(text)
+    if not isinstance(data, dict) or not isinstance(data.get("songs"), list):
+        raise ValueError("Reply doesn't have a list of songs")
+    seen = {_song_key(song) for song in avoid}
+    songs = []
+    for song in data["songs"]:
+        if not isinstance(song, dict):
+            continue
+        title, artist = song.get("title"), song.get("artist")
+        if not isinstance(title, str) or not isinstance(artist, str):
+            continue
+        song = {"title": title.strip(), "artist": artist.strip()}
+        if not song["title"] or not song["artist"]:
+            continue
+        if max(len(song["title"]), len(song["artist"])) > MAX_LENGTH:
+            continue
+        key = _song_key(song)
+        if key in seen:
+            continue
+        seen.add(key)
+        songs.append(song)
+    return songs[:limit]
+
+
+class Recommender:
+    """
+    Keeps each channel's buffer of recommended songs topped up.
+
+    Examples:
+        >>> recommender = Recommender(db)
+        >>> song = await recommender.next(channel.id, channel_ids)
+        >>> song
+        {'title': 'Teardrop', 'artist': 'Massive Attack'}
+    """
+
+    def __init__(
+        self,
+        db: database.Database,
+        batch_size: int = 10,
+        low_water: int = 3):
+        self.db = db
+        self.batch_size = batch_size
+        self.low_water = low_water
+        self._openai_client = None
+        # Refills running for each channel
+        self._refills = {}
+        # Songs played together, loaded on first use
+        self._graph = None
+
+    @classmethod
+    def from_env(cls, db: database.Database) -> "Recommender":
+        """Creates a recommender using the settings in the environment."""
+        return cls(
+            db,
+            batch_size=int(os.getenv("RECOMMENDATION_BATCH_SIZE", "10")),
+            low_water=int(os.getenv("RECOMMENDATION_LOW_WATER", "3")))
+
+    @property
+    def openai_client(self) -> "AsyncOpenAI":
+        """The OpenAI client, created on first use."""
+        if self._openai_client is None:
+            from openai import AsyncOpenAI
+            self._openai_client = AsyncOpenAI(timeout=TIMEOUT)
+        return self._openai_client
+
+    def _update_graph(self):
+        # Importing SciPy takes a while, so this runs in an executor too
+        import similarity
+        if self._graph is None:
+            self._graph = similarity.SongGraph()
+        self._graph.update(self.db)
+
+    async def similar(
+        self,
+        channel_id: int,
+        users: list[int],
+        avoid: list[dict] = ()) -> typing.Optional[dict]:
+        """
+        Picks a song that goes with the channel's latest plays and listeners.
+
+        The first call loads every song play, so it can take a while; later
+        ones only load new plays.
+
+        Args:
+            channel_id (int): The Discord ID of the channel.
+            users (list[int]): The Discord IDs of the members listening.
+            avoid (list[dict]): Songs that shouldn't be picked.
+
+        Returns:
+            Optional[dict]: The song's 'title' and 'artist', picked at random
+                from the best few, or None if nothing goes with them.
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._update_graph)
+        import similarity
+        recent = await loop.run_in_executor(
+            None, self.db.get_recent_songs, [channel_id], similarity.HISTORY,
+            False)
+        # This waits for any update of the graph that's underway
+        picks = await loop.run_in_executor(
+            None, self._graph.recommend, recent, users, avoid)
+        if not picks:
+            return None
+        songs, scores = zip(*picks)
+        return random.choices(songs, weights=scores)[0]
+
+    async def ask(
+        self,
+        seeds: list[dict],
+        avoid: list[dict],
+        count: int) -> list[dict]:
+        """
+        Asks the model for songs like some others.
+
+        Args:
+            seeds (list[dict]): Songs the recommendations should be like.
+            avoid (list[dict]): Songs that shouldn't be recommended.
+            count (int): The number of songs to ask for.
+
+        Returns:
+            list[dict]: Up to 'count' valid songs, none of them in 'seeds' or
+                'avoid'.
+        """
+        with metrics.OPENAI_SECONDS.time(call="recommendations"):
+            completion = await self.openai_client.chat.completions.create(
+                model=MODEL,
+                messages=[
+                    {"role": "system",
+                     "content": SETUP_PROMPT.format(count=count)},
+                    {"role": "user", "content": json.dumps({
+                        "enjoyed": seeds,
+                        "avoid": avoid,
+                    })},
+                ],
+                response_format={
+                    "type": "json_schema", "json_schema": SCHEMA},
+            )
+        return parse_songs(
+            completion.choices[0].message.content, seeds + avoid, count)
+
+    async def refill(self, channel_id: int, channels: list[int]) -> int:
+        """
+        Adds a batch of recommendations to a channel's buffer.
+
+        Args:
+            channel_id (int): The Discord ID of the channel.
+            channels (list[int]): The Discord IDs of the server's channels,
+                whose songs the recommendations are based on.
+
+        Returns:
+            int: The number of recommendations now waiting in the channel.
+        """
+        loop = asyncio.get_running_loop()
+        seeds = await loop.run_in_executor(
+            None, self.db.get_recent_songs, channels, SEEDS)
+        recent = await loop.run_in_executor(
+            None, self.db.get_recent_songs, channels, RECENT, False)
+        buffered = await loop.run_in_executor(
+            None, self.db.get_recommendations, channel_id)
+        # Recent songs that are also seeds are only sent once
+        seed_keys = {_song_key(song) for song in seeds}
+        avoid = [
+            song for song in recent + buffered
+            if _song_key(song) not in seed_keys]
+        songs = await self.ask(seeds, avoid, self.batch_size)
+        waiting = await loop.run_in_executor(
+            None, self.db.add_recommendations, channel_id, songs)
+        logger.info(
+            "Added %d recommendations for channel %d, %d waiting",
+            len(songs), channel_id, waiting)
+        return waiting
+
+    def refill_soon(
+        self,
+        channel_id: int,
+        channels: list[int]) -> asyncio.Task:
+        """
+        Starts refilling a channel's buffer in the background, unless it's
+        already being refilled.
+
+        Args:
+            channel_id (int): The Discord ID of the channel.
+            channels (list[int]): The Discord IDs of the server's channels.
+
+        Returns:
+            asyncio.Task: The refill.
+        """
+        task = self._refills.get(channel_id)
+        if task is None:
+            task = asyncio.create_task(self.refill(channel_id, channels))
+            self._refills[channel_id] = task
+
+            def done(task):
+                del self._refills[channel_id]
+                if not task.cancelled() and task.exception():
+                    logger.error(
+                        "Couldn't get recommendations for channel %d",
+                        channel_id, exc_info=task.exception())
+            task.add_done_callback(done)
+        return task
+
+    async def next(
+        self,
+        channel_id: int,
+        channels: list[int]) -> typing.Optional[dict]:
+        """
+        Takes the next recommendation for a channel.
+
+        The buffer is refilled in the background when it runs low, and only
+        waited on when it's empty.
+
+        Args:
+            channel_id (int): The Discord ID of the channel.
+            channels (list[int]): The Discord IDs of the server's channels.
+
+        Returns:
+            Optional[dict]: The song's 'title' and 'artist', or None if no
+                recommendations could be had.
+        """
+        loop = asyncio.get_running_loop()
+        song, waiting = await loop.run_in_executor(
+            None, self.db.pop_recommendation, channel_id)
+        if waiting < self.low_water:
+            refill = self.refill_soon(channel_id, channels)
+            if song is None:
+                try:
+                    await asyncio.shield(refill)
+                except Exception:
+                    return None
+                song, _ = await loop.run_in_executor(
+                    None, self.db.pop_recommendation, channel_id)
+        return song
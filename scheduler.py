@@ -0,0 +1,353 @@
+"""
+Admission control for chatbot completions.
+
+Completions are slow and the upstream API limits how many can be made, so a
+burst of '!chat' from one guild could use up the limit for everyone. The
+scheduler caps how many completions run at once, throttles each guild and
+user with a token bucket, and queues the rest, taking turns between guilds so
+that one busy guild can't hold up the others. When the API says it's rate
+limited, nothing new is started until it says to retry.
+
+Limits are read from the environment:
+
+    CHATBOT_MAX_CONCURRENT  Maximum number of completions at once. Defaults
+                            to 4.
+    CHATBOT_GUILD_RATE      Completions each guild may start per minute, on
+                            average. Defaults to 20.
+    CHATBOT_GUILD_BURST     Completions a guild may start at once after being
+                            quiet. Defaults to 5.
+    CHATBOT_USER_RATE       Completions each user may start per minute, on
+                            average. Defaults to 4.
+    CHATBOT_USER_BURST      Completions a user may start at once after being
+                            quiet. Defaults to 2.
+    CHATBOT_QUEUE_SIZE      Maximum number of completions waiting to start.
+                            Defaults to 20.
+    CHATBOT_QUEUE_WAIT      Seconds a completion may wait to start before it
+                            is refused. Defaults to 60.
+
+The API is reached at OPENAI_BASE_URL if it's set, so the bot can be pointed
+at 'chatbot_standin.py' to try the limits out locally.
+"""
+
+import asyncio
+import collections
+import contextlib
+import logging
+import math
+import os
+import time
+import typing
+
+from discord.ext import commands
+
+logger = logging.getLogger("scheduler")
+
+# Number of buckets kept before full ones are forgotten
+_MAX_BUCKETS = 1024
+
+
+class Throttled(commands.CommandError):
+    """Raised when a guild or user has started too many completions lately."""
+
+
+class QueueFull(commands.CommandError):
+    """Raised when too many completions are already waiting to start."""
+
+
+class TokenBucket:
+    """
+    Allows an average rate of events, with bursts up to a capacity.
+
+    Args:
+        rate (float): Tokens added per second.
+        capacity (float): Most tokens the bucket holds.
+    """
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+    def wait_time(self) -> float:
+        """Returns the seconds until a token is available, 0 if one is now."""
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+
+class Waiter:
+    """A completion waiting for its turn."""
+
+    __slots__ = ("guild_id", "user_id", "granted", "moved")
+
+    def __init__(self, guild_id: int, user_id: int):
+        self.guild_id = guild_id
+        self.user_id = user_id
+        self.granted = False
+        # Set whenever the waiter moves up the queue or is granted a turn
+        self.moved = asyncio.Event()
+
+
+class CompletionScheduler:
+    """
+    Decides when each completion may start.
+
+    Examples:
+        >>> scheduler = CompletionScheduler(max_concurrent=4)
+        >>> async with scheduler.turn(guild.id, author.id):
+        ...     reply = await client.chat.completions.create(...)
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = 4,
+        guild_rate: float = 20,
+        guild_burst: int = 5,
+        user_rate: float = 4,
+        user_burst: int = 2,
+        queue_size: int = 20,
+        wait: float = 60):
+        self.max_concurrent = max_concurrent
+        self.guild_rate = guild_rate / 60
+        self.guild_burst = guild_burst
+        self.user_rate = user_rate / 60
+        self.user_burst = user_burst
+        self.queue_size = queue_size
+        self.wait = wait
+        self.active = 0
+        self._guild_buckets = {}
+        self._user_buckets = {}
+        # Waiters by guild, and the order guilds take turns in
+        self._queues = {}
+        self._rotation = collections.deque()
+        self._paused_until = 0.0
+        self._resume_handle = None
+        self._resumed = asyncio.Event()
+        self._resumed.set()
+
+    @classmethod
+    def from_env(cls) -> "CompletionScheduler":
+        """Creates a scheduler using the limits set in the environment."""
+        def env(name, cast, default):
+            value = os.getenv(name)
+            return cast(value) if value else default
+        return cls(
+            max_concurrent=env("CHATBOT_MAX_CONCURRENT", int, 4),
+            guild_rate=env("CHATBOT_GUILD_RATE", float, 20),
+            guild_burst=env("CHATBOT_GUILD_BURST", int, 5),
+            user_rate=env("CHATBOT_USER_RATE", float, 4),
+            user_burst=env("CHATBOT_USER_BURST", int, 2),
+            queue_size=env("CHATBOT_QUEUE_SIZE", int, 20),
+            wait=env("CHATBOT_QUEUE_WAIT", float, 60))
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    @property
+    def paused(self) -> bool:
+        return time.monotonic() < self._paused_until
+
+    def _bucket(self, buckets: dict, key: int, rate: float, burst: int):
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= _MAX_BUCKETS:
+                # A full bucket is the same as a new one
+                for full in [k for k, b in buckets.items() if b.full]:
+                    del buckets[full]
+            bucket = buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    def _throttle(self, guild_id: int, user_id: int):
+        """Takes a token for the guild and user, or raises 'Throttled'."""
+        user = self._bucket(
+            self._user_buckets, user_id, self.user_rate, self.user_burst)
+        wait = user.wait_time()
+        if wait:
+            raise Throttled(
+                f"You're chatting too fast. Try again in {math.ceil(wait)}s.")
+        if guild_id is not None:
+            guild = self._bucket(
+                self._guild_buckets, guild_id, self.guild_rate,
+                self.guild_burst)
+            wait = guild.wait_time()
+            if wait:
+                raise Throttled(
+                    f"This server is chatting too fast. "
+                    f"Try again in {math.ceil(wait)}s.")
+            guild.take()
+        user.take()
+
+    def position(self, waiter: Waiter) -> int:
+        """
+        Returns how many turns are given out before the waiter's, plus one.
+
+        Guilds take turns in rotation, so this counts the waiters from every
+        guild that will be served before this one if nothing else arrives.
+        """
+        queue = self._queues[waiter.guild_id]
+        index = queue.index(waiter)
+        position = index + 1
+        for guild_id in self._rotation:
+            if guild_id == waiter.guild_id:
+                # Guilds after this one only go first from the next round
+                index -= 1
+                continue
+            position += min(len(self._queues[guild_id]), index + 1)
+        return position
+
+    def _dispatch(self):
+        """Gives turns to waiting completions while there's capacity."""
+        if self.paused:
+            return
+        granted = False
+        while self._rotation and self.active < self.max_concurrent:
+            guild_id = self._rotation.popleft()
+            queue = self._queues[guild_id]
+            waiter = queue.popleft()
+            if queue:
+                self._rotation.append(guild_id)
+            else:
+                del self._queues[guild_id]
+            waiter.granted = True
+            waiter.moved.set()
+            self.active += 1
+            granted = True
+        if granted:
+            for queue in self._queues.values():
+                for waiter in queue:
+                    waiter.moved.set()
+
+    def _remove(self, waiter: Waiter):
+        queue = self._queues[waiter.guild_id]
+        queue.remove(waiter)
+        if not queue:
+            del self._queues[waiter.guild_id]
+            self._rotation.remove(waiter.guild_id)
+        for queue in self._queues.values():
+            for other in queue:
+                other.moved.set()
+
+    async def acquire(
+        self,
+        guild_id: int,
+        user_id: int,
+        on_position: typing.Callable[[int], typing.Awaitable] = None):
+        """
+        Waits for a turn to run a completion.
+
+        Args:
+            guild_id (int): The guild the completion is for, or None in
+                private messages.
+            user_id (int): The user who asked for it.
+            on_position (Callable[[int], Awaitable]): Called with the
+                waiter's place in the queue each time it has to wait, and
+                each time it moves up.
+
+        Raises:
+            Throttled: If the guild or user has started too many lately.
+            QueueFull: If too many are waiting, or there's no turn within
+                the wait limit.
+        """
+        if self.waiting >= self.queue_size:
+            raise QueueFull(
+                "Too many people are chatting right now. "
+                "Please try again in a minute.")
+        self._throttle(guild_id, user_id)
+
+        waiter = Waiter(guild_id, user_id)
+        if guild_id not in self._queues:
+            self._queues[guild_id] = collections.deque()
+            self._rotation.append(guild_id)
+        self._queues[guild_id].append(waiter)
+        self._dispatch()
+
+        deadline = time.monotonic() + self.wait
+        try:
+            while not waiter.granted:
+                waiter.moved.clear()
+                if on_position is not None:
+                    await on_position(self.position(waiter))
+                    if waiter.granted:
+                        break
+                remaining = deadline - time.monotonic()
+                try:
+                    await asyncio.wait_for(waiter.moved.wait(), remaining)
+                except asyncio.TimeoutError:
+                    if waiter.granted:
+                        break
+                    logger.warning(
+                        "Refused completion for guild %s after %.0fs with "
+                        "%d waiting", guild_id, self.wait, self.waiting)
+                    raise QueueFull(
+                        "The chatbot is too busy right now. "
+                        "Please try again in a minute.")
+        except BaseException:
+            if waiter.granted:
+                self.release()
+            else:
+                self._remove(waiter)
+            raise
+
+    def release(self):
+        """Frees the turn used by a completion."""
+        self.active -= 1
+        self._dispatch()
+
+    @contextlib.asynccontextmanager
+    async def turn(self, guild_id: int, user_id: int, on_position=None):
+        """Waits for a turn with 'acquire()' and releases it afterwards."""
+        await self.acquire(guild_id, user_id, on_position)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def backoff(self, seconds: float):
+        """
+        Stops new completions from starting for a while.
+
+        Called when the API says it's rate limited. Completions already
+        running may retry once 'resumed()' returns.
+
+        Args:
+            seconds (float): How long the API asked to wait.
+        """
+        until = time.monotonic() + seconds
+        if until <= self._paused_until:
+            return
+        logger.warning("Rate limited upstream; pausing for %.1fs", seconds)
+        self._paused_until = until
+        self._resumed.clear()
+        if self._resume_handle is not None:
+            self._resume_handle.cancel()
+        self._resume_handle = asyncio.get_running_loop().call_later(
+            seconds, self._resume)
+
+    def _resume(self):
+        self._resume_handle = None
+        self._resumed.set()
+        self._dispatch()
+
+    async def resumed(self):
+        """Waits until the API may be called again."""
+        await self._resumed.wait()
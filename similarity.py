@@ -0,0 +1,325 @@
+"""
+Recommends songs from what's been played together before.
+
+Plays in a channel with less than 'SESSION_GAP' between them make up a
+listening session. Songs played within 'WINDOW' plays of each other in a
+session count as going together, more so the closer together they were, and
+less when either was skipped. These counts are kept in a sparse song by song
+matrix, and normalized into similarities when they're needed. What each user
+asked for is kept in a sparse user by song matrix, so that the listeners
+present can sway the pick.
+
+Both matrices are topped up with only the plays added since they were last
+updated, and picking a song scores every song against the last few plays and
+the listeners with a couple of sparse products, so it takes milliseconds and
+needs no network.
+
+NumPy and SciPy are slow to import, so this module is imported when it's
+first needed.
+"""
+
+import threading
+import time
+import typing
+from datetime import datetime
+
+import numpy as np
+from scipy import sparse
+
+# Plays apart that songs can be and still count as going together
+WINDOW = 5
+
+# Seconds without a play that end a listening session
+SESSION_GAP = 30 * 60
+
+# How much a skipped play counts for compared to a finished one
+SKIP_WEIGHT = 0.2
+
+# Seconds after which a play with nothing after it is treated as over, even
+# though whether it finished may not have been recorded
+PENDING_AGE = 60 * 60
+
+# Number of the latest plays a pick is based on, and how much less each
+# older one counts than the one after it
+HISTORY = 5
+DECAY = 0.6
+
+# How much the listeners' own plays count against the latest plays
+LISTENER_WEIGHT = 0.5
+
+
+def _key(title: str, artist: str) -> typing.Optional[tuple[str, str]]:
+    # Songs played from a URL have no title until they're enriched, and
+    # can't be in the graph
+    if title is None:
+        return None
+    return title.casefold(), (artist or "").casefold()
+
+
+class SongGraph:
+    """
+    How often songs have been played together, held in memory.
+
+    Examples:
+        >>> graph = SongGraph()
+        >>> graph.update(db)
+        >>> graph.recommend(recent, [member.id for member in listeners])
+        [({'title': 'Teardrop', 'artist': 'Massive Attack'}, 0.41), ...]
+    """
+
+    def __init__(self):
+        self.songs = []         # Title and artist of each song index
+        self._songs = {}        # Song index of each casefolded title and artist
+        self._spellings = {}    # Song index of each title and artist as given
+        self._users = {}        # Row of each Discord user ID
+        self.cooccurrence = sparse.csr_array((0, 0))
+        self.affinity = sparse.csr_array((0, 0))
+        self.plays = np.zeros(0)
+        self.finished = np.zeros(0)
+        self.last_id = 0
+        self.as_of = None
+        # Plays after 'last_id' already counted, because a play before them
+        # hasn't ended yet
+        self._counted = set()
+        # Latest plays counted in each channel, so sessions carry on into
+        # the next update, as arrays of songs, weights and timestamps
+        self._tails = {}
+        self._similarity = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.songs)
+
+    def _song(self, title: str, artist: str) -> int:
+        key = _key(title, artist)
+        index = self._songs.get(key)
+        if index is None:
+            index = self._songs[key] = len(self.songs)
+            self.songs.append({"title": title, "artist": artist})
+        self._spellings[title, artist] = index
+        return index
+
+    def _user(self, discord_id: int) -> int:
+        if discord_id is None:
+            return -1
+        return self._users.setdefault(discord_id, len(self._users))
+
+    def update(self, db) -> datetime:
+        """
+        Counts song plays recorded since the last update.
+
+        Plays are only counted once they're over, which is when another has
+        started in the same channel, or after 'PENDING_AGE'. This blocks on
+        the database, so run it in an executor.
+
+        Args:
+            db (database.Database): The database to load from.
+
+        Returns:
+            datetime: How current the graph now is.
+        """
+        with self._lock:
+            result = db.get_song_play_history(self.last_id)
+            cutoff = time.time() - PENDING_AGE
+            # Every play after 'last_id' is loaded, so only the latest in
+            # each channel can have nothing after it
+            latest = {play[1]: play[0] for play in result.value}
+            ready = []
+            pending = []
+            for play in result.value:
+                if play[0] in self._counted:
+                    continue
+                if latest[play[1]] != play[0] or play[6] < cutoff:
+                    ready.append(play)
+                else:
+                    pending.append(play[0])
+            if pending:
+                self.last_id = min(pending) - 1
+                self._counted = {
+                    play_id for play_id in self._counted
+                    if play_id > self.last_id}
+                self._counted.update(
+                    play[0] for play in ready if play[0] > self.last_id)
+            elif result.value:
+                self.last_id = result.value[-1][0]
+                self._counted = set()
+            self._count([play for play in ready if play[3]])
+            self.as_of = result.as_of
+            return self.as_of
+
+    def _count(self, plays: list[tuple]):
+        """Adds plays, in the order they happened, to the matrices."""
+        if not plays:
+            return
+        channels = np.fromiter(
+            (play[1] for play in plays), dtype=np.int64, count=len(plays))
+        # Most plays are of songs already seen, spelled the same way
+        spellings = self._spellings
+        songs = np.fromiter(
+            (spellings[play[3], play[4]] if (play[3], play[4]) in spellings
+             else self._song(play[3], play[4]) for play in plays),
+            dtype=np.int64, count=len(plays))
+        users = np.fromiter(
+            (self._user(play[2]) for play in plays),
+            dtype=np.int64, count=len(plays))
+        finished = np.fromiter(
+            (bool(play[5]) for play in plays), dtype=bool, count=len(plays))
+        timestamps = np.fromiter(
+            (play[6] for play in plays), dtype=np.int64, count=len(plays))
+        weights = np.where(finished, 1.0, SKIP_WEIGHT)
+        size = len(self.songs)
+
+        # Put the plays counted last time in front of the new ones, so pairs
+        # can span updates, then group each channel's plays together
+        tails = [
+            (channel, *self._tails[channel])
+            for channel in np.unique(channels).tolist()
+            if channel in self._tails]
+        new = np.ones(len(plays), dtype=bool)
+        if tails:
+            channels = np.concatenate(
+                [np.full(len(tail[1]), tail[0]) for tail in tails]
+                + [channels])
+            new = np.concatenate(
+                [np.zeros(len(tail[1]), dtype=bool) for tail in tails] + [new])
+            all_songs = np.concatenate([tail[1] for tail in tails] + [songs])
+            all_weights = np.concatenate(
+                [tail[2] for tail in tails] + [weights])
+            all_timestamps = np.concatenate(
+                [tail[3] for tail in tails] + [timestamps])
+        else:
+            all_songs, all_weights, all_timestamps = songs, weights, timestamps
+        order = np.argsort(channels, kind="stable")
+        channels = channels[order]
+        new = new[order]
+        all_songs = all_songs[order]
+        all_weights = all_weights[order]
+        all_timestamps = all_timestamps[order]
+
+        # A session starts with each channel, and after each long gap
+        starts = np.ones(len(channels), dtype=bool)
+        starts[1:] = (channels[1:] != channels[:-1]) | (
+            all_timestamps[1:] - all_timestamps[:-1] > SESSION_GAP)
+        sessions = np.cumsum(starts)
+
+        rows, columns, values = [], [], []
+        for distance in range(1, WINDOW + 1):
+            first = np.arange(len(channels) - distance)
+            second = first + distance
+            pair = (sessions[first] == sessions[second]) & new[second] & (
+                all_songs[first] != all_songs[second])
+            first, second = first[pair], second[pair]
+            value = all_weights[first] * all_weights[second] / distance
+            # Songs go together both ways
+            rows += [all_songs[first], all_songs[second]]
+            columns += [all_songs[second], all_songs[first]]
+            values += [value, value]
+        counts = sparse.coo_array(
+            (np.concatenate(values),
+             (np.concatenate(rows), np.concatenate(columns))),
+            shape=(size, size)).tocsr()
+        self.cooccurrence.resize((size, size))
+        self.cooccurrence = self.cooccurrence + counts
+        self._similarity = None
+
+        requested = users >= 0
+        affinity = sparse.coo_array(
+            (weights[requested], (users[requested], songs[requested])),
+            shape=(len(self._users), size)).tocsr()
+        self.affinity.resize((len(self._users), size))
+        self.affinity = self.affinity + affinity
+
+        self.plays = np.bincount(
+            songs, minlength=size) + np.pad(
+                self.plays, (0, size - len(self.plays)))
+        self.finished = np.bincount(
+            songs, weights=finished, minlength=size) + np.pad(
+                self.finished, (0, size - len(self.finished)))
+
+        # Remember the latest plays in each channel for next time
+        ends = np.flatnonzero(np.append(channels[1:] != channels[:-1], True))
+        for end in ends.tolist():
+            begin = max(end + 1 - WINDOW, 0)
+            tail = slice(begin, end + 1)
+            tail_channels = channels[tail]
+            keep = tail_channels == channels[end]
+            self._tails[int(channels[end])] = (
+                all_songs[tail][keep], all_weights[tail][keep],
+                all_timestamps[tail][keep])
+
+    @property
+    def similarity(self) -> sparse.csr_array:
+        """
+        How alike each pair of songs is, from 0 to 1.
+
+        Each count of two songs going together is divided by the geometric
+        mean of how much each song goes with anything, so that songs that are
+        simply played a lot don't go with everything.
+        """
+        if self._similarity is None:
+            totals = np.asarray(self.cooccurrence.sum(axis=1)).ravel()
+            scale = np.zeros_like(totals)
+            np.divide(1, np.sqrt(totals), out=scale, where=totals > 0)
+            diagonal = sparse.diags_array(scale)
+            self._similarity = (diagonal @ self.cooccurrence @ diagonal).tocsr()
+        return self._similarity
+
+    def recommend(
+        self,
+        recent: list[dict],
+        listeners: list[int] = (),
+        avoid: list[dict] = (),
+        top: int = 5) -> list[tuple[dict, float]]:
+        """
+        Picks songs to play next.
+
+        This waits for any update that's underway, which can block on the
+        database, so run it in an executor.
+
+        Args:
+            recent (list[dict]): The 'title' and 'artist' of the latest songs
+                played, most recent first.
+            listeners (list[int]): The Discord IDs of the members listening.
+            avoid (list[dict]): Songs that shouldn't be picked, such as ones
+                played recently.
+            top (int): The most songs to return.
+
+        Returns:
+            list[tuple[dict, float]]: The 'title' and 'artist' of the best
+                songs and their scores, best first.
+        """
+        with self._lock:
+            if not self.songs:
+                return []
+            recent = [
+                self._songs.get(_key(song["title"], song["artist"]))
+                for song in recent[:HISTORY]]
+            avoid = [
+                self._songs.get(_key(song["title"], song["artist"]))
+                for song in avoid]
+            rows = [self._users[user] for user in listeners
+                    if user in self._users]
+
+            # Every song's similarity to the latest plays, in one product
+            query = np.zeros(len(self.songs))
+            for age, index in enumerate(recent):
+                if index is not None:
+                    query[index] += DECAY ** age
+            scores = self.similarity @ query
+            if scores.max() > 0:
+                scores /= scores.max()
+            if rows:
+                liked = np.asarray(self.affinity[rows].sum(axis=0)).ravel()
+                if liked.max() > 0:
+                    scores += LISTENER_WEIGHT * liked / liked.max()
+            # Songs that tend to get skipped are less likely to be picked
+            scores *= (self.finished + 1) / (self.plays + 2)
+            excluded = [index for index in recent + avoid if index is not None]
+            scores[excluded] = 0
+
+            top = min(top, np.count_nonzero(scores > 0))
+            if not top:
+                return []
+            best = np.argpartition(scores, -top)[-top:]
+            best = best[np.argsort(scores[best])[::-1]]
+            return [(self.songs[i], float(scores[i])) for i in best.tolist()]
@@ -0,0 +1,170 @@
+import random
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pytest
+
+import analytics
+from database import AnalyticsResult
+
+# Midnight UTC on a Monday
+NOW = int(datetime(2024, 1, 8, tzinfo=timezone.utc).timestamp())
+
+
+class History:
+    """Serves activity changes the way 'Database.get_activity_history' does."""
+
+    def __init__(self, events, users, activities, as_of):
+        self.events = events
+        self.users = users
+        self.activities = activities
+        self.as_of = as_of
+
+    def get_activity_history(self, after):
+        return AnalyticsResult({
+            "first_id": min((e[0] for e in self.events), default=None),
+            "events": [e for e in self.events if e[0] > after["activity_event"]],
+            "users": {
+                k: v for k, v in self.users.items() if k > after["user"]},
+            "activities": {
+                k: v for k, v in self.activities.items()
+                if k > after["activity"]},
+        }, self.as_of)
+
+
+def random_history(seed, count=2000, users=12, activities=6):
+    rng = random.Random(seed)
+    events = []
+    for id in range(1, count + 1):
+        events.append((
+            id, rng.randint(1, users), rng.randint(0, activities),
+            NOW - rng.randint(0, 21 * 86400)))
+    return History(
+        events,
+        {user: 1000 + user for user in range(1, users + 1)},
+        {activity: f"Game {activity}" for activity in range(1, activities + 1)},
+        datetime.fromtimestamp(NOW))
+
+
+def brute_intervals(history, start, member_ids):
+    """Intervals between each member's changes, one row at a time."""
+    end = int(history.as_of.timestamp())
+    by_user = {}
+    for _, user, activity, timestamp in history.events:
+        if history.users[user] in member_ids and timestamp > start:
+            by_user.setdefault(user, []).append((timestamp, activity))
+    intervals = []
+    for user, changes in by_user.items():
+        changes.sort()
+        for i, (timestamp, activity) in enumerate(changes):
+            stop = changes[i + 1][0] if i + 1 < len(changes) else end
+            if activity:
+                intervals.append((user, activity, timestamp, max(stop, timestamp)))
+    return intervals
+
+
+def brute_heatmap(intervals, utc_offset):
+    hours = np.zeros((7, 24))
+    for _, _, start, stop in intervals:
+        # Step through the local hours the interval covers
+        t, stop = start + utc_offset, stop + utc_offset
+        while t < stop:
+            boundary = min(stop, (t // 3600 + 1) * 3600)
+            local = datetime.fromtimestamp(t, timezone.utc)
+            hours[local.weekday(), local.hour] += boundary - t
+            t = boundary
+    return hours
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_intervals_match_brute_force(seed):
+    history = random_history(seed)
+    loaded = analytics.ActivityHistory()
+    loaded.update(history)
+    members = [1000 + user for user in range(1, 10)]
+    since = NOW - 14 * 86400
+    intervals = loaded.intervals(datetime.fromtimestamp(since), members)
+
+    expected = brute_intervals(history, since, set(members))
+    assert sorted(zip(
+        intervals.users.tolist(), intervals.activities.tolist(),
+        intervals.start.tolist(), intervals.stop.tolist())) == sorted(expected)
+
+    totals = {}
+    per_user = {}
+    for user, activity, start, stop in expected:
+        totals[f"Game {activity}"] = totals.get(f"Game {activity}", 0) \
+            + stop - start
+        per_user[1000 + user] = per_user.get(1000 + user, 0) + stop - start
+    assert dict(intervals.totals()) == {
+        name: timedelta(seconds=seconds) for name, seconds in totals.items()}
+    assert [seconds for _, seconds in intervals.totals()] == sorted(
+        (timedelta(seconds=s) for s in totals.values()), reverse=True)
+    assert dict(intervals.ranking(top=None)) == {
+        discord_id: timedelta(seconds=seconds)
+        for discord_id, seconds in per_user.items()}
+    assert len(intervals.ranking(top=3)) == 3
+
+    for utc_offset in (0, 3600, -5 * 3600 - 1800):
+        assert np.allclose(
+            intervals.heatmap(utc_offset), brute_heatmap(expected, utc_offset))
+
+
+def test_heatmap_splits_intervals_across_hours():
+    # Sunday 23:30 UTC until Monday 02:15, a week before NOW
+    start = NOW - 7 * 86400 - 1800
+    intervals = analytics.Intervals(
+        np.array([1]), np.array([1]), np.array([start]),
+        np.array([start + 2 * 3600 + 2700]), {1: 1}, {1: "Game"})
+    heatmap = intervals.heatmap()
+    assert heatmap[6, 23] == 1800
+    assert heatmap[0, 0] == heatmap[0, 1] == 3600
+    assert heatmap[0, 2] == 900
+    assert heatmap.sum() == 2 * 3600 + 2700
+
+
+def test_empty_intervals():
+    loaded = analytics.ActivityHistory()
+    loaded.update(History([], {}, {}, datetime.fromtimestamp(NOW)))
+    intervals = loaded.intervals(datetime.fromtimestamp(0), [1000])
+    assert len(intervals) == 0
+    assert intervals.totals() == []
+    assert intervals.ranking() == []
+    assert not intervals.heatmap().any()
+
+
+def test_updates_match_a_full_load():
+    history = random_history(7)
+    events = history.events
+    full = analytics.ActivityHistory()
+    full.update(history)
+
+    # Load in pieces, with the oldest changes removed along the way
+    partial = analytics.ActivityHistory()
+    history.events = events[:800]
+    partial.update(history)
+    history.events = events[100:1500]
+    partial.update(history)
+    history.events = events[100:]
+    partial.update(history)
+
+    history.events = events[100:]
+    trimmed = analytics.ActivityHistory()
+    trimmed.update(history)
+    for name in ("ids", "users", "activities", "timestamps"):
+        assert np.array_equal(getattr(partial, name), getattr(trimmed, name))
+    assert len(full.ids) == len(partial.ids) + 100
+    assert partial.last_id == full.last_id
+
+
+@pytest.mark.parametrize("text, seconds", [
+    ("12h", 12 * 3600), ("30d", 30 * 86400), (" 2 weeks", 14 * 86400),
+    ("6m", 180 * 86400), ("1y", 365 * 86400)])
+def test_parse_window(text, seconds):
+    assert analytics.parse_window(text) == timedelta(seconds=seconds)
+
+
+@pytest.mark.parametrize("text", ["", "d", "7", "7x", "-1d"])
+def test_parse_window_rejects(text):
+    with pytest.raises(ValueError):
+        analytics.parse_window(text)
@@ -0,0 +1,133 @@
+import asyncio
+
+import pytest
+
+import chatbot_standin
+from cogs import chatbot
+from cogs.chatbot import ResponseCache, normalize_prompt
+
+
+class Clock:
+    """Stands in for 'time.monotonic', moving only when told to."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(chatbot.time, "monotonic", clock)
+    return clock
+
+
+@pytest.mark.parametrize("text, normalized", [
+    ("  Hello,   WORLD!! ", "hello world"),
+    ("hello world", "hello world"),
+    ("HELLO\tworld?", "hello world"),
+    ("Ｈｅｌｌｏ ｗｏｒｌｄ", "hello world"),
+    ("Straße", "strasse"),
+    ("what's up", "what s up"),
+    ("!!!", ""),
+])
+def test_normalize_prompt(text, normalized):
+    assert normalize_prompt(text) == normalized
+
+
+def test_keeps_the_most_recently_used(clock):
+    cache = ResponseCache(size=2, ttl=60)
+    cache.put("a", "A")
+    cache.put("b", "B")
+    assert cache.get("a") == "A"
+    # 'b' is now the least recently used
+    cache.put("c", "C")
+    assert len(cache) == 2
+    assert "b" not in cache
+    assert cache.get("a") == "A"
+    assert cache.get("c") == "C"
+    # Replacing a reply makes it the most recently used
+    cache.put("a", "A2")
+    cache.put("d", "D")
+    assert cache.get("a") == "A2"
+    assert "c" not in cache
+
+
+def test_forgets_replies_after_their_ttl(clock):
+    cache = ResponseCache(size=10, ttl=60)
+    cache.put("a", "A")
+    clock.now += 30
+    cache.put("b", "B")
+    clock.now += 29.9
+    assert cache.get("a") == "A"
+    clock.now += 0.1
+    assert "a" not in cache
+    assert cache.get("a") is None
+    # Expired entries are dropped when looked up
+    assert len(cache) == 1
+    # Looking a reply up doesn't extend its life
+    assert cache.get("b") == "B"
+    clock.now += 30
+    assert cache.get("b") is None
+    assert len(cache) == 0
+
+
+def test_counts_hits_and_misses(clock):
+    cache = ResponseCache(size=1, ttl=60)
+    assert cache.get("a") is None
+    cache.put("a", "A")
+    assert cache.get("a") == "A"
+    assert cache.get("a") == "A"
+    cache.put("b", "B")
+    assert cache.get("a") is None
+    clock.now += 60
+    assert cache.get("b") is None
+    assert (cache.hits, cache.misses) == (2, 3)
+    # Checking whether a reply is there isn't a lookup
+    assert "a" not in cache
+    assert (cache.hits, cache.misses) == (2, 3)
+
+
+def test_size_zero_remembers_nothing(clock):
+    cache = ResponseCache(size=0, ttl=60)
+    cache.put("a", "A")
+    assert len(cache) == 0
+    assert cache.get("a") is None
+
+
+def test_repeated_prompts_are_answered_from_the_cache(monkeypatch):
+    pytest.importorskip("openai")
+
+    async def main():
+        standin = chatbot_standin.StandIn(delay=0)
+        server = await asyncio.start_server(standin.handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        monkeypatch.setenv("OPENAI_BASE_URL", f"http://127.0.0.1:{port}/v1")
+        monkeypatch.setenv("OPENAI_API_KEY", "x")
+        monkeypatch.setenv("CHATBOT_PROMPT", "Be brief.")
+        cog = chatbot.Chatbot(None)
+
+        async def ask(prompt, cache=True):
+            return "".join([
+                piece async for piece in cog.prompt(prompt, cache=cache)])
+
+        try:
+            first = await ask("Hello, world!")
+            assert cog.is_cached("hello   WORLD")
+            again = await ask("hello   WORLD")
+            fresh = await ask("Hello world", cache=False)
+            other = await ask("Goodbye")
+        finally:
+            await cog.openai_client.close()
+            server.close()
+            await server.wait_closed()
+        return cog, standin, (first, again, fresh, other)
+
+    cog, standin, replies = asyncio.run(main())
+    assert replies == (chatbot_standin.REPLY,) * 4
+    # Only the repeated prompt that may use the cache didn't reach the API
+    assert standin.served == 3
+    assert (cog.cache.hits, cog.cache.misses) == (1, 2)
+    assert len(cog.cache) == 2
@@ -0,0 +1,151 @@
+import csv
+import sqlite3
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+import database
+import export
+
+START = datetime(2025, 1, 1, tzinfo=timezone.utc)
+GUILDS = (111, 222)
+
+
+@pytest.fixture
+def db(tmp_path):
+    """A database with a song play and an activity change each hour."""
+    db = database.Database(str(tmp_path / "bot.db"))
+    for hour in range(48):
+        guild_id = GUILDS[hour % 2]
+        source = SimpleNamespace(
+            requester=SimpleNamespace(id=1000 + hour % 3),
+            search_term=f"search {hour}", song_title=f"Song {hour}",
+            artist=None if hour % 5 == 0 else f"Artist {hour % 4}")
+        id = db.insert_song_play(guild_id * 10 + hour % 2, source, guild_id)
+        db.update_song_play(id, hour % 3 == 0)
+        member = SimpleNamespace(
+            id=1000 + hour % 3, status=SimpleNamespace(name="online"),
+            activity=None if hour % 4 == 0 else SimpleNamespace(
+                type=SimpleNamespace(name="playing"), name=f"Game {hour % 2}"))
+        db.insert_activity_change(member, member)
+    with sqlite3.connect(db.path) as conn:
+        for hour in range(48):
+            when = START + timedelta(hours=hour)
+            conn.execute(
+                "UPDATE song_play SET timestamp = ? WHERE id = ?",
+                (when.strftime("%Y-%m-%d %H:%M:%S"), hour + 1))
+            conn.execute(
+                "UPDATE activity_event SET timestamp = ? WHERE id = ?",
+                (int(when.timestamp()), hour + 1))
+    return db
+
+
+def expected_plays(since=None, until=None, guild=None):
+    rows = []
+    for hour in range(48):
+        when = START + timedelta(hours=hour)
+        guild_id = GUILDS[hour % 2]
+        if since and when < since or until and when >= until \
+                or guild and guild_id != guild:
+            continue
+        rows.append({
+            "id": hour + 1, "user_id": 1000 + hour % 3, "server_id": guild_id,
+            "channel_id": guild_id * 10 + hour % 2,
+            "search_term": f"search {hour}", "song_title": f"Song {hour}",
+            "song_artist": None if hour % 5 == 0 else f"Artist {hour % 4}",
+            "finished": hour % 3 == 0, "timestamp": when})
+    return rows
+
+
+def read_csv(path):
+    types = dict(database.EXPORT_TABLES["song_play"][0])
+    rows = []
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            for name, kind in types.items():
+                if row[name] == "":
+                    row[name] = None
+                elif kind == "int":
+                    row[name] = int(row[name])
+                elif kind == "bool":
+                    row[name] = row[name] == "1"
+                elif kind == "time":
+                    row[name] = datetime.fromisoformat(row[name])
+            rows.append(row)
+    return rows
+
+
+def read_parquet(path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    return pq.read_table(path).to_pylist()
+
+
+FILTERS = [
+    {},
+    {"since": START + timedelta(hours=10)},
+    {"until": START + timedelta(hours=30)},
+    {"since": START + timedelta(hours=5), "until": START + timedelta(hours=6)},
+    {"guild": GUILDS[1]},
+    {"since": START + timedelta(days=1), "guild": GUILDS[0]},
+]
+
+
+@pytest.mark.parametrize("format, read", [
+    ("csv", read_csv), ("parquet", read_parquet)])
+@pytest.mark.parametrize("filters", FILTERS)
+def test_song_plays_round_trip(db, tmp_path, format, read, filters):
+    path = str(tmp_path / f"plays.{format}")
+    count = export.export(
+        db, "song_play", path, since=filters.get("since"),
+        until=filters.get("until"), server_id=filters.get("guild"),
+        batch_size=7)
+    expected = expected_plays(**filters)
+    assert count == len(expected)
+    assert read(path) == expected
+
+
+@pytest.mark.parametrize("format", export.FORMATS)
+def test_activity_changes_round_trip(db, tmp_path, format):
+    path = str(tmp_path / f"activity.{format}")
+    since = START + timedelta(hours=12)
+    until = START + timedelta(hours=36)
+    assert export.export(
+        db, "activity_event", path, since=since, until=until) == 24
+    if format == "csv":
+        with open(path, newline="", encoding="utf-8") as f:
+            rows = list(csv.DictReader(f))
+        times = [datetime.fromisoformat(row["timestamp"]) for row in rows]
+        names = [row["activity_name"] or None for row in rows]
+    else:
+        rows = read_parquet(path)
+        times = [row["timestamp"] for row in rows]
+        names = [row["activity_name"] for row in rows]
+    assert times == [since + timedelta(hours=i) for i in range(24)]
+    assert names == [
+        None if hour % 4 == 0 else f"Game {hour % 2}"
+        for hour in range(12, 36)]
+
+
+def test_empty_export_has_a_header(db, tmp_path):
+    path = str(tmp_path / "none.csv")
+    assert export.export(
+        db, "song_play", path, since=START + timedelta(days=30)) == 0
+    with open(path, encoding="utf-8") as f:
+        assert f.read().strip() == ",".join(
+            name for name, _ in database.EXPORT_TABLES["song_play"][0])
+    path = str(tmp_path / "none.parquet")
+    assert export.export(
+        db, "song_play", path, since=START + timedelta(days=30)) == 0
+    assert read_parquet(path) == []
+
+
+def test_refuses_what_it_cant_export(db, tmp_path):
+    with pytest.raises(ValueError, match="Can't export 'server'"):
+        export.export(db, "server", str(tmp_path / "server.csv"))
+    with pytest.raises(ValueError, match="Can't export to 'json'"):
+        export.export(db, "song_play", str(tmp_path / "plays.json"))
+    with pytest.raises(ValueError, match="isn't recorded per server"):
+        export.export(
+            db, "activity_event", str(tmp_path / "activity.csv"),
+            server_id=GUILDS[0])
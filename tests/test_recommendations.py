@@ -0,0 +1,95 @@
+import json
+
+import pytest
+
+import recommendations
+from recommendations import parse_songs
+
+
+def reply(*songs, **extra) -> str:
+    return json.dumps({"songs": list(songs), **extra})
+
+
+def song(title, artist):
+    return {"title": title, "artist": artist}
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    "Here are some songs you might like:",
+    '{"songs": [{"title": "Teardrop"',
+    "[]",
+    '"songs"',
+    "{}",
+    '{"songs": null}',
+    '{"songs": {"title": "Teardrop", "artist": "Massive Attack"}}',
+    '{"tracks": []}',
+])
+def test_rejects_replies_without_a_list_of_songs(text):
+    with pytest.raises(ValueError):
+        parse_songs(text)
+
+
+def test_keeps_valid_songs_in_order():
+    text = reply(
+        song("Teardrop", "Massive Attack"), song("Glory Box", "Portishead"))
+    assert parse_songs(text) == [
+        song("Teardrop", "Massive Attack"), song("Glory Box", "Portishead")]
+
+
+@pytest.mark.parametrize("bad", [
+    "Teardrop by Massive Attack",
+    ["Teardrop", "Massive Attack"],
+    None,
+    {"title": "Teardrop"},
+    {"artist": "Massive Attack"},
+    {"title": None, "artist": "Massive Attack"},
+    {"title": "Teardrop", "artist": 7},
+    {"title": ["Teardrop"], "artist": "Massive Attack"},
+    {"title": "  ", "artist": "Massive Attack"},
+    {"title": "Teardrop", "artist": ""},
+    {"title": "x" * (recommendations.MAX_LENGTH + 1), "artist": "Massive Attack"},
+    {"title": "Teardrop", "artist": "x" * (recommendations.MAX_LENGTH + 1)},
+])
+def test_drops_malformed_songs(bad):
+    text = reply(bad, song("Glory Box", "Portishead"))
+    assert parse_songs(text) == [song("Glory Box", "Portishead")]
+
+
+def test_strips_whitespace_and_ignores_extra_fields():
+    text = reply(
+        {"title": " Teardrop\n", "artist": "\tMassive Attack ", "year": 1998},
+        model="standin")
+    assert parse_songs(text) == [song("Teardrop", "Massive Attack")]
+
+
+def test_longest_allowed_title_is_kept():
+    title = "x" * recommendations.MAX_LENGTH
+    assert parse_songs(reply(song(title, "Artist"))) == [song(title, "Artist")]
+
+
+def test_drops_duplicates_and_songs_to_avoid():
+    text = reply(
+        song("Teardrop", "Massive Attack"),
+        song("TEARDROP", "massive attack"),
+        song("Glory Box", "Portishead"),
+        song("Roads", "Portishead"),
+        song("Teardrop", "Newton Faulkner"))
+    avoid = [song("glory box", "PORTISHEAD")]
+    assert parse_songs(text, avoid) == [
+        song("Teardrop", "Massive Attack"),
+        song("Roads", "Portishead"),
+        song("Teardrop", "Newton Faulkner")]
+
+
+def test_limit_counts_only_valid_songs():
+    text = reply(
+        {"title": "", "artist": "Nobody"},
+        song("Teardrop", "Massive Attack"),
+        song("Teardrop", "Massive Attack"),
+        song("Glory Box", "Portishead"),
+        song("Roads", "Portishead"))
+    assert parse_songs(text, limit=2) == [
+        song("Teardrop", "Massive Attack"), song("Glory Box", "Portishead")]
+    assert parse_songs(text, limit=0) == []
+    assert parse_songs(reply(), limit=5) == []
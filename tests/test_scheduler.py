@@ -0,0 +1,168 @@
+import asyncio
+import time
+
+import pytest
+
+import chatbot_standin
+from scheduler import CompletionScheduler, QueueFull, Throttled
+
+
+def unlimited(**kwargs) -> CompletionScheduler:
+    """A scheduler that never throttles, with any other limits given."""
+    limits = {
+        "guild_rate": 6000, "guild_burst": 100,
+        "user_rate": 6000, "user_burst": 100,
+    }
+    limits.update(kwargs)
+    return CompletionScheduler(**limits)
+
+
+def test_concurrency_cap():
+    async def main():
+        sched = unlimited(max_concurrent=2)
+        running = peak = 0
+
+        async def complete(guild_id, user_id):
+            nonlocal running, peak
+            async with sched.turn(guild_id, user_id):
+                running += 1
+                peak = max(peak, running)
+                await asyncio.sleep(0.02)
+                running -= 1
+
+        await asyncio.gather(*(complete(i % 3, i) for i in range(8)))
+        return sched, peak
+
+    sched, peak = asyncio.run(main())
+    assert peak == 2
+    assert sched.active == 0
+    assert sched.waiting == 0
+
+
+def test_guilds_take_turns():
+    async def main():
+        sched = unlimited(max_concurrent=1)
+        await sched.acquire(0, 0)
+        order = []
+        positions = {}
+
+        async def complete(guild_id, name):
+            async def on_position(position):
+                positions.setdefault(name, position)
+            await sched.acquire(guild_id, name, on_position)
+            order.append(name)
+            await asyncio.sleep(0)
+            sched.release()
+
+        tasks = []
+        for guild_id, name in ((1, "a1"), (1, "a2"), (2, "b1"),
+                               (1, "a3"), (3, "c1")):
+            tasks.append(asyncio.create_task(complete(guild_id, name)))
+            await asyncio.sleep(0)
+        sched.release()
+        await asyncio.gather(*tasks)
+        return order, positions
+
+    order, positions = asyncio.run(main())
+    # Guild 1 asked three times, but the others don't wait for all of those
+    assert order == ["a1", "b1", "c1", "a2", "a3"]
+    # Where each was when it started waiting: c1 came after a3, but goes
+    # ahead of it, since guild 3 gets a turn before guild 1's third
+    assert positions == {"a1": 1, "a2": 2, "b1": 2, "a3": 4, "c1": 3}
+
+
+def test_user_and_guild_throttling():
+    async def main():
+        sched = CompletionScheduler(
+            max_concurrent=10, guild_rate=1, guild_burst=3,
+            user_rate=1, user_burst=2)
+        await sched.acquire(1, 10)
+        await sched.acquire(1, 10)
+        with pytest.raises(Throttled, match="You're chatting too fast"):
+            await sched.acquire(1, 10)
+        await sched.acquire(1, 11)
+        with pytest.raises(Throttled, match="server is chatting too fast"):
+            await sched.acquire(1, 12)
+        # Other guilds have their own bucket
+        await sched.acquire(2, 12)
+        return sched
+
+    assert asyncio.run(main()).active == 4
+
+
+def test_queue_full_and_wait_deadline():
+    async def main():
+        sched = unlimited(max_concurrent=1, queue_size=1, wait=0.1)
+        await sched.acquire(1, 1)
+        waiting = asyncio.create_task(sched.acquire(2, 2))
+        await asyncio.sleep(0)
+        assert sched.waiting == 1
+        with pytest.raises(QueueFull, match="Too many people"):
+            await sched.acquire(3, 3)
+
+        start = time.monotonic()
+        with pytest.raises(QueueFull, match="too busy"):
+            await waiting
+        waited = time.monotonic() - start
+        return sched, waited
+
+    sched, waited = asyncio.run(main())
+    assert 0.05 <= waited < 1
+    # The refused waiter left the queue, and the turn is still held
+    assert sched.waiting == 0
+    assert not sched._rotation
+    assert sched.active == 1
+
+
+def test_backoff_on_rate_limit_from_standin():
+    openai = pytest.importorskip("openai")
+    from cogs.chatbot import Chatbot
+
+    async def main():
+        standin = chatbot_standin.StandIn(
+            delay=0, rate_limit=1.0, retry_after=0.3)
+        server = await asyncio.start_server(standin.handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        client = openai.AsyncOpenAI(
+            base_url=f"http://127.0.0.1:{port}/v1", api_key="x",
+            max_retries=0)
+        sched = unlimited(max_concurrent=2)
+        try:
+            async with sched.turn(1, 1):
+                with pytest.raises(openai.RateLimitError) as error:
+                    await client.chat.completions.create(
+                        model="standin", stream=True,
+                        messages=[{"role": "user", "content": "hi"}])
+                retry_after = Chatbot._retry_after(error.value)
+                sched.backoff(retry_after)
+                assert sched.paused
+
+                # Nothing new starts while paused, even with room for it
+                start = time.monotonic()
+                other = asyncio.create_task(sched.acquire(2, 2))
+                await asyncio.sleep(0.05)
+                assert not other.done()
+
+                standin.rate_limit = 0.0
+                await sched.resumed()
+                resumed_after = time.monotonic() - start
+                stream = await client.chat.completions.create(
+                    model="standin", stream=True,
+                    messages=[{"role": "user", "content": "hi"}])
+                reply = "".join([
+                    chunk.choices[0].delta.content async for chunk in stream
+                    if chunk.choices and chunk.choices[0].delta.content])
+                await other
+                sched.release()
+        finally:
+            await client.close()
+            server.close()
+            await server.wait_closed()
+        return retry_after, resumed_after, reply, standin
+
+    retry_after, resumed_after, reply, standin = asyncio.run(main())
+    assert retry_after == 0.3
+    assert resumed_after >= 0.2
+    assert reply == chatbot_standin.REPLY
+    assert standin.limited == 1
+    assert standin.served == 1
@@ -0,0 +1,137 @@
+import random
+import time
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+import similarity
+from database import AnalyticsResult
+
+SONGS = [
+    ("Teardrop", "Massive Attack"), ("Angel", "Massive Attack"),
+    ("Glory Box", "Portishead"), ("Roads", "Portishead"),
+    ("Unfinished Sympathy", "Massive Attack"), ("Karmacoma", None),
+    ("Hyperballad", "Björk"), ("Army of Me", "Björk"), ("Joga", "Björk"),
+    ("Windowlicker", "Aphex Twin"), ("Xtal", "Aphex Twin"),
+]
+
+
+class Plays:
+    """Serves song plays the way 'Database.get_song_play_history' does."""
+
+    def __init__(self, plays):
+        self.plays = plays
+
+    def get_song_play_history(self, after):
+        return AnalyticsResult(
+            [play for play in self.plays if play[0] > after], datetime.now())
+
+
+def random_plays(seed, count=400):
+    """Plays in a few channels, some in long sessions, ending just now."""
+    rng = random.Random(seed)
+    now = int(time.time())
+    events = []
+    for channel in range(1, 4):
+        timestamp = now - 3 * 86400
+        while timestamp < now:
+            # Mostly back to back, sometimes after a break that ends the
+            # session
+            timestamp += rng.choice((200, 240, 300, 3600 * 3))
+            title, artist = rng.choice(SONGS)
+            if rng.random() < 0.2:
+                title = title.upper()
+            if rng.random() < 0.05:
+                # Played from a URL, and not yet enriched
+                title = artist = None
+            user = rng.choice((None, 501, 502, 503, 504))
+            events.append((timestamp, channel, user, title, artist))
+    events.sort(key=lambda event: event[0])
+    return [
+        (id, channel, user, title, artist, random.Random(id).random() < 0.7,
+         timestamp)
+        for id, (timestamp, channel, user, title, artist)
+        in enumerate(events[-count:], 1)]
+
+
+def canonical(graph):
+    """The graph's counts, with songs and users in a fixed order."""
+    songs = sorted(
+        range(len(graph.songs)),
+        key=lambda i: similarity._key(**graph.songs[i]))
+    users = [graph._users[user] for user in sorted(graph._users)]
+    return {
+        "songs": [similarity._key(**graph.songs[i]) for i in songs],
+        "users": sorted(graph._users),
+        "cooccurrence": graph.cooccurrence.toarray()[np.ix_(songs, songs)],
+        "affinity": graph.affinity.toarray()[np.ix_(users, songs)],
+        "plays": graph.plays[songs],
+        "finished": graph.finished[songs],
+    }
+
+
+def assert_same(graph, other):
+    first, second = canonical(graph), canonical(other)
+    assert first["songs"] == second["songs"]
+    assert first["users"] == second["users"]
+    for name in ("cooccurrence", "affinity", "plays", "finished"):
+        assert np.allclose(first[name], second[name]), name
+
+
+@pytest.mark.parametrize("seed, step", [(0, 1), (1, 7), (2, 50), (3, 133)])
+def test_updates_match_a_full_rebuild(seed, step):
+    plays = random_plays(seed)
+    full = similarity.SongGraph()
+    full.update(Plays(plays))
+
+    graph = similarity.SongGraph()
+    db = Plays([])
+    for end in range(step, len(plays) + step, step):
+        db.plays = plays[:end]
+        graph.update(db)
+    assert graph.last_id == full.last_id
+    assert_same(graph, full)
+
+    recent = [{"title": "Teardrop", "artist": "Massive Attack"},
+              {"title": "GLORY BOX", "artist": "Portishead"}]
+    picks = graph.recommend(recent, [501, 503], top=5)
+    expected = full.recommend(recent, [501, 503], top=5)
+    assert [similarity._key(**song) for song, _ in picks] == [
+        similarity._key(**song) for song, _ in expected]
+    assert np.allclose(
+        [score for _, score in picks], [score for _, score in expected])
+
+
+def test_latest_play_waits_until_its_over():
+    now = int(time.time())
+    db = Plays([
+        (1, 1, 501, "Teardrop", "Massive Attack", True, now - 600),
+        (2, 1, 501, "Angel", "Massive Attack", False, now - 300),
+    ])
+    graph = similarity.SongGraph()
+    graph.update(db)
+    assert [song["title"] for song in graph.songs] == ["Teardrop"]
+    assert graph.plays.tolist() == [1]
+
+    db.plays.append((3, 1, 502, "Roads", "Portishead", True, now))
+    graph.update(db)
+    assert [song["title"] for song in graph.songs] == ["Teardrop", "Angel"]
+    teardrop, angel = 0, 1
+    assert graph.cooccurrence[teardrop, angel] == pytest.approx(
+        similarity.SKIP_WEIGHT)
+    assert graph.finished.tolist() == [1, 0]
+
+
+def test_untitled_plays_are_left_out():
+    now = int(time.time()) - 2 * similarity.PENDING_AGE
+    graph = similarity.SongGraph()
+    graph.update(Plays([
+        (1, 1, 501, None, None, True, now),
+        (2, 1, 501, "Teardrop", "Massive Attack", True, now + 60),
+        (3, 1, 502, None, None, True, now + 120),
+    ]))
+    assert len(graph) == 1
+    assert graph.recommend(
+        [{"title": None, "artist": None}], avoid=[
+            {"title": None, "artist": None}]) == []
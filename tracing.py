@@ -0,0 +1,344 @@
+"""
+Tracing of song requests, from the command to the first audio frame.
+
+Each traced '!play' is a tree of timed spans: the command itself, the LastFM
+and yt-dlp lookups, queueing, waiting in the queue, and the player's steps up
+to the first frame of audio. The root span, named 'play', lasts from the
+command until that first frame, so it's what the user waited for, and its
+children show where that time went.
+
+Spans are carried by a context variable, so a span started while another is
+current becomes its child, including in tasks started from it. Requests are
+handed between tasks through the song's source, which keeps its trace.
+
+When no trace is current, starting a span does nothing, so untraced code
+paths pay next to nothing. Finished spans are put on a queue and written to
+a JSONL file by a background thread, one object per line:
+
+    {"trace": "9f2c...", "span": "41ab...", "parent": "77d0...",
+     "name": "from_search", "start": 1760000000.123, "ms": 812.4}
+
+Summarize them with:
+
+    $ python . --trace-summary traces.jsonl
+
+Settings are read from the environment:
+
+    TRACE_PATH    File spans are appended to, e.g. 'traces.jsonl'. Tracing
+                  is off unless it's set, since the file grows without
+                  bound.
+    TRACE_SAMPLE  Fraction of requests traced, from 0 to 1. Defaults to 1.
+"""
+
+import atexit
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import typing
+
+logger = logging.getLogger("tracing")
+
+PERCENTILES = (50, 90, 99)
+
+# The span that new spans are children of
+_current = contextvars.ContextVar("span", default=None)
+
+# Finished spans waiting to be written, and the thread writing them
+_spans = queue.SimpleQueue()
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def _new_id() -> str:
+    return f"{random.getrandbits(64):016x}"
+
+
+class Span:
+    """
+    A timed step of a traced request.
+
+    Spans are usually used as context managers, which make them current and
+    end them on exit, but can also be ended explicitly from any thread.
+
+    Args:
+        name (str): What the step is.
+        trace_id (str): The request the step is part of.
+        parent_id (str): The span the step is part of, if any.
+        start (float): When the step started, by 'time.perf_counter()'.
+            Defaults to now.
+        **attributes: Details written with the span.
+    """
+
+    __slots__ = (
+        "name", "trace_id", "id", "parent_id", "start", "attributes",
+        "_ended", "_token")
+
+    def __init__(
+        self,
+        name: str,
+        trace_id: str,
+        parent_id: str = None,
+        start: float = None,
+        **attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.id = _new_id()
+        self.parent_id = parent_id
+        self.start = time.perf_counter() if start is None else start
+        self.attributes = attributes
+        self._ended = False
+        self._token = None
+
+    def child(self, name: str, start: float = None, **attributes) -> "Span":
+        """Starts a span within this one."""
+        return Span(name, self.trace_id, self.id, start, **attributes)
+
+    def end(self, **attributes):
+        """Ends the span and queues it to be written. Later calls do nothing."""
+        if self._ended:
+            return
+        self._ended = True
+        end = time.perf_counter()
+        self.attributes.update(attributes)
+        _write({
+            "trace": self.trace_id,
+            "span": self.id,
+            "parent": self.parent_id,
+            "name": self.name,
+            # Wall clock time the span started
+            "start": round(time.time() - (end - self.start), 3),
+            "ms": round((end - self.start) * 1000, 2),
+            **self.attributes,
+        })
+
+    def __enter__(self) -> "Span":
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        _current.reset(self._token)
+        if exc_type is not None:
+            self.end(error=exc_type.__name__)
+        else:
+            self.end()
+
+
+class _NoSpan:
+    """Stands in for a span when nothing is being traced."""
+
+    __slots__ = ()
+
+    def child(self, name: str, start: float = None, **attributes) -> "_NoSpan":
+        return self
+
+    def end(self, **attributes):
+        pass
+
+    def __enter__(self) -> "_NoSpan":
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def __bool__(self) -> bool:
+        return False
+
+
+NO_SPAN = _NoSpan()
+
+
+def enabled() -> bool:
+    """Returns whether spans are written anywhere."""
+    return bool(os.getenv("TRACE_PATH"))
+
+
+def begin(name: str, **attributes) -> typing.Union[Span, _NoSpan]:
+    """
+    Starts tracing a request, and makes its root span current.
+
+    The root span isn't ended on its own; end it once the request is done,
+    which may be in another task or thread.
+
+    Args:
+        name (str): What the request is.
+        **attributes: Details written with the root span.
+
+    Returns:
+        Span: The root span, or a stand-in if the request isn't sampled.
+    """
+    if not enabled() or random.random() >= float(os.getenv("TRACE_SAMPLE", "1")):
+        return NO_SPAN
+    span = Span(name, _new_id(), **attributes)
+    _current.set(span)
+    return span
+
+
+def current() -> typing.Union[Span, _NoSpan]:
+    """Returns the current span, or a stand-in if nothing is traced."""
+    return _current.get() or NO_SPAN
+
+
+def span(name: str, start: float = None, **attributes):
+    """
+    Starts a child of the current span, if there is one.
+
+    Examples:
+        >>> with tracing.span("lastfm"):
+        ...     response = requests.get(url)
+    """
+    parent = _current.get()
+    if parent is None:
+        return NO_SPAN
+    return parent.child(name, start, **attributes)
+
+
+def use(span: typing.Optional[Span]):
+    """
+    Makes a span current for a block, without ending it afterwards.
+
+    This picks up a request's trace in another task, such as the player's.
+    """
+    if not span:
+        return contextlib.nullcontext()
+    return _Use(span)
+
+
+def clear():
+    """
+    Stops the current task from adding spans to whatever was current.
+
+    Tasks inherit the current span from where they were created, so a
+    long-lived task started while handling a request, such as a player,
+    would otherwise add everything it ever does to that request's trace.
+    """
+    _current.set(None)
+
+
+class _Use:
+    __slots__ = ("span", "_token")
+
+    def __init__(self, span: Span):
+        self.span = span
+
+    def __enter__(self) -> Span:
+        self._token = _current.set(self.span)
+        return self.span
+
+    def __exit__(self, *exc_info):
+        _current.reset(self._token)
+
+
+def traced(name: str):
+    """
+    Decorator that runs each call of a coroutine in a span.
+
+    Examples:
+        >>> @tracing.traced("create")
+        ... async def create(cls, search):
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            with span(name):
+                return await function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def _write(record: dict):
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = threading.Thread(
+                    target=_run_writer,
+                    args=(os.getenv("TRACE_PATH"),),
+                    name="trace-writer", daemon=True)
+                _writer.start()
+    _spans.put(record)
+
+
+def _run_writer(path: str):
+    with open(path, "a", encoding="utf-8") as f:
+        while True:
+            record = _spans.get()
+            if record is None:
+                break
+            f.write(json.dumps(record, default=str) + "\n")
+            # Write out everything queued at once before flushing
+            if _spans.empty():
+                f.flush()
+
+
+@atexit.register
+def _stop_writer():
+    if _writer is not None:
+        _spans.put(None)
+        _writer.join(timeout=5)
+
+
+def _percentile(values: list[float], percent: float) -> float:
+    """Returns the nearest-rank percentile of sorted values."""
+    index = max(0, -(-len(values) * percent // 100) - 1)
+    return values[int(index)]
+
+
+def summarize(path: str, since: float = None) -> dict[str, dict[str, float]]:
+    """
+    Works out percentiles of how long each kind of span took.
+
+    Args:
+        path (str): The JSONL file of spans.
+        since (float): Only count spans started since this Unix time.
+
+    Returns:
+        dict[str, dict[str, float]]: For each span name, the 'count' of spans,
+            the 'p50', 'p90' and 'p99' milliseconds, and the 'max'.
+    """
+    durations = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line cut short by a crash
+                continue
+            if since is not None and record["start"] < since:
+                continue
+            durations.setdefault(record["name"], []).append(record["ms"])
+    summary = {}
+    for name, values in durations.items():
+        values.sort()
+        summary[name] = {"count": len(values)}
+        for percent in PERCENTILES:
+            summary[name][f"p{percent}"] = _percentile(values, percent)
+        summary[name]["max"] = values[-1]
+    return summary
+
+
+def report(path: str, since: float = None) -> int:
+    """
+    Prints percentiles of each kind of span, slowest first.
+
+    Returns:
+        int: The exit status, non-zero if the file couldn't be read.
+    """
+    try:
+        summary = summarize(path, since)
+    except OSError as e:
+        print(f"Couldn't read traces: {e}")
+        return 1
+    columns = ["count"] + [f"p{percent}" for percent in PERCENTILES] + ["max"]
+    print(f"{'span (ms)':24}" + "".join(f"{column:>10}" for column in columns))
+    for name, row in sorted(
+            summary.items(), key=lambda item: -item[1]["p50"]):
+        print(f"{name:24}{row['count']:>10}" + "".join(
+            f"{row[column]:>10.1f}" for column in columns[1:]))
+    return 0
@@ -0,0 +1,364 @@
+"""
+Out-of-process audio pipeline for the music player.
+
+By default discord.py runs FFmpeg output through volume scaling and Opus
+encoding on a thread inside the bot process for every voice client, so every
+guild shares one GIL. This module moves that work into a pool of worker
+processes. The bot process keeps the gateway and voice connections and only
+forwards ready-made Opus packets to Discord, which is cheap.
+
+Workers and the bot talk over a pipe per worker using small tuples:
+
+    bot -> worker:
+        ("play", session_id, spec, volume)
+        ("stop", session_id)
+        ("volume", session_id, volume)
+        ("ack", session_id, count)
+        ("shutdown",)
+    worker -> bot:
+        ("spawned", session_id, pid)
+        ("frame", session_id, packet)
+        ("finished", session_id, error)
+
+Workers only stay a fixed number of frames ahead of what the voice client has
+actually read, and the bot acknowledges frames as it reads them. Pausing the
+voice client therefore pauses the worker as well, without a separate message.
+"""
+
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+
+import discord
+
+import logs
+
+logger = logging.getLogger("voice_workers")
+
+# Number of frames (20ms each) a worker may encode ahead of playback
+WINDOW_FRAMES = 25
+
+# Number of frames read before acknowledging them to the worker
+ACK_FRAMES = 5
+
+# Opus encoded silence, played while waiting on a worker
+OPUS_SILENCE = b"\xf8\xff\xfe"
+
+
+class _Session(threading.Thread):
+    """A single song being decoded and encoded inside a worker process."""
+
+    def __init__(self, session_id, spec, volume, send):
+        super().__init__(daemon=True, name=f"voice-session-{session_id}")
+        self.session_id = session_id
+        self.spec = spec
+        self.volume = volume
+        self._send = send
+        self._credit = threading.Semaphore(WINDOW_FRAMES)
+        self._stopped = threading.Event()
+
+    def ack(self, count: int):
+        self._credit.release(count)
+
+    def stop(self):
+        self._stopped.set()
+        self._credit.release()
+
+    def run(self):
+        from cogs import music_player
+
+        error = None
+        source = None
+        try:
+            source = music_player.YTDLSource(**self.spec).open()
+            self._send(("spawned", self.session_id, source.pid))
+            encoder = discord.opus.Encoder()
+            while True:
+                self._credit.acquire()
+                if self._stopped.is_set():
+                    break
+                source.volume = self.volume
+                pcm = source.read()
+                if not pcm:
+                    if source.failed:
+                        error = f"Stream dropped at {source.position:.1f}s"
+                    break
+                packet = encoder.encode(pcm, encoder.SAMPLES_PER_FRAME)
+                self._send(("frame", self.session_id, packet))
+        except Exception as e:
+            logger.exception("Voice session %s failed", self.session_id)
+            error = repr(e)
+        finally:
+            if source:
+                source.cleanup()
+            self._send(("finished", self.session_id, error))
+
+
+def _worker_main(conn):
+    """Entry point of a worker process."""
+    # Imported up front so that sessions starting at the same time don't race
+    # to import it
+    from cogs import music_player
+
+    # Exit handlers don't run in worker processes, so the writer is stopped
+    # below instead
+    logs.setup()
+
+    sessions = {}
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            try:
+                conn.send(message)
+            except (BrokenPipeError, OSError):
+                pass
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        op, *args = message
+        if op == "shutdown":
+            break
+        elif op == "play":
+            session_id, spec, volume = args
+            session = _Session(session_id, spec, volume, send)
+            sessions[session_id] = session
+            session.start()
+        elif op == "stop":
+            session = sessions.pop(args[0], None)
+            if session:
+                session.stop()
+        elif op == "volume":
+            session = sessions.get(args[0])
+            if session:
+                session.volume = args[1]
+        elif op == "ack":
+            session = sessions.get(args[0])
+            if session:
+                session.ack(args[1])
+
+    for session in sessions.values():
+        session.stop()
+    logs.shutdown()
+
+
+class WorkerAudioSource(discord.AudioSource):
+    """
+    An Opus audio source fed by a voice worker process.
+
+    This is handed to 'VoiceClient.play()' in place of the song's own source.
+    Setting its volume forwards the change to the worker, and cleaning it up
+    stops the worker's FFmpeg process.
+    """
+
+    def __init__(self, worker: "_Worker", session_id: int, guild_id: int,
+                 volume: float, start_at: float = 0):
+        self.worker = worker
+        self.session_id = session_id
+        self.guild_id = guild_id
+        self.start_at = start_at
+        self.frames = 0
+        self.error = None   # Why the worker ended the song early, if it did
+        self.pid = None     # PID of the FFmpeg process in the worker
+        self.first_frame = None     # Spans to end on the first frame
+        self._volume = volume
+        self._frames = queue.Queue()
+        self._unacked = 0
+        self._finished = False
+
+    @property
+    def volume(self) -> float:
+        return self._volume
+
+    @volume.setter
+    def volume(self, value: float):
+        self._volume = max(value, 0.0)
+        self.worker.send(("volume", self.session_id, self._volume))
+
+    @property
+    def position(self) -> float:
+        """How far into the song playback is, in seconds."""
+        frame_length = discord.opus.Encoder.FRAME_LENGTH / 1000
+        return self.start_at + self.frames * frame_length
+
+    @property
+    def failed(self) -> bool:
+        return self.error is not None
+
+    def is_opus(self) -> bool:
+        return True
+
+    def read(self) -> bytes:
+        if self._finished:
+            return b""
+        try:
+            packet = self._frames.get(timeout=0.02)
+        except queue.Empty:
+            # The worker is still starting FFmpeg or fell behind; keep the
+            # voice connection fed rather than ending the song
+            return OPUS_SILENCE
+        if packet is None:
+            self._finished = True
+            return b""
+        self.frames += 1
+        if self.first_frame:
+            for span in self.first_frame:
+                span.end()
+            self.first_frame = None
+        self._unacked += 1
+        if self._unacked >= ACK_FRAMES:
+            self.worker.send(("ack", self.session_id, self._unacked))
+            self._unacked = 0
+        return packet
+
+    def cleanup(self):
+        self.worker.close_session(self)
+
+
+class _Worker:
+    """The bot-side handle of one worker process."""
+
+    def __init__(self, context, index: int):
+        self.context = context
+        self.index = index
+        self.process = None
+        self.conn = None
+        self.sessions = {}
+        self._send_lock = threading.Lock()
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def start(self):
+        self.conn, child_conn = self.context.Pipe()
+        self.process = self.context.Process(
+            target=_worker_main,
+            args=(child_conn,),
+            name=f"voice-worker-{self.index}",
+            daemon=True)
+        self.process.start()
+        child_conn.close()
+        threading.Thread(
+            target=self._reader,
+            args=(self.conn,),
+            name=f"voice-worker-{self.index}-reader",
+            daemon=True).start()
+        logger.info("Started voice worker %d (pid %d)",
+                    self.index, self.process.pid)
+
+    def send(self, message):
+        with self._send_lock:
+            try:
+                self.conn.send(message)
+            except (BrokenPipeError, OSError):
+                logger.warning("Voice worker %d is gone", self.index)
+
+    def close_session(self, source: WorkerAudioSource):
+        if self.sessions.pop(source.session_id, None) is not None:
+            self.send(("stop", source.session_id))
+
+    def _reader(self, conn):
+        """Routes packets from the worker to the matching audio sources."""
+        while True:
+            try:
+                op, session_id, payload = conn.recv()
+            except (EOFError, OSError):
+                break
+            source = self.sessions.get(session_id)
+            if source is None:
+                continue
+            if op == "frame":
+                source._frames.put(payload)
+            elif op == "spawned":
+                source.pid = payload
+            elif op == "finished":
+                source.error = payload
+                source._frames.put(None)
+
+        # If the worker died mid-song, end its songs so their players move on
+        if self.sessions:
+            logger.error("Voice worker %d exited during playback", self.index)
+        for source in list(self.sessions.values()):
+            source._frames.put(None)
+
+
+class WorkerPool:
+    """
+    A pool of voice worker processes shared by every guild's music player.
+
+    Workers are spawned lazily the first time they are needed, and each new
+    song goes to the worker currently encoding the fewest songs.
+
+    Examples:
+        >>> pool = WorkerPool(4)
+        >>> audio = pool.open(guild.id, source, volume=0.5)
+        >>> guild.voice_client.play(audio)
+    """
+
+    def __init__(self, size: int):
+        context = multiprocessing.get_context("spawn")
+        self._workers = [_Worker(context, i) for i in range(size)]
+        self._session_ids = itertools.count()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "WorkerPool":
+        """
+        Creates a pool sized by the 'VOICE_WORKERS' environment variable.
+
+        The variable may be a number of workers, or 'auto' for one worker per
+        CPU core. Voice workers are disabled when it is unset or zero.
+
+        Returns:
+            WorkerPool: The pool, or None if voice workers are disabled.
+        """
+        size = os.getenv("VOICE_WORKERS", "0").strip().lower()
+        if size == "auto":
+            size = os.cpu_count() or 1
+        else:
+            size = int(size or 0)
+        return cls(size) if size > 0 else None
+
+    def open(self, guild_id: int, source, volume: float = 1.0
+             ) -> WorkerAudioSource:
+        """
+        Starts playing a song on the least loaded worker.
+
+        Args:
+            guild_id (int): The guild the song is played in.
+            source (music_player.YTDLSource): The song to play. Its FFmpeg
+                process is spawned by the worker, not here.
+            volume (float): The starting volume.
+
+        Returns:
+            WorkerAudioSource: An Opus source to hand to the voice client.
+        """
+        with self._lock:
+            worker = min(self._workers, key=lambda w: len(w.sessions))
+            if not worker.is_alive():
+                worker.start()
+            session_id = next(self._session_ids)
+            audio = WorkerAudioSource(
+                worker, session_id, guild_id, volume, source.start_at)
+            worker.sessions[session_id] = audio
+        worker.send(("play", session_id, source.to_spec(), volume))
+        return audio
+
+    def load(self) -> list[int]:
+        """Returns the number of songs being played by each worker."""
+        return [len(w.sessions) for w in self._workers]
+
+    def shutdown(self):
+        """Stops all worker processes."""
+        for worker in self._workers:
+            if worker.is_alive():
+                worker.send(("shutdown",))
+                worker.process.join(timeout=5)
+                if worker.process.is_alive():
+                    worker.process.kill()